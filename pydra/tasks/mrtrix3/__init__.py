@@ -1,8 +1,76 @@
 """
 >>> import pydra
 >>> import pydra.tasks.mrtrix3
+>>> pydra.tasks.mrtrix3.MRConvert.executable
+'mrconvert'
+
+Tasks are imported from their modules when first accessed, so importing the
+package itself stays cheap however many wrappers it holds. Commands without a
+hand-written task are taken from the generated spec table, if there is one (see
+:mod:`pydra.tasks.mrtrix3.autogen`).
 """
-from ._version import get_versions
+import importlib
+
+#: module defining each task exported by the package
+_TASK_MODULES = {
+    "MRConvert": "utils",
+    "MRConvertBatch": "utils",
+    "header_info": "utils",
+    "MRTrix3Pipeline": "pipeline",
+    "pipe": "pipeline",
+    "DWIDenoise": "preprocess",
+    "MRDeGibbs": "preprocess",
+    "DWIFslPreproc": "preprocess",
+    "DWIBiasCorrect": "preprocess",
+    "DWI2Mask": "preprocess",
+    "dwi_preproc_workflow": "workflows",
+    "FOD2Fixel": "fixel",
+    "FixelCorrespondence": "fixel",
+    "Fixel2Voxel": "fixel",
+    "FixelCFEStats": "fixel",
+    "Tck2Connectome": "connectome",
+    "TckEdit": "tractography",
+    "TckGen": "tractography",
+}
+
+__all__ = ["__version__"] + list(_TASK_MODULES)
+
+
+def __getattr__(name):
+    if name == "__version__":
+        value = _get_version()
+    elif name in _TASK_MODULES:
+        module = importlib.import_module(f".{_TASK_MODULES[name]}", __name__)
+        value = getattr(module, name)
+    elif name[:1].isupper():
+        from .autogen import task_class
+
+        value = task_class(name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    from .autogen import available
+
+    return sorted(set(globals()) | set(__all__) | set(available()))
+
+
+def _get_version() -> str:
+    """ version recorded in the installed package's metadata, only falling back
+        to versioneer (which may query git) for source trees that aren't installed
+    """
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:  # Python 3.7
+        pass
+    else:
+        try:
+            return version("pydra-mrtrix3")
+        except PackageNotFoundError:
+            pass
+    from ._version import get_versions
 
-__version__ = get_versions()["version"]
-del get_versions
+    return get_versions()["version"]
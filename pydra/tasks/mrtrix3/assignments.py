@@ -0,0 +1,277 @@
+"""
+Connectomes built in-process from streamline-to-node assignments.
+
+tck2connectome maps the endpoints of every streamline to the nodes of a
+parcellation and sums the contributions to each edge in a single pass, so any
+change of scaling or weighting means re-reading the whole tractogram.
+:func:`assign` does the mapping once, keeping the pair of nodes of each
+streamline as an int32 array (the equivalent of ``-out_assignments``) along
+with the streamline lengths and, optionally, the mean of images sampled along
+each streamline (e.g. FA). Any number of connectomes can then be built from the
+:class:`Assignments` with :meth:`Assignments.connectome`, each as a handful of
+vectorised operations over the streamlines.
+
+Example
+-------
+>>> import numpy as np
+>>> from pydra.tasks.mrtrix3.assignments import Assignments, assign
+>>> from pydra.tasks.mrtrix3.image import ImageHeader, save_mif
+>>> from pydra.tasks.mrtrix3.streamlines import TckWriter
+>>> labels = np.zeros((4, 1, 1), dtype=np.int16)
+>>> labels[:, 0, 0] = [1, 0, 2, 3]
+>>> header = ImageHeader(dim=(4, 1, 1), vox=(2.0, 2.0, 2.0), layout="+0,+1,+2",
+...                      datatype="Int16LE")
+>>> _ = save_mif("parcels.mif", labels, header)
+>>> with TckWriter("connect.tck") as writer:
+...     writer.write_batch([
+...         np.array([[0.0, 0, 0], [2, 0, 0], [4, 0, 0]]),  # nodes 1 to 2
+...         np.array([[6.0, 0, 0], [2, 0, 0], [0, 0, 0]]),  # nodes 3 to 1
+...         np.array([[4.0, 0, 0], [6, 0, 0]]),  # nodes 2 to 3
+...         np.array([[2.0, 0, 0], [2, 0, 1]]),  # unassigned
+...     ])
+>>> assignments = assign("connect.tck", "parcels.mif", radius=0)
+>>> assignments.nodes.tolist()
+[[1, 2], [3, 1], [2, 3], [0, 0]]
+>>> assignments.connectome().tolist()
+[[0.0, 1.0, 1.0], [0.0, 0.0, 1.0], [0.0, 0.0, 0.0]]
+>>> assignments.connectome(scale="length", symmetric=True)[0].tolist()
+[0.0, 4.0, 6.0]
+>>> sift2 = np.array([0.5, 2.0, 1.0, 1.0])
+>>> assignments.connectome(weights=sift2, zero_diagonal=True)[0].tolist()
+[0.0, 0.5, 2.0]
+>>> assignments.save("connect_assignments.npz")
+>>> Assignments.load("connect_assignments.npz").lengths.tolist()
+[4.0, 6.0, 2.0, 1.0]
+"""
+import typing as ty
+import attr
+import numpy as np
+from .image import ImageHeader, VoxelLookup
+from .streamlines import TckReader, concatenate, segment_sums, streamline_lengths
+
+
+#: default radius (in mm) of the search for the nearest node around an endpoint,
+#: as in tck2connectome
+DEFAULT_RADIUS = 4.0
+
+#: statistics combining the contributions of the streamlines of an edge
+EDGE_STATS = ("sum", "mean", "min", "max")
+
+#: scalings of the contribution of each streamline by its length
+SCALINGS = (None, "length", "invlength")
+
+
+def _search_offsets(header: ImageHeader, radius: float) -> np.ndarray:
+    """ voxel offsets within ``radius`` mm, nearest first (the centre excluded) """
+    vox = np.asarray(header.vox[:3], dtype=np.float64)
+    extent = np.floor(radius / vox).astype(int)
+    grid = np.stack(
+        np.meshgrid(*(np.arange(-e, e + 1) for e in extent), indexing="ij"), axis=-1
+    ).reshape(-1, 3)
+    distances = np.linalg.norm(grid * vox, axis=1)
+    order = np.argsort(distances, kind="stable")
+    grid, distances = grid[order], distances[order]
+    return grid[(distances > 0) & (distances <= radius)]
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class Assignments:
+    """ nodes of the two ends of each streamline of a tractogram
+
+        - nodes is an (N, 2) int32 array of node labels, 0 where an endpoint was
+          assigned to no node
+        - lengths holds the length (in mm) of each streamline, if known
+        - samples maps names to the mean of an image along each streamline
+        - nnodes is the number of nodes of the parcellation (its largest label)
+    """
+
+    nodes: np.ndarray
+    nnodes: int
+    lengths: ty.Optional[np.ndarray] = None
+    samples: ty.Dict[str, np.ndarray] = attr.ib(factory=dict)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def save(self, path: str):
+        """ save to a .npz file """
+        arrays = {"nodes": self.nodes, "nnodes": np.array(self.nnodes)}
+        if self.lengths is not None:
+            arrays["lengths"] = self.lengths
+        arrays.update({f"sample_{k}": v for k, v in self.samples.items()})
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> "Assignments":
+        """ load from a .npz file written by :meth:`save` """
+        with np.load(path) as arrays:
+            return cls(
+                nodes=arrays["nodes"],
+                nnodes=int(arrays["nnodes"]),
+                lengths=arrays["lengths"] if "lengths" in arrays else None,
+                samples={
+                    k[len("sample_") :]: arrays[k]
+                    for k in arrays.files
+                    if k.startswith("sample_")
+                },
+            )
+
+    def write_text(self, path: str):
+        """ write the nodes of each streamline in the format of ``-out_assignments`` """
+        np.savetxt(path, self.nodes, fmt="%d")
+
+    @classmethod
+    def read_text(cls, path: str, nnodes: ty.Optional[int] = None) -> "Assignments":
+        """ read the ``-out_assignments`` file of tck2connectome (without lengths)
+
+            The number of nodes defaults to the largest node assigned.
+        """
+        nodes = np.loadtxt(path, dtype=np.int32, ndmin=2)
+        if nodes.shape[1] != 2:
+            raise ValueError(
+                f"'{path}' assigns {nodes.shape[1]} nodes to each streamline rather "
+                "than 2"
+            )
+        return cls(
+            nodes=nodes, nnodes=int(nodes.max(initial=0)) if nnodes is None else nnodes
+        )
+
+    def connectome(
+        self,
+        weights: ty.Optional[np.ndarray] = None,
+        scale: ty.Optional[str] = None,
+        values: ty.Optional[ty.Union[str, np.ndarray]] = None,
+        stat: str = "sum",
+        symmetric: bool = False,
+        zero_diagonal: bool = False,
+        keep_unassigned: bool = False,
+    ) -> np.ndarray:
+        """ connectome matrix of the nodes, upper triangular unless ``symmetric``
+
+            The contribution of each streamline is the product of its weight
+            (e.g. from tcksift2, default 1), its length or inverse length if
+            ``scale`` is set, and a value per streamline (or the name of one of the
+            samples, e.g. the mean FA). ``stat`` combines the contributions to each
+            edge: the mean is weighted by the streamline weights, and the min and max
+            are taken over the contributions without them. Node 0 (the
+            unassigned endpoints) is dropped unless ``keep_unassigned``.
+        """
+        if stat not in EDGE_STATS:
+            raise ValueError(f"stat must be one of {EDGE_STATS}, not {stat!r}")
+        if scale not in SCALINGS:
+            raise ValueError(f"scale must be one of {SCALINGS}, not {scale!r}")
+        nstreamlines = len(self)
+        weights = (
+            np.ones(nstreamlines)
+            if weights is None
+            else np.asarray(weights, dtype=np.float64)
+        )
+        factor = np.ones(nstreamlines)
+        if scale is not None:
+            if self.lengths is None:
+                raise ValueError("the lengths of the streamlines are not known")
+            lengths = self.lengths.astype(np.float64)
+            if scale == "length":
+                factor *= lengths
+            else:
+                np.divide(1.0, lengths, out=factor, where=lengths > 0)
+        if values is not None:
+            factor *= np.asarray(
+                self.samples[values] if isinstance(values, str) else values,
+                dtype=np.float64,
+            )
+        for name, array in (("weights", weights), ("values", factor)):
+            if array.shape != (nstreamlines,):
+                raise ValueError(
+                    f"expected {nstreamlines} {name}, one per streamline, got "
+                    f"{array.shape[0]}"
+                )
+
+        size = self.nnodes + 1
+        row = self.nodes.min(axis=1).astype(np.int64)
+        col = self.nodes.max(axis=1).astype(np.int64)
+        keep = weights != 0
+        if not keep_unassigned:
+            keep &= row > 0
+        edges = row[keep] * size + col[keep]
+        weights, factor = weights[keep], factor[keep]
+        if stat in ("sum", "mean"):
+            matrix = np.bincount(edges, weights=weights * factor, minlength=size ** 2)
+            if stat == "mean":
+                total = np.bincount(edges, weights=weights, minlength=size ** 2)
+                np.divide(matrix, total, out=matrix, where=total != 0)
+        else:
+            fill = -np.inf if stat == "max" else np.inf
+            matrix = np.full(size ** 2, fill)
+            (np.maximum if stat == "max" else np.minimum).at(matrix, edges, factor)
+            matrix[np.isinf(matrix)] = 0.0
+        matrix = matrix.reshape(size, size)
+        if not keep_unassigned:
+            matrix = matrix[1:, 1:]
+        if symmetric:
+            matrix = matrix + np.triu(matrix, 1).T
+        if zero_diagonal:
+            np.fill_diagonal(matrix, 0.0)
+        return matrix
+
+
+def assign(
+    tracks: str,
+    nodes: str,
+    radius: float = DEFAULT_RADIUS,
+    sample: ty.Optional[ty.Dict[str, str]] = None,
+    batch_size: int = 100000,
+) -> Assignments:
+    """ assign the endpoints of the streamlines of a .tck file to the nodes of a
+        parcellation image, in one pass over the streamlines
+
+        Each endpoint goes to the node of the voxel it lies in, or failing that
+        (with ``radius`` > 0) to the node of the nearest labelled voxel within
+        ``radius`` mm, as in ``tck2connectome -assignment_radial_search`` (the
+        distances being measured between voxel centres). ``sample`` maps names
+        to images to be averaged along each streamline (nearest-neighbour).
+        Uncompressed .mif and NIfTI images are memory-mapped.
+    """
+    parcellation = VoxelLookup(nodes)
+    nnodes = int(np.max(parcellation.data, initial=0))
+    lookups = {name: VoxelLookup(path) for name, path in (sample or {}).items()}
+    offsets = _search_offsets(parcellation.header, radius) if radius > 0 else None
+    nodes_list, lengths_list = [], []
+    samples_list = {name: [] for name in lookups}
+    for batch in TckReader(tracks).iter_batches(batch_size):
+        points, bounds = concatenate(batch)
+        nonempty = np.diff(bounds) > 0
+        ends = np.zeros((len(batch), 2, 3))
+        ends[nonempty, 0] = points[bounds[:-1][nonempty]]
+        ends[nonempty, 1] = points[bounds[1:][nonempty] - 1]
+        voxels = parcellation.voxels(ends.reshape(-1, 3))
+        labels = parcellation.values(voxels).astype(np.int64)
+        if offsets is not None:
+            pending = np.flatnonzero(labels <= 0)
+            for offset in offsets:
+                if not pending.size:
+                    break
+                found = parcellation.values(voxels[pending] + offset)
+                hits = found > 0
+                labels[pending[hits]] = found[hits]
+                pending = pending[~hits]
+        labels[~np.repeat(nonempty, 2)] = 0
+        nodes_list.append(np.clip(labels, 0, None).astype(np.int32).reshape(-1, 2))
+        lengths_list.append(streamline_lengths(points, bounds).astype(np.float32))
+        for name, lookup in lookups.items():
+            values = lookup.values(lookup.voxels(points), fill=np.nan)
+            inside = ~np.isnan(values)
+            sums = segment_sums(np.where(inside, values, 0.0), bounds)
+            nvalues = segment_sums(inside, bounds)
+            means = np.zeros(len(batch))
+            np.divide(sums, nvalues, out=means, where=nvalues > 0)
+            samples_list[name].append(means.astype(np.float32))
+    return Assignments(
+        nodes=np.concatenate(nodes_list or [np.zeros((0, 2), dtype=np.int32)]),
+        nnodes=nnodes,
+        lengths=np.concatenate(lengths_list or [np.zeros(0, dtype=np.float32)]),
+        samples={
+            name: np.concatenate(arrays or [np.zeros(0, dtype=np.float32)])
+            for name, arrays in samples_list.items()
+        },
+    )
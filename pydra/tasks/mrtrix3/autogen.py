@@ -0,0 +1,427 @@
+"""
+Tasks for the whole MRtrix3 command suite, generated from the installed binaries.
+
+Every MRtrix3 command prints its interface with ``__print_full_usage__``. The
+generator runs it for each command of an installation and writes the parsed
+interfaces to a spec table (a gzipped text file with a line per command, of its
+class name and the JSON of its interface), by default
+``$XDG_CACHE_HOME/pydra-mrtrix3/specs.jsonl.gz`` or the path in
+``PYDRA_MRTRIX3_SPEC_TABLE``::
+
+    python -m pydra.tasks.mrtrix3.autogen [--output TABLE] [COMMAND ...]
+
+The task classes are only built when first accessed, as attributes of this
+module or of the package (where the hand-written tasks take precedence), e.g.
+``pydra.tasks.mrtrix3.DWI2Mask`` for dwi2mask. Only the lines of the table are
+held in memory until then, so the size of the suite adds nothing to the import
+time or memory of the workers that don't use it. The table records its format
+and the version of MRtrix3 it was generated from, and is ignored (with a
+warning) if it was written in another format.
+
+Example
+-------
+>>> from pydra.tasks.mrtrix3.autogen import class_name, command_spec, make_task
+>>> class_name("dwi2mask"), class_name("5ttgen"), class_name("tckgen")
+('DWI2Mask', 'FiveTTGen', 'TckGen')
+>>> usage = '''Generate a binary mask from DWI data
+... ARGUMENT input 0 0 IMAGEIN
+... the input DWI image containing volumes that are both diffusion weighted and b=0
+... ARGUMENT output 0 0 IMAGEOUT
+... the output whole-brain mask image
+... OPTION clean_scale 1 0
+... the maximum scale used to cut bridges.
+... ARGUMENT value 0 0 INT 0 9223372036854775807
+... OPTION nthreads 1 0
+... use this number of threads in multi-threaded applications
+... ARGUMENT number 0 0 INT 0 9223372036854775807
+... '''
+>>> DWI2Mask = make_task(command_spec("dwi2mask", usage))
+>>> task = DWI2Mask(input="test_dwi.nii.gz", output="mask.mif", clean_scale=0)
+>>> task.cmdline
+'dwi2mask test_dwi.nii.gz mask.mif -clean_scale 0'
+"""
+import argparse
+import gzip
+import json
+import keyword
+import os
+import re
+import shutil
+import subprocess as sp
+import typing as ty
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+import attr
+from pydra.engine.specs import Directory, File, SpecInfo
+from .base import MRTrix3BaseSpec, MRTrix3OutSpec, MRTrix3Task
+from .capabilities import STANDARD_OPTIONS, cache_root, parse_usage, probe
+
+
+#: bump when the format of the table changes
+TABLE_FORMAT = 1
+
+#: options of MRtrix3 commands covered by the fields of MRTrix3BaseSpec
+BASE_OPTIONS = STANDARD_OPTIONS | {"grad", "fslgrad"}
+
+#: fields of the input and output specs that generated fields can't shadow
+RESERVED_NAMES = {f.name for f in attr.fields(MRTrix3BaseSpec)} | {
+    f.name for f in attr.fields(MRTrix3OutSpec)
+}
+
+#: spelling of the common prefixes of command names in class names
+PREFIXES = {
+    "5tt": "FiveTT",
+    "connectome": "Connectome",
+    "dir": "Dir",
+    "dwi": "DWI",
+    "fixel": "Fixel",
+    "fod": "FOD",
+    "label": "Label",
+    "mask": "Mask",
+    "mr": "MR",
+    "peaks": "Peaks",
+    "sh": "SH",
+    "tck": "Tck",
+    "tensor": "Tensor",
+    "transform": "Transform",
+    "tsf": "TSF",
+    "vector": "Vector",
+    "warp": "Warp",
+}
+
+#: class names that don't follow from the prefixes, matching hand-written tasks
+CLASS_NAMES = {
+    "dwibiascorrect": "DWIBiasCorrect",
+    "dwifslpreproc": "DWIFslPreproc",
+    "fixelcfestats": "FixelCFEStats",
+    "mrdegibbs": "MRDeGibbs",
+}
+
+_LONGEST_FIRST = sorted(PREFIXES, key=len, reverse=True)
+
+INPUT_TYPES = {
+    "IMAGEIN": File,
+    "FILEIN": File,
+    "TRACKSIN": File,
+    "DIRIN": Directory,
+    "INT": int,
+    "FLOAT": float,
+    "ISEQ": ty.List[int],
+    "FSEQ": ty.List[float],
+}
+
+OUTPUT_TYPES = {"IMAGEOUT", "FILEOUT", "TRACKSOUT", "DIROUT"}
+
+#: commands whose outputs differ between runs, kept out of the result cache
+STOCHASTIC_COMMANDS = {"tckgen", "tckglobal"}
+
+_table = None
+_classes = {}
+
+
+def table_path() -> str:
+    return os.environ.get("PYDRA_MRTRIX3_SPEC_TABLE") or os.path.join(
+        cache_root(), "specs.jsonl.gz"
+    )
+
+
+def class_name(command: str) -> str:
+    """ name of the task class of a command, e.g. MRConvert for mrconvert """
+    if command in CLASS_NAMES:
+        return CLASS_NAMES[command]
+    if command.startswith("5tt"):
+        return PREFIXES["5tt"] + class_name(command[len("5tt") :])
+    name = []
+    for piece in re.split(r"(_|\d+)", command):
+        prefix = next((p for p in _LONGEST_FIRST if piece.startswith(p)), "")
+        if piece != "_":
+            name.append(PREFIXES.get(prefix, "") + piece[len(prefix) :].capitalize())
+    return "".join(name)
+
+
+def command_spec(command: str, usage: str) -> dict:
+    """ entry of the spec table for a command, from its ``__print_full_usage__`` """
+    parsed = parse_usage(usage)
+    description = [line for line in parsed["description"] if line.strip()]
+    return {
+        "command": command,
+        "class_name": class_name(command),
+        "synopsis": description[0] if description else "",
+        "description": description[1:],
+        "arguments": parsed["arguments"],
+        "options": [o for o in parsed["options"] if o["id"] not in BASE_OPTIONS],
+    }
+
+
+def _field_name(name: str, taken: ty.Set[str]) -> str:
+    while keyword.iskeyword(name) or name in RESERVED_NAMES or name in taken:
+        name += "_"
+    taken.add(name)
+    return name
+
+
+def _scalar_type(argument: dict) -> type:
+    if argument["type"] in OUTPUT_TYPES:
+        return str
+    return INPUT_TYPES.get(argument["type"], str)
+
+
+def _sequence_type(arguments: ty.List[dict]) -> type:
+    """ type of a list of the values of several arguments """
+    types = {a["type"] for a in arguments}
+    if types <= {"INT"}:
+        return ty.List[int]
+    if types <= {"INT", "FLOAT"}:
+        return ty.List[float]
+    if types <= {"IMAGEIN", "FILEIN", "TRACKSIN"}:
+        return ty.List[File]
+    return ty.List[str]
+
+
+def _help(text: str, arguments: ty.List[dict]) -> str:
+    if len(arguments) > 1:
+        text += " (" + ", ".join(f"{a['id']}: {a['type']}" for a in arguments) + ")"
+    return text or "(undocumented)"
+
+
+def _argument_field(argument: dict, name: str, position: int) -> tuple:
+    metadata = {
+        "help_string": _help(argument["help"], []),
+        "position": position,
+        "mandatory": not argument["optional"],
+    }
+    if argument["multiple"]:
+        tp = _sequence_type([argument])
+        metadata["argstr"] = ""
+    else:
+        tp = _scalar_type(argument)
+        if tp in (ty.List[int], ty.List[float]):
+            metadata.update(argstr="", sep=",")
+        else:
+            metadata["argstr"] = f"{{{name}}}"
+    if "choices" in argument and not argument["multiple"]:
+        metadata["allowed_values"] = argument["choices"]
+    return name, attr.ib(type=tp, metadata=metadata)
+
+
+def _option_field(option: dict, name: str) -> tuple:
+    arguments = option["arguments"]
+    flag = "-" + option["id"]
+    metadata = {"help_string": _help(option["help"], arguments)}
+    if not arguments:
+        tp = bool
+        metadata["argstr"] = flag
+    elif len(arguments) == 1 and not option["multiple"]:
+        tp = _scalar_type(arguments[0])
+        if tp in (ty.List[int], ty.List[float]):
+            metadata.update(argstr=flag, sep=",")
+        else:
+            # formatted, so that zeros aren't dropped from the command line
+            metadata["argstr"] = f"{flag} {{{name}}}"
+        if "choices" in arguments[0]:
+            metadata["allowed_values"] = arguments[0]["choices"]
+    elif len(arguments) == 1:
+        tp = _scalar_type(arguments[0])
+        tp = (
+            ty.List[tp]
+            if isinstance(tp, type) or tp in (File, Directory)
+            else ty.List[str]
+        )
+        metadata["argstr"] = f"{flag}..."
+    elif not option["multiple"]:
+        tp = _sequence_type(arguments)
+        metadata["argstr"] = flag
+    else:
+        # one string of space-separated values per use of the option
+        tp = ty.List[str]
+        metadata["argstr"] = f"{flag}..."
+    return name, attr.ib(type=tp, metadata=metadata)
+
+
+def _output_field(name: str, help_string: str) -> tuple:
+    return (
+        name,
+        attr.ib(
+            type=File,
+            metadata={
+                "help_string": help_string,
+                "output_file_template": f"{{{name}}}",
+            },
+        ),
+    )
+
+
+def make_task(spec: dict) -> ty.Type[MRTrix3Task]:
+    """ build the task class of an entry of the spec table """
+    cls_name = spec["class_name"]
+    taken = set()
+    input_fields, output_fields = [], []
+    for position, argument in enumerate(spec["arguments"], start=1):
+        name = _field_name(argument["id"], taken)
+        input_fields.append(_argument_field(argument, name, position))
+        if argument["type"] in OUTPUT_TYPES and not argument["multiple"]:
+            output_fields.append(_output_field(name, argument["help"]))
+    for option in spec["options"]:
+        name = _field_name(option["id"], taken)
+        input_fields.append(_option_field(option, name))
+        arguments = option["arguments"]
+        if (
+            len(arguments) == 1
+            and arguments[0]["type"] in OUTPUT_TYPES
+            and not option["multiple"]
+        ):
+            output_fields.append(_output_field(name, option["help"]))
+    namespace = {
+        "__doc__": "\n\n".join(
+            filter(None, [spec["synopsis"], "\n".join(spec["description"])])
+        ),
+        "__module__": __name__,
+        "input_spec": SpecInfo(
+            name=f"{cls_name}Inputs", fields=input_fields, bases=(MRTrix3BaseSpec,)
+        ),
+        "output_spec": SpecInfo(
+            name=f"{cls_name}Outputs", fields=output_fields, bases=(MRTrix3OutSpec,)
+        ),
+        "executable": spec["command"],
+        "compressed_outputs": tuple(name for name, _ in output_fields),
+        "cacheable": spec["command"] not in STOCHASTIC_COMMANDS,
+    }
+    return type(cls_name, (MRTrix3Task,), namespace)
+
+
+def _full_usage(path: str) -> ty.Optional[str]:
+    try:
+        proc = sp.run(
+            [path, "__print_full_usage__"],
+            stdout=sp.PIPE,
+            stderr=sp.DEVNULL,
+            timeout=60,
+        )
+    except (OSError, sp.SubprocessError):
+        return None
+    if proc.returncode:
+        return None
+    return proc.stdout.decode("utf-8", "replace")
+
+
+def mrtrix_commands() -> ty.List[str]:
+    """ paths of the executables installed alongside mrconvert """
+    mrconvert = shutil.which("mrconvert")
+    if mrconvert is None:
+        raise FileNotFoundError("mrconvert was not found on the PATH")
+    bin_dir = os.path.dirname(os.path.realpath(mrconvert))
+    return sorted(
+        os.path.join(bin_dir, f)
+        for f in os.listdir(bin_dir)
+        if os.access(os.path.join(bin_dir, f), os.X_OK)
+        and os.path.isfile(os.path.join(bin_dir, f))
+    )
+
+
+def generate(
+    commands: ty.Optional[ty.Sequence[str]] = None, workers: int = 8
+) -> ty.List[dict]:
+    """ spec table entries of the given commands (all installed ones by default),
+        skipping executables that don't print an MRtrix3 interface
+    """
+    if not commands:
+        commands = mrtrix_commands()
+    with ThreadPoolExecutor(workers) as pool:
+        usages = list(pool.map(_full_usage, commands))
+    specs = [
+        command_spec(os.path.basename(path), usage)
+        for path, usage in zip(commands, usages)
+        if usage
+    ]
+    return [spec for spec in specs if spec["arguments"] or spec["options"]]
+
+
+def write_table(specs: ty.List[dict], path: ty.Optional[str] = None) -> str:
+    """ write the spec table, replacing any previous one """
+    if path is None:
+        path = table_path()
+    capabilities = probe(specs[0]["command"]) if specs else None
+    header = {
+        "format": TABLE_FORMAT,
+        "mrtrix_version": capabilities.version if capabilities else "unknown",
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with gzip.open(tmp, "wt") as f:
+        f.write(json.dumps(header) + "\n")
+        for spec in specs:
+            entry = json.dumps(spec, separators=(",", ":"))
+            f.write(f"{spec['class_name']}\t{entry}\n")
+    os.replace(tmp, path)
+    return path
+
+
+def load_table(path: ty.Optional[str] = None) -> ty.Dict[str, str]:
+    """ unparsed lines of the spec table by class name (empty if there is none) """
+    if path is None:
+        path = table_path()
+    try:
+        with gzip.open(path, "rt") as f:
+            header = json.loads(f.readline())
+            lines = f.read().splitlines()
+    except (OSError, ValueError):
+        return {}
+    if header.get("format") != TABLE_FORMAT:
+        warnings.warn(
+            f"Ignoring {path}, written in format {header.get('format')} rather than "
+            f"{TABLE_FORMAT}: regenerate it with python -m {__name__}"
+        )
+        return {}
+    return dict(line.split("\t", 1) for line in lines if line)
+
+
+def _loaded_table() -> ty.Dict[str, str]:
+    global _table
+    if _table is None:
+        _table = load_table()
+    return _table
+
+
+def available() -> ty.List[str]:
+    """ names of the task classes in the spec table """
+    return sorted(_loaded_table())
+
+
+def task_class(name: str) -> ty.Type[MRTrix3Task]:
+    """ task class of the spec table, built on first access """
+    if name not in _classes:
+        line = _loaded_table().get(name)
+        if line is None:
+            raise AttributeError(
+                f"{name} is not in the MRtrix3 spec table {table_path()} "
+                f"(generate it with python -m {__name__})"
+            )
+        _classes[name] = make_task(json.loads(line))
+    return _classes[name]
+
+
+def __getattr__(name):
+    if not re.match(r"^[A-Z]\w*$", name):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return task_class(name)
+
+
+def main(argv: ty.Optional[ty.Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog=f"python -m {__name__}",
+        description="Generate the spec table of the installed MRtrix3 commands",
+    )
+    parser.add_argument(
+        "commands", nargs="*", help="commands to include (default: all installed)"
+    )
+    parser.add_argument("--output", "-o", help=f"path of the table ({table_path()})")
+    parser.add_argument("--workers", type=int, default=8, help="parallel probes")
+    args = parser.parse_args(argv)
+    commands = [shutil.which(c) or c for c in args.commands]
+    specs = generate(commands, workers=args.workers)
+    path = write_table(specs, args.output)
+    print(f"Wrote the specs of {len(specs)} commands to {path}")
+
+
+if __name__ == "__main__":
+    main()
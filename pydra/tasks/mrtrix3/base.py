@@ -1,12 +1,20 @@
+import os
 import attr
 import typing as ty
-from pydra.engine.specs import ShellSpec, File
+import subprocess as sp
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from pydra import ShellCommandTask
+from pydra.engine.helpers import make_klass
+from pydra.engine.specs import ShellSpec, ShellOutSpec, File, Directory
 
 
 @attr.s(auto_attribs=True, kw_only=True)
 class MRTrix3BaseSpec(ShellSpec):
     """ mrtrix3 command standard input specs
-            - includes: nthreads, grad_file, grad_fsl, force, quiet
+            - includes: nthreads, grad_file, grad_fsl, force, quiet, tmpfile_dir,
+              parallel_gzip, telemetry
     """
 
     # number of threads
@@ -51,3 +59,488 @@ class MRTrix3BaseSpec(ShellSpec):
             "argstr": "-quiet",
         }
     )
+
+    # location of temporary images
+    tmpfile_dir: str = attr.ib(
+        metadata={
+            "help_string": "directory of temporary and piped images, or 'auto' to "
+            "choose one with room for them (see pydra.tasks.mrtrix3.tmpfiles)",
+        }
+    )
+
+    # multi-threaded gzip
+    parallel_gzip: bool = attr.ib(
+        metadata={
+            "help_string": "decompress .gz inputs and compress .gz outputs outside of "
+            "the command, with nthreads threads (see pydra.tasks.mrtrix3.compression)",
+        }
+    )
+
+    # measurement of the resources used
+    telemetry: bool = attr.ib(
+        metadata={
+            "help_string": "record the time, memory and I/O used by the command to "
+            "telemetry.jsonl in the output directory, and set them as outputs (see "
+            "pydra.tasks.mrtrix3.telemetry)",
+        }
+    )
+
+
+def _telemetry_field(help_string: str):
+    return attr.ib(metadata={"help_string": help_string, "telemetry": True})
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class MRTrix3OutSpec(ShellOutSpec):
+    """ mrtrix3 command standard output specs
+            - includes: the resources used by the command, if telemetry is set
+              (None otherwise)
+    """
+
+    telemetry_file: File = _telemetry_field("records of the resources used")
+    wall_time: ty.Optional[float] = _telemetry_field("elapsed time, in s")
+    user_time: ty.Optional[float] = _telemetry_field("CPU time in user mode, in s")
+    sys_time: ty.Optional[float] = _telemetry_field("CPU time in kernel mode, in s")
+    max_rss: ty.Optional[int] = _telemetry_field("peak resident memory, in bytes")
+    max_threads: ty.Optional[int] = _telemetry_field("peak number of threads")
+    read_bytes: ty.Optional[int] = _telemetry_field("bytes read from storage")
+    write_bytes: ty.Optional[int] = _telemetry_field("bytes written to storage")
+    read_chars: ty.Optional[int] = _telemetry_field(
+        "bytes read, including from the page cache"
+    )
+    write_chars: ty.Optional[int] = _telemetry_field(
+        "bytes written, including to the page cache"
+    )
+    input_bytes: ty.Optional[int] = _telemetry_field("size of the input files")
+    output_bytes: ty.Optional[int] = _telemetry_field("size of the output files")
+
+    def _file_fields(self) -> ty.List[attr.Attribute]:
+        # the telemetry is set by MRTrix3Task, leaving the output files
+        return [
+            f
+            for f in attr.fields(type(self))
+            if f.name not in ("return_code", "stdout", "stderr")
+            and "telemetry" not in f.metadata
+        ]
+
+    def _collect_file(self, fld: attr.Attribute, inputs, output_dir):
+        if "callable" in fld.metadata:
+            # of any type, e.g. a list of files
+            return self._field_metadata(fld, inputs, output_dir)
+        if fld.type is not File:
+            raise Exception("not implemented (collect_additional_output)")
+        if fld.default is not attr.NOTHING:
+            return self._field_defaultvalue(fld, output_dir)
+        if fld.metadata:
+            return self._field_metadata(fld, inputs, output_dir)
+        raise AttributeError("File has to have default value or metadata")
+
+    def collect_additional_outputs(self, inputs, output_dir):
+        return {
+            fld.name: self._collect_file(fld, inputs, output_dir)
+            for fld in self._file_fields()
+        }
+
+    def generated_output_names(self, inputs, output_dir):
+        from .telemetry import enabled
+
+        inputs.check_fields_input_spec()
+        names = ["return_code", "stdout", "stderr"]
+        for fld in attr.fields(type(self)):
+            if "telemetry" in fld.metadata:
+                if enabled(getattr(inputs, "telemetry", attr.NOTHING)):
+                    names.append(fld.name)
+            elif fld.name in names:
+                continue
+            elif fld.default is not attr.NOTHING:
+                names.append(fld.name)
+            elif self._collect_file(fld, inputs, output_dir) is not attr.NOTHING:
+                names.append(fld.name)
+        return names
+
+
+def in_file_field(position: int = 1, help_string: str = "input image") -> tuple:
+    """ (name, attribute) of the positional in_file input of a spec """
+    return (
+        "in_file",
+        attr.ib(
+            type=File,
+            metadata={
+                "argstr": "{in_file}",
+                "position": position,
+                "help_string": help_string,
+                "mandatory": True,
+            },
+        ),
+    )
+
+
+def out_file_field(help_string: str = "output image") -> tuple:
+    """ (name, attribute) of the out_file input of a spec, the last argument """
+    return (
+        "out_file",
+        attr.ib(
+            type=str,
+            metadata={
+                "argstr": "{out_file}",
+                "position": -1,
+                "help_string": help_string,
+                "mandatory": True,
+            },
+        ),
+    )
+
+
+def output_field(name: str, help_string: str) -> tuple:
+    """ (name, attribute) of an output file named by the input of the same name """
+    return (
+        name,
+        attr.ib(
+            type=File,
+            metadata={
+                "help_string": help_string,
+                "output_file_template": f"{{{name}}}",
+            },
+        ),
+    )
+
+
+class MRTrix3Task(ShellCommandTask):
+    """ base class of tasks wrapping MRtrix3 commands
+
+        Adds the behaviour shared by all MRtrix3 commands on top of
+        :class:`~pydra.engine.task.ShellCommandTask`:
+            - measurement of the resources used, if telemetry is set
+              (see :mod:`pydra.tasks.mrtrix3.telemetry`)
+            - reuse of results from the shared result cache
+              (see :mod:`pydra.tasks.mrtrix3.cache`)
+            - allocation of ``nthreads`` from a node-wide budget when it isn't set
+              (see :mod:`pydra.tasks.mrtrix3.threads`)
+            - placement of temporary images in a private directory that is
+              cleaned up afterwards (see :mod:`pydra.tasks.mrtrix3.tmpfiles`)
+            - multi-threaded decompression of inputs and compression of outputs
+              (see :mod:`pydra.tasks.mrtrix3.compression`)
+            - checking of the options used against the installed executable
+              before it is launched (see :mod:`pydra.tasks.mrtrix3.capabilities`)
+    """
+
+    #: inputs naming output files, which are compressed by the task (instead of
+    #: the command) if they end in .gz and parallel_gzip is set
+    compressed_outputs = ("out_file",)
+
+    #: variables added to the environment of the commands run by the task (the
+    #: environment of the process being shared by tasks run in threads)
+    _environment = {}
+
+    #: measurement of the commands run by the task, while telemetry is recorded
+    _recorder = None
+
+    #: whether results may be reused from the result cache, unset for commands
+    #: whose outputs differ between runs of the same inputs (e.g. tckgen)
+    cacheable = True
+
+    #: inputs that aren't on the command line and don't change its outputs, left
+    #: out of the key of the result cache
+    cache_ignored_inputs = (
+        "executable",
+        "args",
+        "tmpfile_dir",
+        "parallel_gzip",
+        "telemetry",
+    )
+
+    def _run_task(self):
+        from .telemetry import TELEMETRY_FILE, Recorder, enabled, write_record
+
+        if not enabled(getattr(self.inputs, "telemetry", attr.NOTHING)):
+            return self._run_cached()
+        output_dir = Path(self.output_dir)
+        recorder = self._recorder = Recorder()
+        try:
+            with recorder:
+                self._run_cached()
+        finally:
+            del self._recorder
+            record = self._telemetry_record(recorder, output_dir)
+            write_record(record, str(output_dir / TELEMETRY_FILE))
+        outputs = {f.name for f in attr.fields(make_klass(self.output_spec))}
+        record["telemetry_file"] = str(output_dir / TELEMETRY_FILE)
+        self.output_.update({k: v for k, v in record.items() if k in outputs})
+
+    def _telemetry_record(self, recorder, output_dir: Path) -> dict:
+        """ record of the run of the command, for the telemetry """
+        nthreads = getattr(self.inputs, "nthreads", None)
+        output = getattr(self, "output_", None) or {}
+        return {
+            "task": type(self).__name__,
+            "name": self.name,
+            "command": [str(a) for a in self.command_args if a not in ["", " "]],
+            "start": recorder.start,
+            "return_code": output.get("return_code"),
+            "nthreads": None if nthreads is attr.NOTHING else nthreads,
+            **recorder.metrics(),
+            "input_bytes": sum(os.path.getsize(p) for p in self._input_files()),
+            "output_bytes": sum(
+                os.path.getsize(output_dir / f)
+                for f in _list_files(output_dir)
+                if not f.startswith("_") and os.path.isfile(output_dir / f)
+            ),
+        }
+
+    def _run_cached(self):
+        """ run the command, or reuse its result from the cache if enabled """
+        from .cache import ResultCache
+
+        cache = ResultCache.from_env()
+        if cache is None or not self.cacheable:
+            return self._execute()
+        args = [str(el) for el in self.command_args if el not in ["", " "]]
+        output_dir = Path(self.output_dir)
+        key = cache.key(
+            args,
+            output_dir,
+            input_files=self._input_files() + self._input_directories(),
+            output_files=self._output_files(),
+            extra=self._unlisted_inputs(),
+            env=self._command_environment(),
+        )
+        self.output_ = cache.fetch(key, output_dir)
+        if self.output_ is not None:
+            return
+        existing = set(_list_files(output_dir))
+        self._execute()
+        produced = [f for f in _list_files(output_dir) if f not in existing]
+        cache.store(key, self.output_, output_dir, produced)
+
+    def _execute(self):
+        """ run the command, with its temporary images in a managed directory """
+        from .tmpfiles import (
+            AUTO,
+            choose_tmpfile_dir,
+            private_tmpfile_dir,
+            tmpfile_environment,
+        )
+
+        base = self._tmpfile_setting()
+        if base is None:
+            return self._run_with_budget()
+        if base == AUTO:
+            base = choose_tmpfile_dir(self._estimate_tmpfile_bytes())
+        with private_tmpfile_dir(base) as tmpfile_dir:
+            with self._set_environment(tmpfile_environment(tmpfile_dir)):
+                return self._run_with_budget()
+
+    @contextmanager
+    def _set_environment(self, variables: ty.Mapping[str, str]) -> ty.Iterator[None]:
+        """ add variables to the environment of the commands run within the context """
+        previous = self._environment
+        self._environment = {**previous, **variables}
+        try:
+            yield
+        finally:
+            self._environment = previous
+
+    def _command_environment(self) -> ty.Dict[str, str]:
+        """ environment of the commands run by the task """
+        return {**os.environ, **self._environment}
+
+    def _tmpfile_setting(self) -> ty.Optional[str]:
+        """ directory (or 'auto') for temporary images, None to leave it unset """
+        setting = getattr(self.inputs, "tmpfile_dir", attr.NOTHING)
+        if setting in (None, attr.NOTHING):
+            setting = os.environ.get("PYDRA_MRTRIX3_TMPFILE_DIR")
+        return setting or None
+
+    def _estimate_tmpfile_bytes(self) -> int:
+        """ estimated size of the temporary images: one the size of the inputs """
+        from .tmpfiles import estimate_bytes
+
+        return estimate_bytes(self._input_files())
+
+    def _input_files(self) -> ty.List[str]:
+        """ paths of the existing files given as inputs """
+        paths = []
+        for field in attr.fields(type(self.inputs)):
+            if field.type not in (File, ty.List[File]):
+                continue
+            value = getattr(self.inputs, field.name)
+            values = value if isinstance(value, (list, tuple)) else [value]
+            paths.extend(str(v) for v in values if isinstance(v, (str, os.PathLike)))
+        return [p for p in paths if os.path.isfile(p)]
+
+    def _input_directories(self) -> ty.List[str]:
+        """ paths of the existing directories given as inputs (e.g. fixel
+            directories)
+        """
+        paths = []
+        for field in attr.fields(type(self.inputs)):
+            if field.type not in (Directory, ty.List[Directory]):
+                continue
+            value = getattr(self.inputs, field.name)
+            values = value if isinstance(value, (list, tuple)) else [value]
+            paths.extend(str(v) for v in values if isinstance(v, (str, os.PathLike)))
+        return [p for p in paths if os.path.isdir(p)]
+
+    def _output_files(self) -> ty.List[str]:
+        """ paths of the output files named by inputs: those that the templates of
+            the output specification refer to, those with templates of their own
+            and the compressed outputs
+        """
+        names = set(self.compressed_outputs)
+        for field in attr.fields(make_klass(self.output_spec)):
+            template = field.metadata.get("output_file_template", "")
+            if template.startswith("{") and template.endswith("}"):
+                names.add(template[1:-1])
+        for field in attr.fields(type(self.inputs)):
+            if "output_file_template" in field.metadata:
+                names.add(field.name)
+        paths = []
+        for name in sorted(names):
+            value = getattr(self.inputs, name, None)
+            values = value if isinstance(value, (list, tuple)) else [value]
+            paths.extend(str(v) for v in values if isinstance(v, (str, os.PathLike)))
+        return paths
+
+    def _unlisted_inputs(self) -> ty.Dict[str, ty.Any]:
+        """ values of the inputs that aren't passed on the command line but may
+            change its outputs
+        """
+        return {
+            field.name: getattr(self.inputs, field.name)
+            for field in attr.fields(type(self.inputs))
+            if "argstr" not in field.metadata
+            and field.name not in self.cache_ignored_inputs
+            and getattr(self.inputs, field.name) not in (None, attr.NOTHING)
+        }
+
+    def _gzipped_files(self) -> ty.Tuple[ty.Dict[str, str], ty.Dict[str, str]]:
+        """ gzipped input files and outputs of the command, by input name """
+        from .compression import is_compressed
+
+        inputs, outputs = {}, {}
+        for field in attr.fields(type(self.inputs)):
+            value = getattr(self.inputs, field.name)
+            if not isinstance(value, (str, os.PathLike)) or not is_compressed(value):
+                continue
+            if field.type is File and os.path.isfile(value):
+                inputs[field.name] = str(value)
+            elif field.name in self.compressed_outputs:
+                outputs[field.name] = str(value)
+        return inputs, outputs
+
+    def _run_with_budget(self):
+        """ run the command, drawing its threads from the node's budget if enabled """
+        from .threads import ThreadBudget
+
+        budget = ThreadBudget.from_env()
+        if budget is None or not hasattr(self.inputs, "nthreads"):
+            return self._run_gzip_staged()
+        if self.inputs.nthreads not in (None, attr.NOTHING):
+            return self._run_gzip_staged()
+        with budget.allocate() as nthreads:
+            # shared between the commands the task runs at once
+            nthreads = max(nthreads // self._concurrent_commands(), 1)
+            self.inputs = attr.evolve(self.inputs, nthreads=nthreads)
+            self._run_gzip_staged()
+
+    def _concurrent_commands(self) -> int:
+        """ number of commands the task runs at once, each with nthreads threads """
+        return 1
+
+    def _run_gzip_staged(self):
+        """ run the command on uncompressed copies of its gzipped inputs and
+            outputs, if parallel_gzip is set
+        """
+        from .compression import compress, stage_inputs, uncompressed_name
+        from .threads import available_cores
+        from .tmpfiles import choose_tmpfile_dir, estimate_bytes, private_tmpfile_dir
+
+        if getattr(self.inputs, "parallel_gzip", attr.NOTHING) is not True:
+            return self._run_command()
+        inputs, outputs = self._gzipped_files()
+        if not inputs and not outputs:
+            return self._run_command()
+        threads = getattr(self.inputs, "nthreads", attr.NOTHING)
+        if threads in (None, attr.NOTHING):
+            threads = available_cores()
+        # room for the uncompressed inputs and outputs of a similar size
+        nbytes = estimate_bytes(inputs.values(), copies=2)
+        original = self.inputs
+        with private_tmpfile_dir(choose_tmpfile_dir(nbytes)) as staging_dir:
+            staged = stage_inputs(inputs, staging_dir, threads)
+            for name, path in outputs.items():
+                staged[name] = os.path.join(staging_dir, uncompressed_name(path))
+            self.inputs = attr.evolve(original, **staged)
+            try:
+                self._run_command()
+            finally:
+                self.inputs = original
+            for name, path in outputs.items():
+                compress(staged[name], path, threads)
+
+    def _run_command(self):
+        self._check_capabilities([self.command_args])
+        args = [str(el) for el in self.command_args if el not in ["", " "]]
+        return_code, stdout, stderr = self._run_process(args)
+        self.output_ = {
+            "return_code": return_code,
+            "stdout": stdout.strip() if self.strip else stdout,
+            "stderr": stderr,
+        }
+        if return_code:
+            raise RuntimeError(stderr or stdout)
+
+    def _popen(self, args: ty.Sequence[str], env=None, **kwargs) -> sp.Popen:
+        """ start a command of the task, in its environment (unless another is
+            given), to be waited for with _wait
+        """
+        if env is None:
+            env = self._command_environment()
+        proc = sp.Popen(args, env=env, **kwargs)
+        if self._recorder is not None:
+            self._recorder.track(proc)
+        return proc
+
+    def _wait(self, proc: sp.Popen) -> int:
+        """ wait for a command started with _popen, returning its return code """
+        if self._recorder is None:
+            return proc.wait()
+        return self._recorder.wait(proc)
+
+    def _run_process(self, args: ty.Sequence[str], env=None) -> ty.Tuple[int, str, str]:
+        """ run a command of the task, returning its return code and output """
+        with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+            proc = self._popen(args, env=env, stdout=stdout, stderr=stderr)
+            try:
+                return_code = self._wait(proc)
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+            stdout.seek(0)
+            stderr.seek(0)
+            return (
+                return_code,
+                stdout.read().decode("utf-8", "replace"),
+                stderr.read().decode("utf-8", "replace"),
+            )
+
+    def _check_capabilities(self, commands: ty.Iterable[ty.Sequence[str]]):
+        """ check the commands against the interfaces of the installed executables
+            (see :mod:`pydra.tasks.mrtrix3.capabilities`)
+        """
+        from .capabilities import check_command, enabled
+
+        if not enabled():
+            return
+        for args in commands:
+            check_command([str(a) for a in args if a not in ["", " "]])
+
+
+def _list_files(directory: Path) -> ty.List[str]:
+    """ paths of all files under a directory, relative to it """
+    return [
+        os.path.relpath(os.path.join(root, fname), directory)
+        for root, _, fnames in os.walk(directory)
+        for fname in fnames
+    ]
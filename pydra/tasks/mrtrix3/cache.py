@@ -0,0 +1,333 @@
+"""
+Content-addressed cache of MRtrix3 command results shared between task instances.
+
+Pydra's own checksums cover the input specification of a task, so identical
+conversions run from different workflows (or with different file paths) are all
+recomputed. This cache instead keys each invocation on the content of its input
+files (and of the files under its input directories), the command line with
+those files and irrelevant options (e.g. -nthreads) normalised away, the inputs
+of the task that aren't passed on the command line, the environment variables
+that change the results of MRtrix3 commands (e.g. ``MRTRIX_RNG_SEED``) and the
+version of the MRtrix3 executable. The input and output files among the
+arguments are those named by the input specification of the task. Outputs are
+copied in and out of the cache (as reflinks where the file system supports
+them), so that the outputs of tasks never share their storage with the cache,
+and the least recently used entries are evicted once the total size exceeds a
+byte budget.
+
+The cache is enabled for all tasks derived from
+:class:`~pydra.tasks.mrtrix3.base.MRTrix3Task` by setting the
+``PYDRA_MRTRIX3_CACHE_DIR`` environment variable, with the budget taken from
+``PYDRA_MRTRIX3_CACHE_SIZE`` (bytes, optionally suffixed with K, M, G or T).
+
+Example
+-------
+>>> import os
+>>> from pydra.tasks.mrtrix3.cache import ResultCache
+>>> cache = ResultCache("result_cache", max_bytes=1024)
+>>> with open("input.txt", "w") as f:
+...     _ = f.write("input data")
+>>> os.makedirs("run1")
+>>> out1 = os.path.abspath("run1/out.mif")
+>>> key = cache.key(["mrconvert", "input.txt", "-nthreads", "4", out1], "run1",
+...                 version="3.0.2", input_files=["input.txt"], output_files=[out1])
+>>> cache.fetch(key, "run1") is None
+True
+>>> with open(out1, "w") as f:
+...     _ = f.write("output data")
+>>> cache.store(key, {"return_code": 0, "stdout": "", "stderr": ""}, "run1",
+...             ["out.mif"])
+>>> os.makedirs("run2")
+>>> out2 = os.path.abspath("run2/out.mif")
+>>> key == cache.key(["mrconvert", "input.txt", out2], "run2", version="3.0.2",
+...                  input_files=["input.txt"], output_files=[out2])
+True
+>>> cache.fetch(key, "run2")["return_code"]
+0
+>>> open("run2/out.mif").read()
+'output data'
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+import typing as ty
+from pathlib import Path
+from filelock import SoftFileLock
+
+
+#: options that do not change the outputs of MRtrix3 commands
+IGNORED_OPTIONS = {"-nthreads": 1, "-force": 0, "-quiet": 0, "-info": 0, "-debug": 0}
+
+#: environment variables that change the outputs of MRtrix3 commands
+ENVIRONMENT = ("MRTRIX_RNG_SEED", "MRTRIX_CONFIGFILE")
+
+#: size of the blocks in which input files are read when hashing their content
+HASH_BLOCK_SIZE = 8 * 1024 ** 2
+
+_SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(size: str) -> int:
+    """ convert a size such as '500M' or '20G' to a number of bytes """
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in _SIZE_SUFFIXES:
+        return int(float(size[:-1]) * _SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def mrtrix_version(executable: str) -> str:
+    """ version string reported by an MRtrix3 executable ('unknown' if it can't run) """
+    from .capabilities import probe
+
+    capabilities = probe(executable)
+    return capabilities.version if capabilities is not None else "unknown"
+
+
+def file_digest(path: str, memo_dir: ty.Optional[str] = None) -> str:
+    """ SHA-256 digest of the content of a file, read in blocks
+
+        If ``memo_dir`` is given, digests are remembered there against the path,
+        size, inode and modification time of the file, so unchanged files are
+        only read once.
+    """
+    stat = os.stat(path)
+    signature = f"{stat.st_size} {stat.st_ino} {stat.st_mtime_ns}"
+    memo = None
+    if memo_dir is not None:
+        name = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+        memo = Path(memo_dir) / name
+        try:
+            memo_signature, digest = memo.read_text().rsplit(" ", 1)
+            if memo_signature == signature:
+                return digest
+        except (OSError, ValueError):
+            pass
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha.update(block)
+    digest = sha.hexdigest()
+    if memo is not None:
+        memo.parent.mkdir(parents=True, exist_ok=True)
+        tmp = memo.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(f"{signature} {digest}")
+        os.replace(tmp, memo)
+    return digest
+
+
+def directory_digest(path: str, memo_dir: ty.Optional[str] = None) -> str:
+    """ SHA-256 digest of the names and contents of the files under a directory
+        (e.g. a fixel directory), with those of the files memoised as by
+        :func:`file_digest`
+    """
+    sha = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        # visited in a stable order
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            relpath = os.path.relpath(file_path, path)
+            sha.update(f"{relpath} {file_digest(file_path, memo_dir)}\n".encode())
+    return sha.hexdigest()
+
+
+def clone_or_copy(src: str, dst: str):
+    """ copy a file as a reflink (sharing its blocks until either is modified),
+        falling back to a plain copy
+    """
+    try:
+        import fcntl
+
+        FICLONE = 0x40049409
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+    except (ImportError, OSError):
+        shutil.copy2(src, dst)
+
+
+class ResultCache:
+    """ on-disk cache of MRtrix3 command results, with LRU eviction by size
+
+        Each entry is a directory named after the cache key, holding the output
+        files (relative to the task's output directory) and a manifest with the
+        captured return code, stdout and stderr. Entries are marked as used by
+        touching their manifest.
+    """
+
+    def __init__(self, root: str, max_bytes: ty.Optional[int] = None):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.entries = self.root / "entries"
+        self.entries.mkdir(parents=True, exist_ok=True)
+        self.lock = SoftFileLock(str(self.root / "cache.lock"))
+
+    @classmethod
+    def from_env(cls) -> ty.Optional["ResultCache"]:
+        """ cache configured through the environment, or None if it is disabled """
+        root = os.environ.get("PYDRA_MRTRIX3_CACHE_DIR")
+        if not root:
+            return None
+        size = os.environ.get("PYDRA_MRTRIX3_CACHE_SIZE")
+        return cls(root, max_bytes=parse_size(size) if size else None)
+
+    def normalise(
+        self,
+        args: ty.Sequence[str],
+        output_dir: str,
+        input_files: ty.Iterable[str] = (),
+        output_files: ty.Iterable[str] = (),
+    ) -> ty.List[str]:
+        """ replace the input files (and directories) among the arguments by the
+            digest of their content and the output files by their path relative to
+            the output directory, and drop ignored options
+
+            Relative paths of output files are taken to be within ``output_dir``,
+            where the command runs.
+        """
+        output_dir = os.path.abspath(output_dir)
+        input_files = {str(path) for path in input_files}
+        output_files = {str(path) for path in output_files}
+        normalised = []
+        skip = 0
+        for arg in args:
+            if skip:
+                skip -= 1
+                continue
+            if arg in IGNORED_OPTIONS:
+                skip = IGNORED_OPTIONS[arg]
+                continue
+            if arg in output_files:
+                path = os.path.join(output_dir, arg)
+                normalised.append("output:" + os.path.relpath(path, output_dir))
+            elif arg in input_files:
+                normalised.append(self._digest(arg))
+            else:
+                normalised.append(arg)
+        return normalised
+
+    def _digest(self, path: str) -> str:
+        if os.path.isdir(path):
+            return "sha256-dir:" + directory_digest(path, self.root / "digests")
+        return "sha256:" + file_digest(path, self.root / "digests")
+
+    def key(
+        self,
+        args: ty.Sequence[str],
+        output_dir: str,
+        version: ty.Optional[str] = None,
+        input_files: ty.Iterable[str] = (),
+        output_files: ty.Iterable[str] = (),
+        extra: ty.Optional[ty.Mapping[str, ty.Any]] = None,
+        env: ty.Optional[ty.Mapping[str, str]] = None,
+    ) -> str:
+        """ cache key of a command line run in ``output_dir``
+
+            ``extra`` holds the settings of the command that aren't among its
+            arguments (e.g. inputs of the task used otherwise), with the input files
+            among their values also replaced by their digest, and the variables of
+            ``env`` (by default the environment of this process) listed in
+            :data:`ENVIRONMENT` are included as well.
+        """
+        if version is None:
+            version = mrtrix_version(args[0])
+        input_files = [str(path) for path in input_files]
+        normalised = self.normalise(args, output_dir, input_files, output_files)
+        digested = set(input_files)
+
+        def settle(value):
+            if isinstance(value, (list, tuple)):
+                return [settle(v) for v in value]
+            if isinstance(value, (str, os.PathLike)) and str(value) in digested:
+                return self._digest(str(value))
+            return value
+
+        extra = {name: settle(value) for name, value in (extra or {}).items()}
+        env = os.environ if env is None else env
+        environment = {name: env[name] for name in ENVIRONMENT if name in env}
+        key = [version, normalised, extra, environment]
+        return hashlib.sha256(
+            json.dumps(key, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def fetch(self, key: str, output_dir: str) -> ty.Optional[dict]:
+        """ copy the outputs of a cached result into ``output_dir`` and return the
+            captured return code, stdout and stderr (None on a cache miss)
+        """
+        entry = self.entries / key
+        try:
+            manifest = json.loads((entry / "manifest.json").read_text())
+        except (OSError, ValueError):
+            return None
+        for fname in manifest["files"]:
+            dst = Path(output_dir) / fname
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            if dst.exists():
+                dst.unlink()
+            try:
+                clone_or_copy(str(entry / "files" / fname), str(dst))
+            except FileNotFoundError:
+                # evicted concurrently
+                return None
+        os.utime(entry / "manifest.json")
+        return manifest["result"]
+
+    def store(self, key: str, result: dict, output_dir: str, files: ty.Iterable[str]):
+        """ add the given output files (relative to ``output_dir``) to the cache """
+        entry = self.entries / key
+        if entry.exists():
+            return
+        tmp = self.entries / f".{key}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        files = sorted(files)
+        nbytes = 0
+        for fname in files:
+            dst = tmp / "files" / fname
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            clone_or_copy(str(Path(output_dir) / fname), str(dst))
+            nbytes += dst.stat().st_size
+        manifest = {"result": result, "files": files, "size": nbytes}
+        (tmp / "manifest.json").write_text(json.dumps(manifest))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # stored concurrently by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._list_entries())
+
+    def _list_entries(self) -> ty.List[ty.Tuple[float, int, Path]]:
+        listed = []
+        for entry in self.entries.iterdir():
+            if entry.name.startswith("."):
+                continue
+            try:
+                manifest = entry / "manifest.json"
+                size = json.loads(manifest.read_text())["size"]
+                listed.append((manifest.stat().st_mtime, size, entry))
+            except (OSError, ValueError, KeyError):
+                continue
+        return listed
+
+    def evict(self):
+        """ remove the least recently used entries until within the byte budget """
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            listed = sorted(self._list_entries())
+            total = sum(size for _, size, _ in listed)
+            for _, size, entry in listed:
+                if total <= self.max_bytes:
+                    break
+                # rename first so that concurrent fetches see a clean miss
+                doomed = entry.with_name(f".{entry.name}.{time.time_ns()}.evicted")
+                try:
+                    os.rename(entry, doomed)
+                except OSError:
+                    continue
+                shutil.rmtree(doomed, ignore_errors=True)
+                total -= size
@@ -0,0 +1,253 @@
+"""
+Registry of the capabilities of the MRtrix3 executables on the system.
+
+The version and the arguments and options accepted by an MRtrix3 command are
+probed by running it with ``-version`` and ``__print_usage__`` (which prints its
+interface in a machine-readable form). The results are cached on disk against
+the resolved path, size and modification time of the executable, under
+``PYDRA_MRTRIX3_CAPABILITY_DIR`` (by default ``$XDG_CACHE_HOME/pydra-mrtrix3``),
+so each installation is only probed once. Tasks derived from
+:class:`~pydra.tasks.mrtrix3.base.MRTrix3Task` check the options of their
+command line against it before launching the command, so that an option
+missing from the installed version fails the task up front (unless
+``PYDRA_MRTRIX3_CHECK_CAPABILITIES`` is set to 0).
+
+Example
+-------
+>>> from pydra.tasks.mrtrix3.capabilities import Capabilities
+>>> usage = '''mrconvert
+... Perform conversion between different file types
+... ARGUMENT input 0 0 IMAGEIN
+... the input image.
+... ARGUMENT output 0 0 IMAGEOUT
+... the output image.
+... OPTION json_export 1 0
+... export data from an image header key-value pairs into a JSON file
+... ARGUMENT file 0 0 FILEOUT
+... the output JSON file.
+... OPTION datatype 1 0
+... specify output image data type.
+... ARGUMENT spec 0 0 CHOICE float32 float32le int16 uint8
+... '''
+>>> caps = Capabilities.from_usage("mrconvert", "mrconvert 3.0.2", usage)
+>>> [arg["type"] for arg in caps.arguments]
+['IMAGEIN', 'IMAGEOUT']
+>>> caps.supports("json_export"), caps.supports("export_grad_mrtrix")
+(True, False)
+>>> caps.datatypes
+['float32', 'float32le', 'int16', 'uint8']
+>>> caps.check_args(["mrconvert", "in.mif", "-export_grad_mrtrix", "x.b", "out.mif"])
+Traceback (most recent call last):
+...
+ValueError: mrconvert (mrconvert 3.0.2) does not support -export_grad_mrtrix
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess as sp
+import typing as ty
+import attr
+
+
+#: options accepted by every MRtrix3 command (whether or not they are listed)
+STANDARD_OPTIONS = {
+    "info",
+    "quiet",
+    "debug",
+    "force",
+    "nthreads",
+    "config",
+    "help",
+    "version",
+}
+
+#: bump when the format of the cached entries changes
+REGISTRY_VERSION = 2
+
+_OPTION_TOKEN = re.compile(r"^-([A-Za-z_]\w*)$")
+
+_probed = {}
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class Capabilities:
+    """ version and interface of an MRtrix3 executable
+
+    - arguments are the positional arguments, as dicts of id, optional,
+      multiple, type and (for choices) choices
+    - options map the option ids (without dash) to their arguments
+    - usage is False if the interface couldn't be probed, in which case the
+      options aren't checked
+    """
+
+    executable: str
+    version: str = "unknown"
+    arguments: ty.List[dict] = attr.ib(factory=list)
+    options: ty.Dict[str, ty.List[dict]] = attr.ib(factory=dict)
+    usage: bool = False
+
+    @classmethod
+    def from_usage(cls, executable: str, version: str, usage: str) -> "Capabilities":
+        """ parse the output of ``<command> __print_usage__`` """
+        parsed = parse_usage(usage)
+        return cls(
+            executable=executable,
+            version=version,
+            arguments=parsed["arguments"],
+            options={o["id"]: o["arguments"] for o in parsed["options"]},
+            usage=bool(parsed["arguments"] or parsed["options"]),
+        )
+
+    @property
+    def datatypes(self) -> ty.List[str]:
+        """ output datatypes accepted by the -datatype option, if it has one """
+        for argument in self.options.get("datatype", []):
+            return argument.get("choices", [])
+        return []
+
+    def supports(self, option: str) -> bool:
+        return not self.usage or option in self.options or option in STANDARD_OPTIONS
+
+    def check_args(self, args: ty.Sequence[str]):
+        """ raise a ValueError if the command line uses an unsupported option """
+        unsupported = [
+            arg
+            for arg in args[1:]
+            if _OPTION_TOKEN.match(str(arg))
+            and not self.supports(_OPTION_TOKEN.match(str(arg)).group(1))
+        ]
+        if unsupported:
+            raise ValueError(
+                f"{os.path.basename(self.executable)} ({self.version}) does not "
+                f"support {', '.join(unsupported)}"
+            )
+
+
+def parse_usage(usage: str) -> dict:
+    """ parse the interface printed by ``__print_usage__`` or ``__print_full_usage__``
+
+        Returns the lines of text preceding the first argument (the synopsis and
+        description), the positional arguments and the options. Each argument is a
+        dict of id, optional, multiple, type, help and (for choices) choices, and
+        each option a dict of id, optional, multiple, help and arguments.
+    """
+    description, arguments, options = [], [], []
+    current, described = arguments, description
+    for line in usage.splitlines():
+        words = line.split()
+        flags = words[2:4] if len(words) >= 4 else []
+        if any(f not in ("0", "1") for f in flags):
+            flags = []
+        if len(words) == 4 and words[0] == "OPTION" and flags:
+            option = {
+                "id": words[1],
+                "optional": flags[0] == "1",
+                "multiple": flags[1] == "1",
+                "help": "",
+                "arguments": [],
+            }
+            options.append(option)
+            current, described = option["arguments"], option
+        elif len(words) >= 5 and words[0] == "ARGUMENT" and flags:
+            argument = {
+                "id": words[1],
+                "optional": flags[0] == "1",
+                "multiple": flags[1] == "1",
+                "type": words[4],
+                "help": "",
+            }
+            if words[4] == "CHOICE":
+                argument["choices"] = words[5:]
+            current.append(argument)
+            described = argument
+        elif isinstance(described, list):
+            described.append(line)
+        elif line.strip():
+            described["help"] = " ".join(filter(None, [described["help"], line]))
+    return {"description": description, "arguments": arguments, "options": options}
+
+
+def cache_root() -> str:
+    """ directory under which the registries of the package are kept """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "pydra-mrtrix3")
+
+
+def enabled() -> bool:
+    return os.environ.get("PYDRA_MRTRIX3_CHECK_CAPABILITIES", "1") != "0"
+
+
+def registry_dir() -> str:
+    return os.environ.get("PYDRA_MRTRIX3_CAPABILITY_DIR") or os.path.join(
+        cache_root(), "capabilities"
+    )
+
+
+def _run(args: ty.List[str]) -> ty.Tuple[int, str]:
+    try:
+        proc = sp.run(args, stdout=sp.PIPE, stderr=sp.STDOUT, timeout=60)
+    except (OSError, sp.SubprocessError):
+        return -1, ""
+    return proc.returncode, proc.stdout.decode("utf-8", "replace")
+
+
+def probe_executable(path: str) -> Capabilities:
+    """ run an executable to find out its version and interface (uncached) """
+    returncode, out = _run([path, "-version"])
+    # e.g. "== mrconvert 3.0.2 =="
+    version = out.splitlines()[0].strip("= \t") if out else "unknown"
+    if returncode:
+        version = "unknown"
+    returncode, usage = _run([path, "__print_usage__"])
+    if returncode:
+        return Capabilities(executable=path, version=version)
+    return Capabilities.from_usage(path, version, usage)
+
+
+def probe(executable: str) -> ty.Optional[Capabilities]:
+    """ capabilities of an executable (by name or path), None if it isn't found
+
+        Results are kept in memory and on disk, keyed on the resolved path, size
+        and modification time of the executable.
+    """
+    path = shutil.which(executable)
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    signature = f"{REGISTRY_VERSION} {path} {stat.st_size} {stat.st_mtime_ns}"
+    if signature in _probed:
+        return _probed[signature]
+    entry = os.path.join(
+        registry_dir(), hashlib.sha256(signature.encode()).hexdigest() + ".json"
+    )
+    try:
+        with open(entry) as f:
+            capabilities = Capabilities(**json.load(f))
+    except (OSError, ValueError, TypeError):
+        capabilities = probe_executable(path)
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            tmp = f"{entry}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(attr.asdict(capabilities), f)
+            os.replace(tmp, entry)
+        except OSError:
+            # e.g. a read-only home directory: the probe is just repeated
+            pass
+    _probed[signature] = capabilities
+    return capabilities
+
+
+def check_command(args: ty.Sequence[str]):
+    """ fail before launching a command whose executable is missing or doesn't
+        support the options given to it
+    """
+    capabilities = probe(str(args[0]))
+    if capabilities is None:
+        raise FileNotFoundError(f"{args[0]} was not found on the PATH")
+    capabilities.check_args(args)
@@ -0,0 +1,465 @@
+"""
+A compact container for tractograms (.tckz), converted to and from .tck.
+
+A .tck file stores every point as three floats. In a .tckz file the
+coordinates are instead quantised to a given ``precision`` (in mm). Each
+streamline is then stored as its first point, its first step and the changes
+between consecutive steps. As streamlines are smooth, these changes are small
+integers: a 0.5 mm step quantised to 0.01 mm typically takes a single byte per
+coordinate. With no precision, the bit patterns of the stored floats are
+differenced instead, so that the .tck file is reproduced exactly. The
+streamlines are grouped into blocks of ``block_size``. Each block holds the
+number of points of each of its streamlines, their first points and the
+differences. Each of these arrays is zigzag-encoded in the narrowest integer
+type that fits it and split into byte planes. The block is then compressed
+with zstd (if the zstandard package is installed) or zlib. Blocks are
+compressed and decompressed on a pool of threads.
+
+The file starts with a JSON header holding the keys of the .tck header. A
+table of the blocks at the end gives random access to the blocks (and so to
+individual streamlines), while the size prefixed to each block lets the file
+also be read sequentially as a stream.
+
+Example
+-------
+>>> import numpy as np
+>>> from pydra.tasks.mrtrix3.compressed_tracks import (
+...     TckzReader, compress_tck, decompress_tck)
+>>> from pydra.tasks.mrtrix3.streamlines import TckReader, TckWriter
+>>> rng = np.random.default_rng(0)
+>>> tracks = [np.cumsum(rng.normal(0, 0.5, (n, 3)), axis=0) for n in range(1, 40)]
+>>> with TckWriter("walks.tck", keyval={"step_size": "0.5"}) as writer:
+...     writer.write_batch(tracks)
+>>> _ = compress_tck("walks.tck", "walks.tckz", block_size=16)
+>>> _ = decompress_tck("walks.tckz", "restored.tck")
+>>> open("restored.tck", "rb").read() == open("walks.tck", "rb").read()
+True
+>>> _ = compress_tck("walks.tck", "walks_q.tckz", precision=0.01)
+>>> reader = TckzReader("walks_q.tckz")
+>>> reader.count, reader.header["keyval"]["step_size"]
+(39, '0.5')
+>>> float(np.abs(reader.streamline(30) - tracks[30]).max()) < 0.01
+True
+"""
+import json
+import os
+import struct
+import typing as ty
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .streamlines import TckReader, TckWriter, concatenate
+
+
+#: first line of a .tckz file
+MAGIC = b"mrtrix tracks compressed\n"
+
+#: version of the layout of .tckz files
+FORMAT_VERSION = 1
+
+#: default number of streamlines per block
+BLOCK_SIZE = 10000
+
+#: default compression levels of the codecs
+LEVELS = {"zstd": 9, "zlib": 6}
+
+#: marker closing the file, after the offset of the block table
+END_MARKER = b"TCKZEND\0"
+
+# compressed size and number of streamlines of a block
+_BLOCK_PREFIX = struct.Struct("<QQ")
+# offset of the block table, and the end marker
+_FOOTER = struct.Struct("<Q8s")
+# byte offset, compressed size, first streamline and number of streamlines of
+# each block
+_TABLE_COLUMNS = 4
+
+_WIDTHS = (np.uint8, np.uint16, np.uint32, np.uint64)
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def default_codec() -> str:
+    """ zstd if the zstandard package is installed, otherwise zlib """
+    return "zlib" if _zstd() is None else "zstd"
+
+
+def _compressor(codec: str, level: int) -> ty.Callable[[bytes], bytes]:
+    if codec == "zlib":
+        return lambda data: zlib.compress(data, level)
+    if codec == "zstd":
+        zstandard = _zstd()
+        if zstandard is None:
+            raise ImportError("the zstandard package is required for zstd blocks")
+        # compressors are not thread-safe, so each block gets its own
+        return lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError(f"unknown codec {codec!r}")
+
+
+def _decompressor(codec: str) -> ty.Callable[[bytes], bytes]:
+    if codec == "zlib":
+        return zlib.decompress
+    if codec == "zstd":
+        zstandard = _zstd()
+        if zstandard is None:
+            raise ImportError("the zstandard package is required for zstd blocks")
+        return lambda data: zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"unknown codec {codec!r}")
+
+
+def _pack(array: np.ndarray) -> bytes:
+    """ a signed integer array zigzag-encoded (0, -1, 1, -2... as 0, 1, 2, 3...) in
+        the narrowest unsigned type that fits it, and split into byte planes (all
+        the lowest bytes first) so that runs of small values compress well
+    """
+    array = np.asarray(array, dtype=np.int64).ravel()
+    zigzag = ((array << 1) ^ (array >> 63)).view(np.uint64)
+    high = int(zigzag.max()) if zigzag.size else 0
+    width = next(w for w in _WIDTHS if high <= np.iinfo(w).max)
+    narrow = zigzag.astype(np.dtype(width).newbyteorder("<"))
+    planes = narrow.view(np.uint8).reshape(-1, narrow.itemsize).T
+    return struct.pack("<BQ", narrow.itemsize, narrow.size) + planes.tobytes()
+
+
+def _unpack(data: memoryview, position: int) -> ty.Tuple[np.ndarray, int]:
+    itemsize, size = struct.unpack_from("<BQ", data, position)
+    position += struct.calcsize("<BQ")
+    nbytes = itemsize * size
+    planes = np.frombuffer(data, np.uint8, nbytes, position).reshape(itemsize, size)
+    zigzag = planes.T.copy().view(f"<u{itemsize}").ravel().astype(np.uint64)
+    array = (zigzag >> np.uint64(1)).view(np.int64) ^ -(zigzag & np.uint64(1)).view(
+        np.int64
+    )
+    return array, position + nbytes
+
+
+def _difference(values: np.ndarray, restart: np.ndarray) -> np.ndarray:
+    """ differences between consecutive rows, except at the rows of restart """
+    steps = values.copy()
+    inner = np.flatnonzero(~restart)
+    steps[inner] -= values[inner - 1]
+    return steps
+
+
+def _cumulative(steps: np.ndarray, restart: np.ndarray) -> np.ndarray:
+    """ inverse of :func:`_difference`: cumulative sums restarting at restart """
+    values = np.cumsum(steps, axis=0)
+    segments = np.flatnonzero(restart)
+    if segments.size:
+        before = np.zeros((len(segments),) + steps.shape[1:], dtype=values.dtype)
+        before[1:] = values[segments[1:] - 1]
+        lengths = np.diff(np.append(segments, len(steps)))
+        values -= np.repeat(before, lengths, axis=0)
+    return values
+
+
+def _restarts(counts: np.ndarray) -> ty.Tuple[np.ndarray, np.ndarray]:
+    """ masks of the first and second points of each streamline """
+    bounds = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=bounds[1:])
+    first = np.zeros(bounds[-1], dtype=bool)
+    first[bounds[:-1][counts > 0]] = True
+    second = np.zeros(bounds[-1], dtype=bool)
+    second[bounds[:-1][counts > 1] + 1] = True
+    return first, second
+
+
+class _Encoding:
+    """ conversion of points to integers and back """
+
+    def __init__(self, datatype: str, precision: ty.Optional[float]):
+        self.dtype = np.dtype(
+            {"Float32": "f4", "Float64": "f8"}[datatype[:-2]]
+        ).newbyteorder("<" if datatype.endswith("LE") else ">")
+        self.precision = precision
+        self.bits = np.dtype(f"<i{self.dtype.itemsize}")
+
+    def encode(self, points: np.ndarray) -> np.ndarray:
+        if self.precision is None:
+            stored = np.ascontiguousarray(points, dtype=self.dtype.newbyteorder("<"))
+            return stored.view(self.bits).astype(np.int64)
+        return np.rint(points / self.precision).astype(np.int64)
+
+    def decode(self, values: np.ndarray) -> np.ndarray:
+        if self.precision is None:
+            native = self.dtype.newbyteorder("=")
+            return (
+                values.astype(self.bits)
+                .view(self.dtype.newbyteorder("<"))
+                .astype(native)
+            )
+        return (values * self.precision).astype(self.dtype.newbyteorder("="))
+
+
+def _encode_block(streamlines: ty.Sequence[np.ndarray], encoding: _Encoding) -> bytes:
+    points, bounds = concatenate(streamlines)
+    counts = np.diff(bounds)
+    first, second = _restarts(counts)
+    # second differences along each streamline, after its first point and step
+    steps = _difference(encoding.encode(points), first)
+    steps = _difference(steps, first | second)
+    return _pack(counts) + _pack(steps[first]) + _pack(steps[~first])
+
+
+def _decode_block(data: bytes, encoding: _Encoding) -> ty.List[np.ndarray]:
+    data = memoryview(data)
+    counts, position = _unpack(data, 0)
+    firsts, position = _unpack(data, position)
+    others, position = _unpack(data, position)
+    first, second = _restarts(counts)
+    steps = np.empty((len(first), 3), dtype=np.int64)
+    steps[first] = firsts.reshape(-1, 3)
+    steps[~first] = others.reshape(-1, 3)
+    steps = _cumulative(steps, first | second)
+    points = encoding.decode(_cumulative(steps, first))
+    bounds = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=bounds[1:])
+    return [points[bounds[i] : bounds[i + 1]] for i in range(len(counts))]
+
+
+class TckzWriter:
+    """ write streamlines to a .tckz file, block by block
+
+        Streamlines are buffered until a block is full, and full blocks are
+        compressed on ``threads`` threads while the next ones are filled.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        keyval: ty.Optional[ty.Dict[str, str]] = None,
+        datatype: str = "Float32LE",
+        precision: ty.Optional[float] = None,
+        block_size: int = BLOCK_SIZE,
+        codec: ty.Optional[str] = None,
+        level: ty.Optional[int] = None,
+        threads: int = 1,
+    ):
+        self.path = str(path)
+        codec = codec or default_codec()
+        self.header = {
+            "version": FORMAT_VERSION,
+            "datatype": datatype,
+            "precision": precision,
+            "codec": codec,
+            "block_size": block_size,
+            "keyval": dict(keyval or {}),
+        }
+        self._encoding = _Encoding(datatype, precision)
+        self._compress = _compressor(codec, LEVELS[codec] if level is None else level)
+        self._pool = ThreadPoolExecutor(max(threads, 1))
+        self._threads = max(threads, 1)
+        self._pending = []
+        self._buffer = []
+        self._table = []
+        self.count = 0
+        self._file = open(self.path, "wb")
+        self._file.write(MAGIC + json.dumps(self.header).encode("utf-8") + b"\n")
+
+    def _encode(self, streamlines):
+        return self._compress(_encode_block(streamlines, self._encoding))
+
+    def _submit(self, streamlines):
+        self._pending.append(
+            (len(streamlines), self._pool.submit(self._encode, streamlines))
+        )
+        # bound the number of blocks held in memory
+        while len(self._pending) > 2 * self._threads:
+            self._write_block(*self._pending.pop(0))
+
+    def _write_block(self, nstreamlines, future):
+        block = future.result()
+        offset = self._file.tell()
+        self._file.write(_BLOCK_PREFIX.pack(len(block), nstreamlines) + block)
+        self._table.append([offset, len(block), self.count, nstreamlines])
+        self.count += nstreamlines
+
+    def write(self, streamline: np.ndarray):
+        self.write_batch([streamline])
+
+    def write_batch(self, streamlines: ty.Sequence[np.ndarray]):
+        block_size = self.header["block_size"]
+        for points in streamlines:
+            self._buffer.append(np.asarray(points, dtype=np.float64))
+            if len(self._buffer) == block_size:
+                self._submit(self._buffer)
+                self._buffer = []
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._buffer:
+            self._submit(self._buffer)
+            self._buffer = []
+        for pending in self._pending:
+            self._write_block(*pending)
+        self._pending = []
+        self._pool.shutdown()
+        # an empty block marks the end of the blocks for sequential readers
+        self._file.write(_BLOCK_PREFIX.pack(0, 0))
+        table_offset = self._file.tell()
+        table = np.array(self._table, dtype="<u8").reshape(-1, _TABLE_COLUMNS)
+        self._file.write(table.tobytes())
+        self._file.write(_FOOTER.pack(table_offset, END_MARKER))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TckzReader:
+    """ random or sequential access to the blocks of streamlines of a .tckz file """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        with open(self.path, "rb") as f:
+            if f.readline() != MAGIC:
+                raise ValueError(f"'{self.path}' is not a .tckz file")
+            self.header = json.loads(f.readline())
+            self.data_offset = f.tell()
+            if self.header.get("version") != FORMAT_VERSION:
+                raise ValueError(
+                    f"'{self.path}' has unsupported version {self.header.get('version')}"
+                )
+            f.seek(-_FOOTER.size, os.SEEK_END)
+            table_offset, marker = _FOOTER.unpack(f.read(_FOOTER.size))
+            if marker != END_MARKER:
+                raise ValueError(f"'{self.path}' is incomplete (no block table)")
+            f.seek(table_offset)
+            nbytes = os.path.getsize(self.path) - _FOOTER.size - table_offset
+            self.table = np.frombuffer(f.read(nbytes), dtype="<u8").reshape(
+                -1, _TABLE_COLUMNS
+            )
+        self._encoding = _Encoding(self.header["datatype"], self.header["precision"])
+        self._decompress = _decompressor(self.header["codec"])
+
+    @property
+    def count(self) -> int:
+        return int(self.table[:, 3].sum())
+
+    @property
+    def nblocks(self) -> int:
+        return len(self.table)
+
+    def _decode(self, block: bytes) -> ty.List[np.ndarray]:
+        return _decode_block(self._decompress(block), self._encoding)
+
+    def _read(self, f, i: int) -> bytes:
+        offset, size = (int(v) for v in self.table[i, :2])
+        f.seek(offset + _BLOCK_PREFIX.size)
+        return f.read(size)
+
+    def block(self, i: int) -> ty.List[np.ndarray]:
+        """ the streamlines of the i-th block """
+        with open(self.path, "rb") as f:
+            return self._decode(self._read(f, i))
+
+    def iter_blocks(
+        self, threads: int = 1, blocks: ty.Optional[ty.Iterable[int]] = None
+    ) -> ty.Iterator[ty.List[np.ndarray]]:
+        """ yield the streamlines of the blocks (all of them by default) in order,
+            decompressing up to ``threads`` blocks ahead on a pool of threads
+        """
+        blocks = range(self.nblocks) if blocks is None else blocks
+        threads = max(threads, 1)
+        with open(self.path, "rb") as f, ThreadPoolExecutor(threads) as pool:
+            pending = []
+            for i in blocks:
+                pending.append(pool.submit(self._decode, self._read(f, i)))
+                if len(pending) > threads:
+                    yield pending.pop(0).result()
+            for future in pending:
+                yield future.result()
+
+    def __iter__(self) -> ty.Iterator[np.ndarray]:
+        for streamlines in self.iter_blocks():
+            yield from streamlines
+
+    def select(self, numbers: ty.Iterable[int]) -> ty.Iterator[np.ndarray]:
+        """ yield the given streamlines (in the order requested), decompressing
+            only the blocks holding them
+        """
+        firsts = self.table[:, 2].astype(np.int64)
+        cached = (None, None)
+        for number in numbers:
+            if not 0 <= number < self.count:
+                raise IndexError(f"streamline {number} out of range ({self.count})")
+            i = int(np.searchsorted(firsts, number, side="right")) - 1
+            if cached[0] != i:
+                cached = (i, self.block(i))
+            yield cached[1][number - int(firsts[i])]
+
+    def streamline(self, number: int) -> np.ndarray:
+        return next(self.select([number]))
+
+
+def iter_stream(f: ty.BinaryIO) -> ty.Iterator[np.ndarray]:
+    """ yield the streamlines of a .tckz file read sequentially from a stream
+        (e.g. a pipe), without its block table
+    """
+    if f.readline() != MAGIC:
+        raise ValueError("not a .tckz stream")
+    header = json.loads(f.readline())
+    encoding = _Encoding(header["datatype"], header["precision"])
+    decompress = _decompressor(header["codec"])
+    while True:
+        prefix = f.read(_BLOCK_PREFIX.size)
+        if len(prefix) < _BLOCK_PREFIX.size:
+            raise ValueError("truncated .tckz stream")
+        size, nstreamlines = _BLOCK_PREFIX.unpack(prefix)
+        if not size and not nstreamlines:
+            return
+        block = f.read(size)
+        if len(block) < size:
+            raise ValueError("truncated .tckz stream")
+        yield from _decode_block(decompress(block), encoding)
+
+
+def compress_tck(
+    in_file: str,
+    out_file: str,
+    precision: ty.Optional[float] = None,
+    block_size: int = BLOCK_SIZE,
+    codec: ty.Optional[str] = None,
+    level: ty.Optional[int] = None,
+    threads: int = 1,
+) -> int:
+    """ convert a .tck file to .tckz, returning the number of streamlines
+
+        ``precision`` is the step (in mm) the coordinates are quantised to, the
+        conversion being lossless if it is None.
+    """
+    reader = TckReader(in_file)
+    with TckzWriter(
+        out_file,
+        keyval=reader.header.keyval,
+        datatype=reader.header.datatype,
+        precision=precision,
+        block_size=block_size,
+        codec=codec,
+        level=level,
+        threads=threads,
+    ) as writer:
+        for batch in reader.iter_batches(block_size):
+            writer.write_batch(batch)
+    return writer.count
+
+
+def decompress_tck(in_file: str, out_file: str, threads: int = 1) -> int:
+    """ convert a .tckz file to .tck, returning the number of streamlines """
+    reader = TckzReader(in_file)
+    with TckWriter(
+        out_file, keyval=reader.header["keyval"], datatype=reader.header["datatype"]
+    ) as writer:
+        for streamlines in reader.iter_blocks(threads=threads):
+            writer.write_batch(streamlines)
+    return writer.header.count
@@ -0,0 +1,172 @@
+"""
+Multi-threaded (de)compression of gzipped images outside of MRtrix3 commands.
+
+MRtrix3 reads and writes .mif.gz and .nii.gz images with a single thread. With
+the ``parallel_gzip`` input of a task derived from
+:class:`~pydra.tasks.mrtrix3.base.MRTrix3Task` set, its compressed inputs are
+instead decompressed to temporary copies that are passed to the command, and
+outputs with a .gz extension are written uncompressed and then compressed into
+place, using ``nthreads`` threads. The first available of python-isal,
+zlib-ng, pigz and the standard library's zlib is used. All of them write
+standard gzip files; the standard library fallback compresses independent
+blocks in parallel (as a multi-member gzip file, which all gzip readers
+accept), but decompresses with a single thread.
+
+Example
+-------
+>>> import gzip
+>>> from pydra.tasks.mrtrix3.compression import compress, decompress
+>>> with open("plain.dat", "wb") as f:
+...     _ = f.write(bytes(range(256)) * 4096)
+>>> compress("plain.dat", "plain.dat.gz", threads=4)
+>>> gzip.open("plain.dat.gz").read() == open("plain.dat", "rb").read()
+True
+>>> decompress("plain.dat.gz", "restored.dat", threads=4)
+>>> open("restored.dat", "rb").read() == open("plain.dat", "rb").read()
+True
+"""
+import io
+import os
+import gzip
+import shutil
+import typing as ty
+import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor
+
+
+#: size of the independently compressed blocks of the standard library fallback
+BLOCK_SIZE = 4 * 1024 ** 2
+
+#: compression level of the zlib-based backends (isal uses its own default)
+COMPRESSION_LEVEL = 6
+
+
+def _threaded_module():
+    """ the threaded gzip module of python-isal or zlib-ng, if installed """
+    try:
+        from isal import igzip_threaded
+
+        return igzip_threaded
+    except ImportError:
+        pass
+    try:
+        from zlib_ng import gzip_ng_threaded
+
+        return gzip_ng_threaded
+    except ImportError:
+        return None
+
+
+def backend() -> str:
+    """ name of the implementation used: 'isal', 'zlib-ng', 'pigz' or 'zlib' """
+    module = _threaded_module()
+    if module is not None:
+        return "isal" if module.__name__.startswith("isal") else "zlib-ng"
+    if shutil.which("pigz"):
+        return "pigz"
+    return "zlib"
+
+
+def is_compressed(path: str) -> bool:
+    return str(path).endswith(".gz")
+
+
+def decompress(src: str, dst: str, threads: int = 1):
+    """ decompress a gzip file """
+    name = backend()
+    if name == "pigz":
+        with open(dst, "wb") as out:
+            sp.run(
+                ["pigz", "-d", "-c", "-p", str(threads), src], stdout=out, check=True
+            )
+        return
+    if name == "zlib":
+        opener = gzip.open
+    else:
+        module = _threaded_module()
+
+        def opener(path, mode):
+            return module.open(path, mode, threads=threads)
+
+    with opener(src, "rb") as f, open(dst, "wb") as out:
+        shutil.copyfileobj(f, out, length=BLOCK_SIZE)
+
+
+def compress(src: str, dst: str, threads: int = 1):
+    """ compress a file to gzip format """
+    name = backend()
+    if name == "pigz":
+        with open(dst, "wb") as out:
+            sp.run(
+                ["pigz", f"-{COMPRESSION_LEVEL}", "-c", "-p", str(threads), src],
+                stdout=out,
+                check=True,
+            )
+    elif name == "zlib":
+        _compress_blocks(src, dst, threads)
+    else:
+        module = _threaded_module()
+        kwargs = {} if name == "isal" else {"compresslevel": COMPRESSION_LEVEL}
+        with open(src, "rb") as f, module.open(
+            dst, "wb", threads=threads, **kwargs
+        ) as out:
+            shutil.copyfileobj(f, out, length=BLOCK_SIZE)
+
+
+def _compress_blocks(src: str, dst: str, threads: int):
+    """ compress blocks of a file in parallel, as the members of a gzip file """
+
+    def blocks():
+        with open(src, "rb") as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                yield block
+
+    def compress_block(block):
+        # zlib releases the GIL while compressing (gzip.compress only takes
+        # mtime from Python 3.8)
+        buf = io.BytesIO()
+        with gzip.GzipFile(
+            fileobj=buf, mode="wb", compresslevel=COMPRESSION_LEVEL, mtime=0
+        ) as member:
+            member.write(block)
+        return buf.getvalue()
+
+    with open(dst, "wb") as out, ThreadPoolExecutor(max(threads, 1)) as pool:
+        pending = []
+        for block in blocks():
+            pending.append(pool.submit(compress_block, block))
+            # bound the number of blocks held in memory
+            if len(pending) >= 2 * max(threads, 1):
+                out.write(pending.pop(0).result())
+        for future in pending:
+            out.write(future.result())
+    if os.path.getsize(dst) == 0:
+        with gzip.open(dst, "wb", compresslevel=COMPRESSION_LEVEL):
+            pass
+
+
+def uncompressed_name(path: str) -> str:
+    """ file name of a gzipped file with its .gz extension removed """
+    return os.path.basename(str(path))[: -len(".gz")]
+
+
+def stage_inputs(
+    paths: ty.Dict[str, str], staging_dir: str, threads: int
+) -> ty.Dict[str, str]:
+    """ decompress the given files into ``staging_dir`` concurrently, returning
+        the paths of the uncompressed copies
+    """
+    staged = {
+        name: os.path.join(staging_dir, f"{name}_{uncompressed_name(path)}")
+        for name, path in paths.items()
+    }
+    # share the threads between the files
+    per_file = max(threads // max(len(paths), 1), 1)
+    with ThreadPoolExecutor(max(len(paths), 1)) as pool:
+        futures = [
+            pool.submit(decompress, str(paths[name]), staged[name], per_file)
+            for name in paths
+        ]
+        for future in futures:
+            future.result()
+    return staged
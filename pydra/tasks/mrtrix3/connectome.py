@@ -0,0 +1,245 @@
+import attr
+from pydra.engine.specs import File, SpecInfo
+from .base import (
+    MRTrix3BaseSpec,
+    MRTrix3OutSpec,
+    MRTrix3Task,
+    in_file_field,
+    out_file_field,
+    output_field,
+)
+
+
+Tck2ConnectomeInputSpec = SpecInfo(
+    name="Tck2ConnectomeInputs",
+    fields=[
+        in_file_field(help_string="input tractogram"),
+        (
+            "nodes",
+            attr.ib(
+                type=File,
+                metadata={
+                    "argstr": "{nodes}",
+                    "position": 2,
+                    "help_string": "parcellation image, labelling each node with an "
+                    "integer from 1",
+                    "mandatory": True,
+                },
+            ),
+        ),
+        out_file_field("output connectome matrix (text file)"),
+        (
+            "assignment_end_voxels",
+            attr.ib(
+                type=bool,
+                metadata={
+                    "argstr": "-assignment_end_voxels",
+                    "help_string": "assign each endpoint to the node of the voxel it "
+                    "lies in",
+                },
+            ),
+        ),
+        (
+            "assignment_radial_search",
+            attr.ib(
+                type=float,
+                metadata={
+                    "argstr": "-assignment_radial_search {assignment_radial_search}",
+                    "help_string": "assign each endpoint to the nearest node within "
+                    "this radius in mm (the default, with a radius of 4 mm)",
+                },
+            ),
+        ),
+        (
+            "assignment_reverse_search",
+            attr.ib(
+                type=float,
+                metadata={
+                    "argstr": "-assignment_reverse_search "
+                    "{assignment_reverse_search}",
+                    "help_string": "search back along the streamline from each "
+                    "endpoint, up to this distance in mm",
+                },
+            ),
+        ),
+        (
+            "assignment_forward_search",
+            attr.ib(
+                type=float,
+                metadata={
+                    "argstr": "-assignment_forward_search "
+                    "{assignment_forward_search}",
+                    "help_string": "project each endpoint forward, up to this "
+                    "distance in mm",
+                },
+            ),
+        ),
+        (
+            "assignment_all_voxels",
+            attr.ib(
+                type=bool,
+                metadata={
+                    "argstr": "-assignment_all_voxels",
+                    "help_string": "assign each streamline to all the nodes it "
+                    "traverses",
+                },
+            ),
+        ),
+        (
+            "scale_length",
+            attr.ib(
+                type=bool,
+                metadata={
+                    "argstr": "-scale_length",
+                    "help_string": "scale each contribution by the streamline length",
+                },
+            ),
+        ),
+        (
+            "scale_invlength",
+            attr.ib(
+                type=bool,
+                metadata={
+                    "argstr": "-scale_invlength",
+                    "help_string": "scale each contribution by the inverse of the "
+                    "streamline length",
+                },
+            ),
+        ),
+        (
+            "scale_invnodevol",
+            attr.ib(
+                type=bool,
+                metadata={
+                    "argstr": "-scale_invnodevol",
+                    "help_string": "scale each contribution by the inverse of the "
+                    "two node volumes",
+                },
+            ),
+        ),
+        (
+            "scale_file",
+            attr.ib(
+                type=File,
+                metadata={
+                    "argstr": "-scale_file {scale_file}",
+                    "help_string": "scale each contribution by the values of a text "
+                    "file with one value per streamline (e.g. the mean FA sampled "
+                    "by tcksample)",
+                },
+            ),
+        ),
+        (
+            "stat_edge",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "-stat_edge {stat_edge}",
+                    "help_string": "statistic combining the contributions to each "
+                    "edge (default sum)",
+                    "allowed_values": ["sum", "mean", "min", "max"],
+                },
+            ),
+        ),
+        (
+            "tck_weights_in",
+            attr.ib(
+                type=File,
+                metadata={
+                    "argstr": "-tck_weights_in {tck_weights_in}",
+                    "help_string": "weights of the streamlines (e.g. from tcksift2)",
+                },
+            ),
+        ),
+        (
+            "keep_unassigned",
+            attr.ib(
+                type=bool,
+                metadata={
+                    "argstr": "-keep_unassigned",
+                    "help_string": "keep a row and column for the streamlines "
+                    "assigned to no node",
+                },
+            ),
+        ),
+        (
+            "out_assignments",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "-out_assignments {out_assignments}",
+                    "help_string": "output text file of the nodes of each streamline",
+                },
+            ),
+        ),
+        (
+            "vector",
+            attr.ib(
+                type=bool,
+                metadata={
+                    "argstr": "-vector",
+                    "help_string": "output a vector of the connectivity of node 1 "
+                    "to all others",
+                },
+            ),
+        ),
+        (
+            "symmetric",
+            attr.ib(
+                type=bool,
+                metadata={
+                    "argstr": "-symmetric",
+                    "help_string": "make the matrix symmetric rather than upper "
+                    "triangular",
+                },
+            ),
+        ),
+        (
+            "zero_diagonal",
+            attr.ib(
+                type=bool,
+                metadata={
+                    "argstr": "-zero_diagonal",
+                    "help_string": "set the diagonal of the matrix to zero",
+                },
+            ),
+        ),
+    ],
+    bases=(MRTrix3BaseSpec,),
+)
+
+Tck2ConnectomeOutputSpec = SpecInfo(
+    name="Tck2ConnectomeOutputs",
+    fields=[
+        output_field("out_file", "connectome matrix"),
+        output_field("out_assignments", "nodes of each streamline"),
+    ],
+    bases=(MRTrix3OutSpec,),
+)
+
+
+class Tck2Connectome(MRTrix3Task):
+    """
+    To build several connectomes (e.g. with and without SIFT2 weights, or
+    scaled by length) from one tractogram and parcellation, the streamlines can
+    be assigned to nodes once and the matrices computed from the assignments
+    with :class:`~pydra.tasks.mrtrix3.assignments.Assignments`.
+
+    Example
+    ------
+    >>> from pydra.tasks.mrtrix3.streamlines import TckWriter
+    >>> TckWriter("tracks.tck").close()
+    >>> task = Tck2Connectome(
+    ...     in_file="tracks.tck", nodes="test_dwi.nii.gz", out_file="connectome.csv"
+    ... )
+    >>> task.inputs.tck_weights_in = "test.bval"
+    >>> task.inputs.out_assignments = "assignments.txt"
+    >>> task.inputs.symmetric = True
+    >>> task.cmdline
+    'tck2connectome tracks.tck test_dwi.nii.gz -tck_weights_in test.bval -out_assignments assignments.txt -symmetric connectome.csv'
+    """
+
+    input_spec = Tck2ConnectomeInputSpec
+    output_spec = Tck2ConnectomeOutputSpec
+    executable = "tck2connectome"
+    compressed_outputs = ()
@@ -0,0 +1,249 @@
+"""
+In-process conversion of NIfTI images to MRtrix3 format.
+
+Most mrconvert calls merely re-wrap a NIfTI image, and its bvecs/bvals, as a .mif
+with the gradient table embedded in its header. As the voxel data are left
+untouched by such conversions, :class:`~pydra.tasks.mrtrix3.utils.MRConvert`
+performs them here instead of running mrconvert: the NIfTI header is translated
+(with its axes realigned to the scanner frame, as MRtrix3 does) and the voxel
+data are streamed, decompressing .nii.gz on the fly, straight into the
+memory-mapped data region of the output in the order they are stored, the
+realignment being absorbed by the layout of the output. The conversions are run on a shared
+pool of processes (``PYDRA_MRTRIX3_CONVERT_WORKERS`` processes, by default one
+per core), so that concurrent conversions decompress in parallel.
+
+Images that the in-process conversion doesn't handle (e.g. of an unsupported
+datatype) raise :class:`UnsupportedConversion`, on which MRConvert falls back to
+mrconvert. The in-process path is disabled by setting
+``PYDRA_MRTRIX3_FAST_CONVERT=0``.
+
+Example
+-------
+>>> import gzip, struct
+>>> import numpy as np
+>>> from pydra.tasks.mrtrix3.image import load_mif
+>>> from pydra.tasks.mrtrix3.convert import nifti_to_mif
+>>> hdr = bytearray(352)  # a radiological (LAS) 2x2x1x3 Int16 NIfTI-1 image
+>>> struct.pack_into("<i", hdr, 0, 348)
+>>> struct.pack_into("<8h", hdr, 40, 4, 2, 2, 1, 3, 1, 1, 1)
+>>> struct.pack_into("<2h", hdr, 70, 4, 16)
+>>> struct.pack_into("<8f", hdr, 76, -1, 2, 2, 2, 1, 0, 0, 0)
+>>> struct.pack_into("<f", hdr, 108, 352)
+>>> struct.pack_into("<2h", hdr, 252, 0, 1)
+>>> struct.pack_into("<12f", hdr, 280, -2, 0, 0, 2, 0, 2, 0, -2, 0, 0, 2, 0)
+>>> with gzip.open("las_dwi.nii.gz", "wb") as f:
+...     _ = f.write(bytes(hdr) + np.arange(12, dtype="<i2").tobytes())
+>>> np.savetxt("las.bvec", [[0, 1, 0], [0, 0, 1], [0, 0, 0]])
+>>> np.savetxt("las.bval", [[0, 1000, 1000]])
+>>> header = nifti_to_mif("las_dwi.nii.gz", "las_dwi.mif",
+...                       grad_fsl=["las.bvec", "las.bval"])
+>>> header.layout, header.transform[0]
+('-0,+1,+2,+3', [1.0, 0.0, 0.0, 0.0])
+>>> img = load_mif("las_dwi.mif")
+>>> img.data[:, 0, 0, 0].tolist()
+[1, 0]
+>>> img.header.dw_scheme[1]
+[-1.0, 0.0, 0.0, 1000.0]
+"""
+import os
+import gzip
+import json
+import atexit
+import threading
+import typing as ty
+import attr
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .gradients import GradientTable
+from .image import ImageHeader, create_image, read_header, read_nifti_header, realign
+from .threads import available_cores
+
+
+#: input and output formats handled in-process
+NIFTI_EXTENSIONS = (".nii", ".nii.gz")
+MRTRIX_EXTENSIONS = (".mif", ".mih")
+
+#: size of the blocks in which the voxel data are copied
+COPY_BLOCK_SIZE = 16 * 1024 ** 2
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class UnsupportedConversion(ValueError):
+    """ the image can't be converted in-process, but may be by mrconvert """
+
+
+def enabled() -> bool:
+    """ whether conversions may be done in-process """
+    return os.environ.get("PYDRA_MRTRIX3_FAST_CONVERT", "1").strip() not in (
+        "0",
+        "false",
+        "no",
+    )
+
+
+def copy_data(src: str, src_offset: int, dst: str, dst_offset: int, nbytes: int):
+    """ copy the bytes of a (possibly gzipped) file into a preallocated region """
+    target = np.memmap(dst, dtype=np.uint8, mode="r+", offset=dst_offset, shape=nbytes)
+    view = memoryview(target)
+    with (gzip.open if src.endswith(".gz") else open)(src, "rb") as f:
+        f.seek(src_offset)
+        position = 0
+        while position < nbytes:
+            count = f.readinto(view[position : position + COPY_BLOCK_SIZE])
+            if not count:
+                raise ValueError(
+                    f"'{src}' holds {position} of the {nbytes} bytes of image data"
+                )
+            position += count
+    target.flush()
+    del view, target
+
+
+def nifti_to_mif(
+    in_file: str,
+    out_file: str,
+    grad_fsl: ty.Optional[ty.Sequence[str]] = None,
+    grad_file: ty.Optional[str] = None,
+    export_grad: ty.Optional[str] = None,
+    export_json: ty.Optional[str] = None,
+    command_history: ty.Optional[str] = None,
+) -> ImageHeader:
+    """ convert a NIfTI image to .mif/.mih as ``mrconvert`` would, without
+        changing its voxel data, returning the header of the output
+    """
+    in_file, out_file = str(in_file), str(out_file)
+    try:
+        source = read_nifti_header(in_file)
+    except ValueError as e:
+        raise UnsupportedConversion(str(e)) from e
+    header = realign(attr.evolve(source, files=[], path=None, format="MRtrix"))
+    if grad_fsl:
+        bvecs, bvals = grad_fsl
+        grad = GradientTable.from_fsl(bvecs, bvals, transform=source.transform)
+        header = grad.to_header(header)
+    elif grad_file:
+        header = GradientTable.from_mrtrix(grad_file).to_header(header)
+    if header.dw_scheme and len(header.dw_scheme) != header.dim[-1]:
+        raise ValueError(
+            f"{len(header.dw_scheme)} gradient directions do not match the "
+            f"{header.dim[-1]} volumes of '{in_file}'"
+        )
+    if command_history:
+        header = attr.evolve(header, keyval={"command_history": command_history})
+    written = create_image(out_file, header)
+    try:
+        data_path, offset = written.data_file
+        copy_data(in_file, source.files[0][1], data_path, offset, written.nbytes)
+    except BaseException:
+        _remove_image(out_file)
+        raise
+    if export_grad:
+        GradientTable(written.dw_scheme).to_mrtrix(export_grad)
+    if export_json:
+        with open(export_json, "w") as f:
+            json.dump(written.to_json(), f, indent=2)
+    return written
+
+
+def convert_pool() -> ProcessPoolExecutor:
+    """ the pool of processes shared by in-process conversions """
+    global _pool
+    # conversions are started from the threads of MRConvertBatch
+    with _pool_lock:
+        if _pool is None:
+            workers = os.environ.get("PYDRA_MRTRIX3_CONVERT_WORKERS")
+            _pool = ProcessPoolExecutor(
+                max_workers=int(workers) if workers else available_cores()
+            )
+            atexit.register(_pool.shutdown)
+        return _pool
+
+
+def shutdown_pool():
+    """ shut down the pool of processes shared by in-process conversions, if
+        started
+
+        Child processes (e.g. the workers of a pool themselves) don't run atexit
+        handlers but wait for their own children on exit, so must call this
+        before they finish if they ran conversions.
+    """
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def _discard_pool(pool: ProcessPoolExecutor):
+    # a worker that died (e.g. killed by the OOM killer) breaks the whole pool,
+    # so the next conversions start a new one
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def submit(**kwargs):
+    """ run :func:`nifti_to_mif` on the shared pool, returning its future """
+    return convert_pool().submit(nifti_to_mif, **_absolute_paths(kwargs))
+
+
+def convert(**kwargs) -> ImageHeader:
+    """ run :func:`nifti_to_mif` on the shared pool and wait for it to finish
+
+        The conversion is run in this process if it can't start a pool, e.g. as
+        a daemonic worker process of a pool itself. If a worker of the pool dies,
+        the pool is discarded and BrokenProcessPool raised.
+    """
+    pool = convert_pool()
+    try:
+        future = pool.submit(nifti_to_mif, **_absolute_paths(kwargs))
+    except AssertionError:
+        # a daemonic worker process, which can't start a pool itself
+        return nifti_to_mif(**kwargs)
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise
+
+
+def remove_outputs(**kwargs):
+    """ remove any outputs left behind by a conversion that didn't complete """
+    if kwargs.get("out_file"):
+        _remove_image(str(kwargs["out_file"]))
+    for name in ("export_grad", "export_json"):
+        if kwargs.get(name) and os.path.exists(kwargs[name]):
+            os.unlink(kwargs[name])
+
+
+def _remove_image(path: str):
+    # with the data file of a .mih image
+    paths = [path]
+    if path.endswith(".mih"):
+        try:
+            paths.append(read_header(path).data_file[0])
+        except (OSError, ValueError):
+            # named as by create_image, the header being missing or incomplete
+            paths.append(path[:-4] + ".dat")
+    for path in paths:
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def _absolute_paths(kwargs: dict) -> dict:
+    # the processes of the pool don't follow changes of the working directory
+    kwargs = dict(kwargs)
+    for name in ("in_file", "out_file", "grad_file", "export_grad", "export_json"):
+        if kwargs.get(name):
+            kwargs[name] = os.path.abspath(kwargs[name])
+    if kwargs.get("grad_fsl"):
+        kwargs["grad_fsl"] = [os.path.abspath(p) for p in kwargs["grad_fsl"]]
+    return kwargs
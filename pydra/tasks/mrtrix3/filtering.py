@@ -0,0 +1,319 @@
+"""
+Parallel, out-of-core selection of streamlines, as made by tckedit.
+
+tckedit reads the whole tractogram on a single thread for every selection.
+:func:`filter_tracks` instead splits the data region of the .tck file into byte
+ranges on streamline boundaries (using its offset index, see
+:class:`~pydra.tasks.mrtrix3.streamlines.TckIndex`) and has a pool of processes
+test the streamlines of each range, batch by batch, against any number of
+:class:`TrackFilter` specifications at once. The regions of interest of all the
+filters are looked up once per batch, mask images being memory-mapped. The
+streamlines selected from each range are written to temporary files, which are
+then concatenated in order into the output of each filter, applying its
+``skip`` and ``number`` limits.
+
+Example
+-------
+>>> import numpy as np
+>>> from pydra.tasks.mrtrix3.filtering import TrackFilter, filter_tracks
+>>> from pydra.tasks.mrtrix3.streamlines import TckReader, TckWriter
+>>> with TckWriter("to_filter.tck") as writer:
+...     writer.write_batch([
+...         np.array([[0.0, 0, 0], [10, 0, 0]]),
+...         np.array([[0.0, 0, 0], [0, 30, 0]]),
+...         np.array([[20.0, 0, 0], [20, 5, 0]]),
+...     ])
+>>> filter_tracks("to_filter.tck", [
+...     TrackFilter(out_file="long.tck", minlength=8),
+...     TrackFilter(out_file="origin.tck", include=["0,0,0,1"], number=1),
+...     TrackFilter(out_file="others.tck", include=["0,0,0,1"], inverse=True),
+... ], workers=1)
+[2, 1, 1]
+>>> [s[-1].tolist() for s in TckReader("long.tck")]
+[[10.0, 0.0, 0.0], [0.0, 30.0, 0.0]]
+>>> [s[-1].tolist() for s in TckReader("others.tck")]
+[[20.0, 5.0, 0.0]]
+"""
+import os
+import shutil
+import tempfile
+import typing as ty
+from concurrent.futures import ProcessPoolExecutor
+import attr
+import numpy as np
+from .image import VoxelLookup
+from .streamlines import (
+    TckReader,
+    TckWriter,
+    concatenate,
+    load_index,
+    segment_sums,
+    streamline_lengths,
+)
+from .threads import available_cores
+
+
+#: number of streamlines tested at a time
+BATCH_SIZE = 50000
+
+#: stride of the offset index used to split tractograms into byte ranges
+INDEX_STRIDE = 1000
+
+#: byte ranges per worker, so that workers finishing early take on more
+CHUNKS_PER_WORKER = 4
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class TrackFilter:
+    """ criteria of a selection of streamlines, and the file it is written to
+
+        The options are those of tckedit. Regions of interest are mask images
+        (tested nearest-neighbour) or spheres given as "x,y,z,radius" in mm;
+        selected streamlines pass through all the include regions and none of
+        the exclude regions. The weight criteria and ``weights_out`` require the
+        weights of the streamlines to be passed to :func:`filter_tracks`.
+    """
+
+    out_file: str
+    include: ty.List[str] = attr.ib(factory=list)
+    exclude: ty.List[str] = attr.ib(factory=list)
+    minlength: ty.Optional[float] = None
+    maxlength: ty.Optional[float] = None
+    minweight: ty.Optional[float] = None
+    maxweight: ty.Optional[float] = None
+    number: ty.Optional[int] = None
+    skip: int = 0
+    inverse: bool = False
+    ends_only: bool = False
+    weights_out: ty.Optional[str] = None
+
+    @property
+    def uses_weights(self) -> bool:
+        return (
+            self.minweight is not None
+            or self.maxweight is not None
+            or self.weights_out is not None
+        )
+
+    def select(
+        self,
+        regions: ty.Callable[[str, bool], np.ndarray],
+        lengths: np.ndarray,
+        weights: ty.Optional[np.ndarray],
+    ) -> np.ndarray:
+        """ mask of the streamlines of a batch selected by the filter
+
+            ``regions(spec, ends_only)`` gives the mask of the streamlines of the
+            batch entering a region.
+        """
+        selected = np.ones(len(lengths), dtype=bool)
+        for spec in self.include:
+            selected &= regions(spec, self.ends_only)
+        for spec in self.exclude:
+            selected &= ~regions(spec, self.ends_only)
+        if self.minlength is not None:
+            selected &= lengths >= self.minlength
+        if self.maxlength is not None:
+            selected &= lengths <= self.maxlength
+        if self.minweight is not None:
+            selected &= weights >= self.minweight
+        if self.maxweight is not None:
+            selected &= weights <= self.maxweight
+        return ~selected if self.inverse else selected
+
+
+def _region(spec: str) -> ty.Callable[[np.ndarray], np.ndarray]:
+    """ test of whether points lie within a region of interest """
+    values = spec.split(",")
+    if len(values) == 4 and not os.path.exists(spec):
+        try:
+            x, y, z, radius = (float(v) for v in values)
+        except ValueError:
+            pass
+        else:
+            centre = np.array([x, y, z])
+            return lambda points: (
+                np.einsum("ij,ij->i", points - centre, points - centre) <= radius ** 2
+            )
+    lookup = VoxelLookup(spec)
+    return lambda points: lookup(points) > 0
+
+
+def _filter_range(
+    in_file: str,
+    start: int,
+    stop: int,
+    first: int,
+    filters: ty.List[TrackFilter],
+    prefix: str,
+    weights_file: ty.Optional[str],
+) -> ty.List[int]:
+    """ write the streamlines of a byte range selected by each filter to
+        ``{prefix}_{filter}.tck`` (and their weights to ``.npy``), returning how
+        many each selected
+    """
+    reader = TckReader(in_file)
+    specs = {spec for f in filters for spec in f.include + f.exclude}
+    tests = {spec: _region(spec) for spec in specs}
+    all_weights = None if weights_file is None else np.load(weights_file, "r")
+    writers = [
+        TckWriter(f"{prefix}_{i}.tck", datatype=reader.header.datatype)
+        for i in range(len(filters))
+    ]
+    selected_weights = [[] for _ in filters]
+    number = first
+
+    def process(batch):
+        points, bounds = concatenate(batch)
+        lengths = streamline_lengths(points, bounds)
+        weights = None
+        if all_weights is not None:
+            weights = np.asarray(all_weights[number : number + len(batch)])
+        nonempty = np.diff(bounds) > 0
+        starts, ends = bounds[:-1][nonempty], bounds[1:][nonempty] - 1
+        entered = {}
+
+        def regions(spec, ends_only):
+            if spec not in entered:
+                inside = tests[spec](points)
+                traversed = segment_sums(inside, bounds) > 0
+                at_ends = np.zeros(len(batch), dtype=bool)
+                at_ends[nonempty] = inside[starts] | inside[ends]
+                entered[spec] = (traversed, at_ends)
+            return entered[spec][ends_only]
+
+        for i, track_filter in enumerate(filters):
+            chosen = np.flatnonzero(track_filter.select(regions, lengths, weights))
+            writers[i].write_batch([batch[j] for j in chosen])
+            if track_filter.weights_out is not None:
+                selected_weights[i].append(weights[chosen])
+
+    try:
+        batch = []
+        for _, points in reader.scan(start, stop):
+            batch.append(points)
+            if len(batch) == BATCH_SIZE:
+                process(batch)
+                number += len(batch)
+                batch = []
+        if batch:
+            process(batch)
+    finally:
+        for writer in writers:
+            writer.close()
+    for i, weights in enumerate(selected_weights):
+        if filters[i].weights_out is not None:
+            np.save(f"{prefix}_{i}.npy", np.concatenate(weights or [np.zeros(0)]))
+    return [writer.header.count for writer in writers]
+
+
+def _merge(
+    track_filter: TrackFilter,
+    parts: ty.List[ty.Tuple[str, int]],
+    keyval: ty.Dict[str, str],
+    datatype: str,
+) -> int:
+    """ concatenate the (path, count) parts selected by a filter into its output,
+        applying its skip and number limits
+    """
+    skip = track_filter.skip
+    remaining = np.inf if track_filter.number is None else track_filter.number
+    weights = []
+    with TckWriter(track_filter.out_file, keyval=keyval, datatype=datatype) as writer:
+        for path, count in parts:
+            first = min(skip, count)
+            last = int(min(count, first + remaining))
+            skip -= first
+            remaining -= last - first
+            if last == first:
+                continue
+            if (first, last) == (0, count):
+                writer.append_tck(path)
+            else:
+                position = 0
+                for batch in TckReader(path).iter_batches(BATCH_SIZE):
+                    lo = max(first - position, 0)
+                    hi = min(last - position, len(batch))
+                    if lo < hi:
+                        writer.write_batch(batch[lo:hi])
+                    position += len(batch)
+            if track_filter.weights_out is not None:
+                weights.append(np.load(path[: -len(".tck")] + ".npy")[first:last])
+    if track_filter.weights_out is not None:
+        np.savetxt(track_filter.weights_out, np.concatenate(weights or [np.zeros(0)]))
+    return writer.header.count
+
+
+def filter_tracks(
+    in_file: str,
+    filters: ty.Sequence[TrackFilter],
+    weights: ty.Optional[ty.Union[str, np.ndarray]] = None,
+    workers: ty.Optional[int] = None,
+    nchunks: ty.Optional[int] = None,
+) -> ty.List[int]:
+    """ select streamlines of a .tck file with each of the filters, in one pass
+
+        ``weights`` are those of the streamlines (or a text file of them, e.g.
+        from tcksift2). The tractogram is split into ``nchunks`` byte ranges
+        (by default CHUNKS_PER_WORKER per worker) tested by ``workers`` processes
+        (by default one per core). Returns the number of streamlines written by
+        each filter.
+    """
+    in_file = os.path.abspath(in_file)
+    filters = [
+        attr.evolve(
+            f,
+            out_file=os.path.abspath(f.out_file),
+            weights_out=f.weights_out and os.path.abspath(f.weights_out),
+        )
+        for f in filters
+    ]
+    if weights is None and any(f.uses_weights for f in filters):
+        raise ValueError("the weights of the streamlines are required by a filter")
+    workers = workers or available_cores()
+    index = load_index(in_file, stride=INDEX_STRIDE)
+    ranges = index.chunks(nchunks or workers * CHUNKS_PER_WORKER)
+    header = TckReader(in_file).header
+    tmp_dir = tempfile.mkdtemp(
+        prefix=".tckfilter", dir=os.path.dirname(filters[0].out_file)
+    )
+    try:
+        weights_file = None
+        if weights is not None:
+            weights = np.loadtxt(weights) if isinstance(weights, str) else weights
+            weights = np.asarray(weights, dtype=np.float64).ravel()
+            if len(weights) != index.count:
+                raise ValueError(
+                    f"{len(weights)} weights given for {index.count} streamlines"
+                )
+            weights_file = os.path.join(tmp_dir, "weights.npy")
+            np.save(weights_file, weights)
+        jobs = [
+            (in_file, start, stop, first, filters, os.path.join(tmp_dir, str(n)))
+            for n, (first, start, stop) in enumerate(ranges)
+        ]
+        counts = None
+        if workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(min(workers, len(jobs))) as pool:
+                try:
+                    futures = [
+                        pool.submit(_filter_range, *j, weights_file) for j in jobs
+                    ]
+                except AssertionError:
+                    # a daemonic worker process, which can't start a pool itself
+                    pass
+                else:
+                    counts = [future.result() for future in futures]
+        if counts is None:
+            counts = [_filter_range(*job, weights_file) for job in jobs]
+        return [
+            _merge(
+                track_filter,
+                [(f"{job[-1]}_{i}.tck", c[i]) for job, c in zip(jobs, counts)],
+                header.keyval,
+                header.datatype,
+            )
+            for i, track_filter in enumerate(filters)
+        ]
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
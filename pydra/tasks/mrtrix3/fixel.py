@@ -0,0 +1,485 @@
+import attr
+import typing as ty
+from pydra.engine.specs import Directory, File, SpecInfo
+from .base import (
+    MRTrix3BaseSpec,
+    MRTrix3OutSpec,
+    MRTrix3Task,
+    in_file_field,
+    output_field,
+)
+
+
+def _out_dir(position=-1):
+    return (
+        "out_dir",
+        attr.ib(
+            type=str,
+            metadata={
+                "argstr": "{out_dir}",
+                "position": position,
+                "help_string": "output fixel directory",
+                "mandatory": True,
+            },
+        ),
+    )
+
+
+FOD2FixelInputSpec = SpecInfo(
+    name="FOD2FixelInputs",
+    fields=[
+        in_file_field(help_string="input FOD image"),
+        _out_dir(),
+        (
+            "mask",
+            attr.ib(
+                type=File,
+                metadata={
+                    "argstr": "-mask {mask}",
+                    "help_string": "only process voxels within the mask",
+                },
+            ),
+        ),
+        (
+            "afd",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "-afd {afd}",
+                    "help_string": "name of the data file of the apparent fibre "
+                    "density of each fixel, within the fixel directory",
+                },
+            ),
+        ),
+        (
+            "peak_amp",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "-peak_amp {peak_amp}",
+                    "help_string": "name of the data file of the amplitude of the "
+                    "FOD at the maximal peak of each fixel",
+                },
+            ),
+        ),
+        (
+            "disp",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "-disp {disp}",
+                    "help_string": "name of the data file of the dispersion of each "
+                    "fixel",
+                },
+            ),
+        ),
+        (
+            "fmls_integral",
+            attr.ib(
+                type=float,
+                metadata={
+                    "argstr": "-fmls_integral {fmls_integral}",
+                    "help_string": "threshold on the integral of FOD lobes",
+                },
+            ),
+        ),
+        (
+            "fmls_peak_value",
+            attr.ib(
+                type=float,
+                metadata={
+                    "argstr": "-fmls_peak_value {fmls_peak_value}",
+                    "help_string": "threshold on the peak amplitude of FOD lobes",
+                },
+            ),
+        ),
+        (
+            "fmls_no_thresholds",
+            attr.ib(
+                type=bool,
+                metadata={
+                    "argstr": "-fmls_no_thresholds",
+                    "help_string": "disable all FOD lobe thresholding",
+                },
+            ),
+        ),
+        (
+            "maxnum",
+            attr.ib(
+                type=int,
+                metadata={
+                    "argstr": "-maxnum {maxnum}",
+                    "help_string": "maximum number of fixels in each voxel",
+                },
+            ),
+        ),
+    ],
+    bases=(MRTrix3BaseSpec,),
+)
+
+FOD2FixelOutputSpec = SpecInfo(
+    name="FOD2FixelOutputs",
+    fields=[output_field("out_dir", "output fixel directory")],
+    bases=(MRTrix3OutSpec,),
+)
+
+
+class FOD2Fixel(MRTrix3Task):
+    """
+    The fixel directories produced can be read without running MRtrix3 commands
+    with :class:`~pydra.tasks.mrtrix3.fixel_directory.FixelDirectory`.
+
+    Example
+    ------
+    >>> task = FOD2Fixel(in_file="test_dwi.nii.gz", out_dir="fixels", afd="fd.mif")
+    >>> task.cmdline
+    'fod2fixel test_dwi.nii.gz -afd fd.mif fixels'
+    """
+
+    input_spec = FOD2FixelInputSpec
+    output_spec = FOD2FixelOutputSpec
+    executable = "fod2fixel"
+    compressed_outputs = ()
+
+
+FixelCorrespondenceInputSpec = SpecInfo(
+    name="FixelCorrespondenceInputs",
+    fields=[
+        in_file_field(help_string="data file of the subject's fixels"),
+        (
+            "template_dir",
+            attr.ib(
+                type=Directory,
+                metadata={
+                    "argstr": "{template_dir}",
+                    "position": 2,
+                    "help_string": "fixel directory of the template",
+                    "mandatory": True,
+                },
+            ),
+        ),
+        _out_dir(position=3),
+        (
+            "out_file",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "{out_file}",
+                    "position": 4,
+                    "help_string": "name of the data file of the template's fixels, "
+                    "within the output directory",
+                    "mandatory": True,
+                },
+            ),
+        ),
+        (
+            "angle",
+            attr.ib(
+                type=float,
+                metadata={
+                    "argstr": "-angle {angle}",
+                    "help_string": "largest angle (in degrees) between corresponding "
+                    "fixels (default 45)",
+                },
+            ),
+        ),
+    ],
+    bases=(MRTrix3BaseSpec,),
+)
+
+FixelCorrespondenceOutputSpec = SpecInfo(
+    name="FixelCorrespondenceOutputs",
+    fields=[output_field("out_dir", "output fixel directory")],
+    bases=(MRTrix3OutSpec,),
+)
+
+
+class FixelCorrespondence(MRTrix3Task):
+    """
+    Example
+    ------
+    >>> task = FixelCorrespondence(
+    ...     in_file="test_dwi.nii.gz", template_dir=".", out_dir="fd_template",
+    ...     out_file="sub-01.mif"
+    ... )
+    >>> task.cmdline
+    'fixelcorrespondence test_dwi.nii.gz . fd_template sub-01.mif'
+    """
+
+    input_spec = FixelCorrespondenceInputSpec
+    output_spec = FixelCorrespondenceOutputSpec
+    executable = "fixelcorrespondence"
+    compressed_outputs = ()
+
+
+Fixel2VoxelInputSpec = SpecInfo(
+    name="Fixel2VoxelInputs",
+    fields=[
+        in_file_field(help_string="fixel data file"),
+        (
+            "operation",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "{operation}",
+                    "position": 2,
+                    "help_string": "operation reducing the fixels of each voxel",
+                    "allowed_values": [
+                        "mean",
+                        "sum",
+                        "product",
+                        "min",
+                        "max",
+                        "absmax",
+                        "magmax",
+                        "count",
+                        "complexity",
+                        "sf",
+                        "dec_unit",
+                        "dec_scaled",
+                        "none",
+                    ],
+                    "mandatory": True,
+                },
+            ),
+        ),
+        (
+            "out_file",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "{out_file}",
+                    "position": 3,
+                    "help_string": "output voxel image",
+                    "mandatory": True,
+                },
+            ),
+        ),
+        (
+            "number",
+            attr.ib(
+                type=int,
+                metadata={
+                    "argstr": "-number {number}",
+                    "help_string": "number of fixels of each voxel to output (for "
+                    "the 'none' operation)",
+                },
+            ),
+        ),
+        (
+            "fill",
+            attr.ib(
+                type=float,
+                metadata={
+                    "argstr": "-fill {fill}",
+                    "help_string": "value of voxels with too few fixels (for the "
+                    "'none' operation)",
+                },
+            ),
+        ),
+        (
+            "weighted",
+            attr.ib(
+                type=File,
+                metadata={
+                    "argstr": "-weighted {weighted}",
+                    "help_string": "fixel data file of weights (e.g. fibre density)",
+                },
+            ),
+        ),
+    ],
+    bases=(MRTrix3BaseSpec,),
+)
+
+Fixel2VoxelOutputSpec = SpecInfo(
+    name="Fixel2VoxelOutputs",
+    fields=[output_field("out_file", "output voxel image")],
+    bases=(MRTrix3OutSpec,),
+)
+
+
+class Fixel2Voxel(MRTrix3Task):
+    """
+    The sum, mean, max, min and count operations can also be computed in-process,
+    chunk by chunk, with
+    :meth:`~pydra.tasks.mrtrix3.fixel_directory.FixelDirectory.voxel_map`.
+
+    Example
+    ------
+    >>> task = Fixel2Voxel(in_file="test_dwi.nii.gz", operation="sum", out_file="fd.mif")
+    >>> task.cmdline
+    'fixel2voxel test_dwi.nii.gz sum fd.mif'
+    """
+
+    input_spec = Fixel2VoxelInputSpec
+    output_spec = Fixel2VoxelOutputSpec
+    executable = "fixel2voxel"
+
+
+def _file_option(name, help_string):
+    return (
+        name,
+        attr.ib(
+            type=File,
+            metadata={"argstr": f"-{name} {{{name}}}", "help_string": help_string},
+        ),
+    )
+
+
+def _flag_option(name, help_string):
+    return (
+        name,
+        attr.ib(type=bool, metadata={"argstr": f"-{name}", "help_string": help_string}),
+    )
+
+
+def _float_option(name, help_string):
+    return (
+        name,
+        attr.ib(
+            type=float,
+            metadata={"argstr": f"-{name} {{{name}}}", "help_string": help_string},
+        ),
+    )
+
+
+FixelCFEStatsInputSpec = SpecInfo(
+    name="FixelCFEStatsInputs",
+    fields=[
+        (
+            "in_dir",
+            attr.ib(
+                type=Directory,
+                metadata={
+                    "argstr": "{in_dir}",
+                    "position": 1,
+                    "help_string": "fixel directory holding the data files of all "
+                    "subjects",
+                    "mandatory": True,
+                },
+            ),
+        ),
+        (
+            "subjects",
+            attr.ib(
+                type=File,
+                metadata={
+                    "argstr": "{subjects}",
+                    "position": 2,
+                    "help_string": "text file listing the data file of each subject",
+                    "mandatory": True,
+                },
+            ),
+        ),
+        (
+            "design",
+            attr.ib(
+                type=File,
+                metadata={
+                    "argstr": "{design}",
+                    "position": 3,
+                    "help_string": "design matrix",
+                    "mandatory": True,
+                },
+            ),
+        ),
+        (
+            "contrast",
+            attr.ib(
+                type=File,
+                metadata={
+                    "argstr": "{contrast}",
+                    "position": 4,
+                    "help_string": "contrast matrix",
+                    "mandatory": True,
+                },
+            ),
+        ),
+        (
+            "connectivity",
+            attr.ib(
+                type=Directory,
+                metadata={
+                    "argstr": "{connectivity}",
+                    "position": 5,
+                    "help_string": "fixel-fixel connectivity matrix (the output "
+                    "directory of fixelconnectivity)",
+                    "mandatory": True,
+                },
+            ),
+        ),
+        _out_dir(position=6),
+        _file_option("mask", "only test the fixels within this fixel mask"),
+        _flag_option("notest", "don't run the permutation test"),
+        (
+            "errors",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "-errors {errors}",
+                    "help_string": "assumptions on the errors: exchangeable (ee), "
+                    "independent and symmetric (ise) or both",
+                    "allowed_values": ["ee", "ise", "both"],
+                },
+            ),
+        ),
+        _file_option("exchange_within", "blocks of exchangeability within subjects"),
+        _file_option("exchange_whole", "blocks exchanged as a whole"),
+        _flag_option("strong", "strong familywise error control across contrasts"),
+        (
+            "nshuffles",
+            attr.ib(
+                type=int,
+                metadata={
+                    "argstr": "-nshuffles {nshuffles}",
+                    "help_string": "number of shuffles (default 5000)",
+                },
+            ),
+        ),
+        _file_option("permutations", "permutations to use, one per row"),
+        _flag_option("nonstationarity", "adjust for non-stationarity"),
+        _float_option("cfe_dh", "height increment of the CFE integration"),
+        _float_option("cfe_e", "extent exponent of CFE"),
+        _float_option("cfe_h", "height exponent of CFE"),
+        _float_option("cfe_c", "connectivity exponent of CFE"),
+        _file_option("variance", "variance groups of the subjects"),
+        _file_option("ftests", "F-tests, as rows of contrasts"),
+        _flag_option("fonly", "only assess the F-tests"),
+        (
+            "column",
+            attr.ib(
+                type=ty.List[File],
+                metadata={
+                    "argstr": "-column...",
+                    "help_string": "text files of subject-specific columns of the "
+                    "design matrix",
+                },
+            ),
+        ),
+    ],
+    bases=(MRTrix3BaseSpec,),
+)
+
+FixelCFEStatsOutputSpec = SpecInfo(
+    name="FixelCFEStatsOutputs",
+    fields=[output_field("out_dir", "fixel directory of the statistics")],
+    bases=(MRTrix3OutSpec,),
+)
+
+
+class FixelCFEStats(MRTrix3Task):
+    """
+    Example
+    ------
+    >>> task = FixelCFEStats(
+    ...     in_dir=".", subjects="test.bval", design="test.bvec", contrast="test.bval",
+    ...     connectivity=".", out_dir="stats", nshuffles=1000
+    ... )
+    >>> task.cmdline
+    'fixelcfestats . test.bval test.bvec test.bval . stats -nshuffles 1000'
+    """
+
+    input_spec = FixelCFEStatsInputSpec
+    output_spec = FixelCFEStatsOutputSpec
+    executable = "fixelcfestats"
+    compressed_outputs = ()
@@ -0,0 +1,208 @@
+"""
+Out-of-core access to MRtrix3 fixel directories.
+
+A fixel directory holds an index image, whose two volumes give the number of
+fixels in each voxel and the index of the first of them (the fixels of a voxel
+being stored consecutively), an image of the direction of each fixel (N x 3 x 1
+for N fixels), and any number of data files of N x 1 x 1 (or N x k x 1) values,
+e.g. the fibre density (afd.mif) of each fixel. :class:`FixelDirectory`
+memory-maps all of them, so that the fixels of a set of voxels can be gathered,
+or per-fixel values reduced to voxel maps, without running an MRtrix3 command
+or reading whole data files into memory.
+
+Example
+-------
+>>> import os
+>>> import numpy as np
+>>> from pydra.tasks.mrtrix3.fixel_directory import FixelDirectory, write_fixel_image
+>>> os.makedirs("fixels", exist_ok=True)
+>>> index = np.zeros((2, 1, 1, 2), dtype=np.uint32)
+>>> index[:, 0, 0, 0] = [2, 1]  # fixels in each voxel
+>>> index[:, 0, 0, 1] = [0, 2]  # index of their first fixel
+>>> _ = write_fixel_image("fixels/index.mif", index, datatype="UInt32LE")
+>>> _ = write_fixel_image("fixels/directions.mif", np.eye(3))
+>>> _ = write_fixel_image("fixels/afd.mif", [0.5, 0.25, 0.75])
+>>> fixels = FixelDirectory("fixels")
+>>> fixels.nfixels, fixels.data_files()
+(3, ['afd'])
+>>> ids, bounds = fixels.fixels_of([[1, 0, 0], [0, 0, 0]])
+>>> ids.tolist(), bounds.tolist()
+([2, 0, 1], [0, 1, 3])
+>>> values, bounds = fixels.gather("afd", [[0, 0, 0]])
+>>> values.tolist()
+[0.5, 0.25]
+>>> fixels.voxel_map("afd", reduce="max")[:, 0, 0].tolist()
+[0.5, 0.75]
+"""
+import os
+import typing as ty
+import numpy as np
+from .image import ImageHeader, load_mif, read_header, save_mif
+
+
+#: number of fixels processed at a time when reducing them to voxel maps
+CHUNK_SIZE = 4 * 1024 ** 2
+
+#: extensions of the images of a fixel directory
+IMAGE_EXTENSIONS = (".mif", ".mih")
+
+REDUCTIONS = ("sum", "mean", "max", "min", "count")
+
+
+def write_fixel_image(path: str, values, datatype: str = "Float32LE") -> ImageHeader:
+    """ write per-fixel values (N or N x k) as a fixel data file, or an index
+        image (X x Y x Z x 2) as given
+    """
+    values = np.asarray(values)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+    if values.ndim == 2:
+        values = values[..., np.newaxis]
+    header = ImageHeader(
+        dim=values.shape,
+        vox=(1.0,) * values.ndim,
+        layout=",".join(f"+{i}" for i in range(values.ndim)),
+        datatype=datatype,
+    )
+    return save_mif(path, values, header, slab_size=values.shape[-1])
+
+
+class FixelDirectory:
+    """ memory-mapped images of an MRtrix3 fixel directory """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self.index = load_mif(self._image_path("index"))
+        if self.index.header.ndim != 4 or self.index.header.dim[3] != 2:
+            raise ValueError(f"{self.index.header.path} is not a fixel index image")
+        self.counts = self.index.data[..., 0]
+        self.offsets = self.index.data[..., 1]
+        self.directions = load_mif(self._image_path("directions")).data[:, :, 0]
+        self._fixel_voxels = None
+
+    def _image_path(self, name: str) -> str:
+        for ext in IMAGE_EXTENSIONS:
+            path = os.path.join(self.path, name + ext)
+            if os.path.exists(path):
+                return path
+        raise FileNotFoundError(f"no {name} image in fixel directory {self.path}")
+
+    @property
+    def nfixels(self) -> int:
+        return self.directions.shape[0]
+
+    @property
+    def shape(self) -> ty.Tuple[int, int, int]:
+        """ dimensions of the voxel grid """
+        return tuple(self.index.header.dim[:3])
+
+    def data_files(self) -> ty.List[str]:
+        """ names of the data files (images with a value per fixel) """
+        names = []
+        for fname in sorted(os.listdir(self.path)):
+            name, ext = os.path.splitext(fname)
+            if ext not in IMAGE_EXTENSIONS or name in ("index", "directions"):
+                continue
+            try:
+                dim = read_header(os.path.join(self.path, fname)).dim
+            except (OSError, ValueError):
+                continue
+            if dim[0] == self.nfixels:
+                names.append(name)
+        return names
+
+    def data(self, name: str) -> np.ndarray:
+        """ memory-mapped values of a data file, of shape N (or N x k) """
+        image = load_mif(self._image_path(name))
+        if image.header.dim[0] != self.nfixels:
+            raise ValueError(
+                f"{image.header.path} has {image.header.dim[0]} rows rather than one "
+                f"per fixel ({self.nfixels})"
+            )
+        values = image.data[:, :, 0]
+        return values[:, 0] if values.shape[1] == 1 else values
+
+    def _values(self, values: ty.Union[str, np.ndarray]) -> np.ndarray:
+        return self.data(values) if isinstance(values, str) else values
+
+    def fixels_of(self, voxels) -> ty.Tuple[np.ndarray, np.ndarray]:
+        """ indices of the fixels of M voxels (M x 3 coordinates)
+
+            Returns the indices of all their fixels, voxel by voxel, and the M + 1
+            bounds of the fixels of each voxel in them.
+        """
+        x, y, z = np.asarray(voxels, dtype=np.intp).reshape(-1, 3).T
+        counts = np.asarray(self.counts[x, y, z], dtype=np.int64)
+        offsets = np.asarray(self.offsets[x, y, z], dtype=np.int64)
+        bounds = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=bounds[1:])
+        ids = np.arange(bounds[-1]) + np.repeat(offsets - bounds[:-1], counts)
+        return ids, bounds
+
+    def gather(
+        self, values: ty.Union[str, np.ndarray], voxels
+    ) -> ty.Tuple[np.ndarray, np.ndarray]:
+        """ values (or the data file of that name) of the fixels of M voxels, with
+            the M + 1 bounds of the fixels of each voxel in them
+        """
+        ids, bounds = self.fixels_of(voxels)
+        # only the pages holding the requested fixels are read
+        return np.asarray(self._values(values)[ids]), bounds
+
+    def fixel_voxels(self) -> np.ndarray:
+        """ linear index (in C order over the voxel grid) of the voxel of each fixel """
+        if self._fixel_voxels is None:
+            counts = np.asarray(self.counts, dtype=np.int64).ravel()
+            offsets = np.asarray(self.offsets, dtype=np.int64).ravel()
+            if counts.sum() != self.nfixels:
+                raise ValueError(
+                    f"the index of {self.path} holds {counts.sum()} fixels, but there "
+                    f"are {self.nfixels} directions"
+                )
+            occupied = np.flatnonzero(counts)
+            occupied = occupied[np.argsort(offsets[occupied], kind="stable")]
+            self._fixel_voxels = np.repeat(occupied, counts[occupied])
+        return self._fixel_voxels
+
+    def voxel_map(
+        self, values: ty.Union[str, np.ndarray], reduce: str = "mean"
+    ) -> np.ndarray:
+        """ reduce per-fixel values (or a data file) to a map over the voxel grid
+
+            ``reduce`` is one of sum, mean, max, min or count; voxels without
+            fixels are 0. The values are read CHUNK_SIZE fixels at a time.
+        """
+        if reduce not in REDUCTIONS:
+            raise ValueError(f"reduce must be one of {REDUCTIONS}, not {reduce!r}")
+        values = self._values(values)
+        voxels = self.fixel_voxels()
+        nvoxels = int(np.prod(self.shape))
+        counts = np.bincount(voxels, minlength=nvoxels)
+        if reduce == "count":
+            return counts.reshape(self.shape)
+        if reduce in ("sum", "mean"):
+            result = np.zeros(nvoxels)
+        else:
+            result = np.full(nvoxels, -np.inf if reduce == "max" else np.inf)
+        for start in range(0, self.nfixels, CHUNK_SIZE):
+            chunk = np.asarray(values[start : start + CHUNK_SIZE], dtype=np.float64)
+            where = voxels[start : start + CHUNK_SIZE]
+            if reduce in ("sum", "mean"):
+                result += np.bincount(where, weights=chunk, minlength=nvoxels)
+            elif reduce == "max":
+                np.maximum.at(result, where, chunk)
+            else:
+                np.minimum.at(result, where, chunk)
+        if reduce == "mean":
+            np.divide(result, counts, out=result, where=counts > 0)
+        result[counts == 0] = 0
+        return result.reshape(self.shape)
+
+    def write_data(self, name: str, values, datatype: str = "Float32LE") -> str:
+        """ add a data file of per-fixel values (e.g. custom statistics) """
+        values = np.asarray(values)
+        if values.shape[0] != self.nfixels:
+            raise ValueError(f"expected {self.nfixels} values, got {values.shape[0]}")
+        path = os.path.join(self.path, name + ".mif")
+        write_fixel_image(path, values, datatype=datatype)
+        return path
@@ -0,0 +1,159 @@
+"""
+In-process handling of diffusion gradient tables.
+
+Gradient tables are held as (N, 4) float64 arrays of [x, y, z, b] rows in the
+scanner frame, as in MRtrix3's .b files and the ``dw_scheme`` header entry, and
+can be loaded from and exported to either format (or FSL bvecs/bvals) without
+invoking mrconvert. Shell clustering follows MRtrix3's default behaviour.
+
+Example
+-------
+>>> import numpy as np
+>>> from pydra.tasks.mrtrix3.gradients import GradientTable
+>>> np.savetxt("dwi.bvec", [[0, 1, 0, 0.6], [0, 0, 1, 0.8], [0, 0, 0, 0]])
+>>> np.savetxt("dwi.bval", [[0, 1000, 1005, 2990]])
+>>> grad = GradientTable.from_fsl("dwi.bvec", "dwi.bval", transform=np.eye(3))
+>>> grad.table[1].tolist()
+[-1.0, 0.0, 0.0, 1000.0]
+>>> grad.shells()
+[(0.0, [0]), (1002.5, [1, 2]), (2990.0, [3])]
+>>> grad.to_mrtrix("dwi.b")
+>>> GradientTable.from_mrtrix("dwi.b").shell_bvalues()
+[0.0, 1002.5, 2990.0]
+>>> grad.to_fsl("out.bvec", "out.bval", transform=np.eye(3))
+>>> np.allclose(np.loadtxt("out.bvec"), np.loadtxt("dwi.bvec"))
+True
+"""
+import typing as ty
+import attr
+import numpy as np
+
+
+#: b-values at or below this are considered to be b=0 volumes
+BZERO_THRESHOLD = 10.0
+
+#: maximum difference between b-values of the same shell
+BVALUE_EPSILON = 80.0
+
+
+def _linear(transform) -> np.ndarray:
+    """ 3x3 rotation part of a 3x3/3x4/4x4 image transform (voxel sizes removed) """
+    linear = np.asarray(transform, dtype=np.float64)[:3, :3]
+    return linear / np.linalg.norm(linear, axis=0)
+
+
+@attr.s(auto_attribs=True)
+class GradientTable:
+    """ diffusion gradient table of [x, y, z, b] rows in the scanner frame """
+
+    table: np.ndarray = attr.ib(converter=lambda t: np.asarray(t, dtype=np.float64))
+
+    def __attrs_post_init__(self):
+        self.table = self.table.reshape(-1, 4)
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self.table[:, :3]
+
+    @property
+    def bvalues(self) -> np.ndarray:
+        return self.table[:, 3]
+
+    @classmethod
+    def from_mrtrix(cls, path: str) -> "GradientTable":
+        """ load an MRtrix3 format (.b) gradient file """
+        return cls(np.loadtxt(path, comments="#", ndmin=2))
+
+    @classmethod
+    def from_header(cls, header) -> "GradientTable":
+        """ gradient table stored in the dw_scheme of an image header """
+        if not header.dw_scheme:
+            raise ValueError(f"'{header.path}' has no dw_scheme entry")
+        return cls(header.dw_scheme)
+
+    @classmethod
+    def from_fsl(cls, bvecs: str, bvals: str, transform) -> "GradientTable":
+        """ load FSL bvecs/bvals, rotating the vectors into the scanner frame
+
+            ``transform`` is the voxel-to-scanner transform of the image the
+            bvecs refer to (as stored on disk, e.g. the NIfTI sform). As FSL
+            defines bvecs in a left-handed voxel frame, the x component is flipped
+            for images whose transform has a positive determinant.
+        """
+        vecs = np.loadtxt(bvecs, ndmin=2)
+        vals = np.loadtxt(bvals, ndmin=1).ravel()
+        if vecs.shape[0] != 3 and vecs.shape[1] == 3:
+            vecs = vecs.T
+        if vecs.shape != (3, len(vals)):
+            raise ValueError(
+                f"bvecs of shape {vecs.shape} do not match {len(vals)} bvals"
+            )
+        linear = _linear(transform)
+        if np.linalg.det(linear) > 0:
+            vecs = vecs * np.array([[-1.0], [1.0], [1.0]])
+        return cls(np.column_stack([(linear @ vecs).T, vals]))
+
+    def normalise(self, scale_bvalues: bool = False) -> "GradientTable":
+        """ gradient table with unit-length vectors for all non-b=0 volumes
+
+            With ``scale_bvalues`` the b-values are multiplied by the squared norm
+            of their original vectors, as done by MRtrix3's -bvalue_scaling.
+        """
+        table = self.table.copy()
+        norms = np.linalg.norm(table[:, :3], axis=1)
+        nonzero = norms > 0
+        table[nonzero, :3] /= norms[nonzero, np.newaxis]
+        if scale_bvalues:
+            table[nonzero, 3] *= norms[nonzero] ** 2
+        return type(self)(table)
+
+    def shells(
+        self, epsilon: float = BVALUE_EPSILON, bzero_threshold: float = BZERO_THRESHOLD
+    ) -> ty.List[ty.Tuple[float, ty.List[int]]]:
+        """ cluster volumes into shells, returning (mean b-value, volumes) pairs
+
+            B-values within ``epsilon`` of a neighbouring b-value belong to the
+            same shell, and those up to ``bzero_threshold`` form the b=0 shell.
+        """
+        bvalues = self.bvalues
+        order = np.argsort(bvalues, kind="stable")
+        sorted_b = bvalues[order]
+        bzero = sorted_b <= bzero_threshold
+        breaks = np.flatnonzero(np.diff(sorted_b) > epsilon) + 1
+        # the b=0 volumes always form their own shell
+        nzero = int(bzero.sum())
+        if 0 < nzero < len(sorted_b):
+            breaks = np.union1d(breaks, [nzero])
+        shells = []
+        for members in np.split(order, breaks):
+            if not len(members):
+                continue
+            bvalue = 0.0 if bvalues[members[0]] <= bzero_threshold else bvalues[members]
+            shells.append((float(np.mean(bvalue)), sorted(members.tolist())))
+        return shells
+
+    def shell_bvalues(self, **kwargs) -> ty.List[float]:
+        return [bvalue for bvalue, _ in self.shells(**kwargs)]
+
+    def to_mrtrix(self, path: str):
+        """ write an MRtrix3 format (.b) gradient file """
+        np.savetxt(path, self.table, fmt="%.10g")
+
+    def to_header(self, header):
+        """ copy of an image header with this table as its dw_scheme """
+        return attr.evolve(header, dw_scheme=self.table.tolist())
+
+    def to_fsl(self, bvecs: str, bvals: str, transform):
+        """ write FSL bvecs/bvals for an image with the given transform
+
+            This is the inverse of :meth:`from_fsl`.
+        """
+        linear = _linear(transform)
+        vecs = np.linalg.inv(linear) @ self.vectors.T
+        if np.linalg.det(linear) > 0:
+            vecs[0] = -vecs[0]
+        np.savetxt(bvecs, vecs + 0.0, fmt="%.10g")
+        np.savetxt(bvals, self.bvalues[np.newaxis], fmt="%.10g")
@@ -0,0 +1,705 @@
+"""
+Reading and writing of MRtrix3 format images (.mif/.mih) without invoking an MRtrix3
+binary.
+
+The voxel data are exposed as a :class:`numpy.memmap` view onto the image file,
+so that large (e.g. 4D DWI) volumes can be accessed without copying them into
+memory.
+
+Example
+-------
+>>> import numpy as np
+>>> from pydra.tasks.mrtrix3.image import load_mif
+>>> hdr = (
+...     b"mrtrix image\\n"
+...     b"dim: 2,3,4\\n"
+...     b"vox: 2,2,2\\n"
+...     b"layout: -0,+2,+1\\n"
+...     b"datatype: Int16LE\\n"
+...     b"transform: 1,0,0,0\\n"
+...     b"transform: 0,1,0,0\\n"
+...     b"transform: 0,0,1,0\\n"
+...     b"file: . 256\\n"
+...     b"END\\n"
+... )
+>>> with open("example.mif", "wb") as f:
+...     _ = f.write(hdr.ljust(256, b"\\0"))
+...     _ = f.write(np.arange(24, dtype="<i2").tobytes())
+>>> img = load_mif("example.mif")
+>>> img.header.dim
+(2, 3, 4)
+>>> img.data.shape
+(2, 3, 4)
+>>> int(img.data[0, 0, 0]), int(img.data[1, 0, 0]), int(img.data[0, 0, 1])
+(1, 0, 3)
+"""
+
+import os
+import gzip
+import struct
+import typing as ty
+import attr
+import numpy as np
+
+#: MRtrix3 datatype specifiers and their NumPy equivalents (without endianness)
+DATATYPES = {
+    "Int8": "i1",
+    "UInt8": "u1",
+    "Int16": "i2",
+    "UInt16": "u2",
+    "Int32": "i4",
+    "UInt32": "u4",
+    "Int64": "i8",
+    "UInt64": "u8",
+    "Float32": "f4",
+    "Float64": "f8",
+    "CFloat32": "c8",
+    "CFloat64": "c16",
+}
+
+
+def parse_datatype(datatype: str) -> np.dtype:
+    """ convert an MRtrix3 datatype specifier (e.g. 'Float32LE') to a numpy dtype """
+    name, byteorder = datatype, "="
+    if datatype.endswith("LE"):
+        name, byteorder = datatype[:-2], "<"
+    elif datatype.endswith("BE"):
+        name, byteorder = datatype[:-2], ">"
+    if name == "Bit":
+        raise ValueError("Bit datatype images cannot be memory-mapped")
+    try:
+        return np.dtype(byteorder + DATATYPES[name])
+    except KeyError:
+        raise ValueError(f"unrecognised MRtrix3 datatype '{datatype}'")
+
+
+def parse_layout(layout: str) -> ty.List[ty.Tuple[int, int]]:
+    """ convert an MRtrix3 layout string (e.g. '-0,+1,+2') to (sign, order) pairs """
+    parsed = []
+    for spec in layout.split(","):
+        spec = spec.strip()
+        sign = -1 if spec.startswith("-") else 1
+        parsed.append((sign, int(spec.lstrip("+-"))))
+    return parsed
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class ImageHeader:
+    """ header of an MRtrix3 format (or NIfTI) image
+
+    - dim, vox, layout and datatype describe the voxel grid and its storage
+    - transform is the 3x4 voxel-to-scanner transform (without voxel sizes)
+    - scaling is the (offset, scale) pair applied to stored intensities
+    - dw_scheme holds the diffusion gradient table rows, if any
+    - files are the (path, byte offset) pairs of the data, relative to the header
+    - keyval holds all other key-value entries
+    - format is the file format the header was read from
+    """
+
+    dim: ty.Tuple[int, ...]
+    vox: ty.Tuple[float, ...]
+    layout: str
+    datatype: str
+    transform: ty.List[ty.List[float]] = attr.ib(factory=list)
+    scaling: ty.Tuple[float, float] = (0.0, 1.0)
+    dw_scheme: ty.List[ty.List[float]] = attr.ib(factory=list)
+    files: ty.List[ty.Tuple[str, int]] = attr.ib(factory=list)
+    keyval: ty.Dict[str, str] = attr.ib(factory=dict)
+    path: ty.Optional[str] = None
+    format: str = "MRtrix"
+
+    @property
+    def ndim(self) -> int:
+        return len(self.dim)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return parse_datatype(self.datatype)
+
+    @property
+    def nbytes(self) -> int:
+        """ size of the (uncompressed) image data """
+        nvoxels = int(np.prod(self.dim, dtype=np.int64))
+        if self.datatype == "Bit":
+            return (nvoxels + 7) // 8
+        return nvoxels * self.dtype.itemsize
+
+    @property
+    def data_file(self) -> ty.Tuple[str, int]:
+        """ absolute path and offset of the (single) data file """
+        if len(self.files) != 1:
+            raise ValueError(
+                f"images with {len(self.files)} data files are not supported"
+            )
+        fname, offset = self.files[0]
+        if fname == ".":
+            fname = self.path
+        elif self.path is not None:
+            fname = os.path.join(os.path.dirname(self.path), fname)
+        return fname, offset
+
+    def storage_shape(self) -> ty.Tuple[int, ...]:
+        """ shape of the data as laid out on disk (C-order, slowest axis first) """
+        return tuple(self.dim[ax] for ax in self.disk_order())
+
+    def disk_order(self) -> ty.List[int]:
+        """ image axes ordered from slowest to fastest varying on disk """
+        layout = parse_layout(self.layout)
+        if len(layout) != self.ndim:
+            raise ValueError(
+                f"layout '{self.layout}' does not match {self.ndim} dimensions"
+            )
+        return sorted(range(self.ndim), key=lambda ax: -layout[ax][1])
+
+    def to_json(self) -> dict:
+        """ header in the form exported by MRtrix3 (e.g. ``mrinfo -json_all``) """
+        keyval = dict(self.keyval)
+        if self.dw_scheme:
+            keyval["dw_scheme"] = [list(row) for row in self.dw_scheme]
+        transform = [list(row) for row in self.transform[:3]]
+        return {
+            "name": self.path,
+            "format": self.format,
+            "size": list(self.dim),
+            "spacing": list(self.vox),
+            "strides": [
+                sign * (order + 1) for sign, order in parse_layout(self.layout)
+            ],
+            "datatype": self.datatype,
+            "intensity_offset": self.scaling[0],
+            "intensity_scale": self.scaling[1],
+            "transform": transform + [[0.0, 0.0, 0.0, 1.0]] if transform else [],
+            "keyval": keyval,
+        }
+
+
+def read_entries(path: str, magic: str) -> ty.List[ty.Tuple[str, str]]:
+    """ read the key-value entries of an MRtrix3 header starting with ``magic`` """
+    entries = []
+    with (gzip.open if str(path).endswith(".gz") else open)(path, "rb") as f:
+        if f.readline().rstrip(b"\r\n") != magic.encode("utf-8"):
+            raise ValueError(f"'{path}' does not start with '{magic}'")
+        for line in f:
+            line = line.decode("utf-8").rstrip("\r\n")
+            if line == "END":
+                break
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            key, _, value = line.partition(":")
+            entries.append((key.strip(), value.strip()))
+        else:
+            raise ValueError(f"'{path}' has no END marker in its header")
+    return entries
+
+
+def read_header(path: str) -> ImageHeader:
+    """ read the header of an MRtrix3 .mif/.mih image """
+    return _header_from_entries(read_entries(path, "mrtrix image"), str(path))
+
+
+def _header_from_entries(entries, path=None) -> ImageHeader:
+    fields = {"keyval": {}, "transform": [], "dw_scheme": [], "files": []}
+    for key, value in entries:
+        if key == "dim":
+            fields["dim"] = tuple(int(d) for d in value.split(","))
+        elif key == "vox":
+            fields["vox"] = tuple(float(v) for v in value.split(","))
+        elif key in ("layout", "datatype"):
+            fields[key] = value
+        elif key == "transform":
+            fields["transform"].append([float(v) for v in value.split(",")])
+        elif key == "scaling":
+            fields["scaling"] = tuple(float(v) for v in value.split(","))
+        elif key == "dw_scheme":
+            fields["dw_scheme"].append([float(v) for v in value.split(",")])
+        elif key == "file":
+            fname, _, offset = value.partition(" ")
+            fields["files"].append((fname, int(offset) if offset else 0))
+        elif key in fields["keyval"]:
+            # repeated keys are joined by newlines, as done by MRtrix3
+            fields["keyval"][key] += "\n" + value
+        else:
+            fields["keyval"][key] = value
+    missing = [key for key in ("dim", "vox", "layout", "datatype") if key not in fields]
+    if missing:
+        raise ValueError(f"header of '{path}' is missing {missing}")
+    return ImageHeader(path=path, **fields)
+
+
+#: NIfTI datatype codes and their MRtrix3 equivalents (without endianness)
+NIFTI_DATATYPES = {
+    2: "UInt8",
+    4: "Int16",
+    8: "Int32",
+    16: "Float32",
+    32: "CFloat32",
+    64: "Float64",
+    256: "Int8",
+    512: "UInt16",
+    768: "UInt32",
+    1024: "Int64",
+    1280: "UInt64",
+    1792: "CFloat64",
+}
+
+# (header size, format name, struct layout of the fields used) of NIfTI-1 and -2
+_NIFTI_FORMATS = {
+    348: (
+        "NIfTI-1.1",
+        [
+            ("dim", 40, "8h"),
+            ("datatype", 70, "h"),
+            ("pixdim", 76, "8f"),
+            ("vox_offset", 108, "f"),
+            ("scl", 112, "2f"),
+            ("codes", 252, "2h"),
+            ("quatern", 256, "6f"),
+            ("srow", 280, "12f"),
+        ],
+    ),
+    540: (
+        "NIfTI-2",
+        [
+            ("datatype", 12, "h"),
+            ("dim", 16, "8q"),
+            ("pixdim", 104, "8d"),
+            ("vox_offset", 168, "q"),
+            ("scl", 176, "2d"),
+            ("codes", 344, "2i"),
+            ("quatern", 352, "6d"),
+            ("srow", 400, "12d"),
+        ],
+    ),
+}
+
+
+def read_nifti_header(path: str) -> ImageHeader:
+    """ read the header of a NIfTI-1/2 image (.nii or .nii.gz)
+
+        Only the first 540 bytes of the file are read (decompressed). Unlike in
+        MRtrix3, the axes are reported as stored, i.e. the transform and layout
+        are not realigned to the closest match of the scanner axes.
+    """
+    with (gzip.open if str(path).endswith(".gz") else open)(path, "rb") as f:
+        raw = f.read(540)
+    size = None
+    for byteorder, suffix in (("<", "LE"), (">", "BE")):
+        candidate = struct.unpack(byteorder + "i", raw[:4])[0] if len(raw) >= 4 else 0
+        if candidate in _NIFTI_FORMATS and len(raw) >= candidate:
+            size = candidate
+            break
+    if size is None:
+        raise ValueError(f"'{path}' is not a NIfTI image")
+    format_name, layout = _NIFTI_FORMATS[size]
+    fields = {
+        name: struct.unpack_from(byteorder + fmt, raw, offset)
+        for name, offset, fmt in layout
+    }
+    ndim = fields["dim"][0]
+    dim = tuple(int(d) for d in fields["dim"][1 : ndim + 1])
+    pixdim = fields["pixdim"]
+    try:
+        datatype = NIFTI_DATATYPES[fields["datatype"][0]]
+    except KeyError:
+        raise ValueError(f"unsupported NIfTI datatype {fields['datatype'][0]}")
+    if datatype not in ("UInt8", "Int8"):
+        datatype += suffix
+    slope, inter = fields["scl"]
+    qform_code, sform_code = fields["codes"]
+    if sform_code > 0:
+        affine = np.array(fields["srow"], dtype=np.float64).reshape(3, 4)
+    elif qform_code > 0:
+        affine = _quaternion_affine(fields["quatern"], pixdim)
+    else:
+        affine = np.zeros((3, 4))
+        affine[:, :3] = np.diag(pixdim[1:4])
+    # MRtrix3 holds the transform without the voxel sizes
+    norms = np.linalg.norm(affine[:, :3], axis=0)
+    affine[:, :3] /= np.where(norms > 0, norms, 1.0)
+    return ImageHeader(
+        dim=dim,
+        vox=tuple(float(v) for v in pixdim[1 : ndim + 1]),
+        layout=",".join(f"+{i}" for i in range(ndim)),
+        datatype=datatype,
+        transform=(affine + 0.0).tolist(),
+        # a zero slope means the intensities are unscaled
+        scaling=(float(inter), float(slope)) if slope != 0 else (0.0, 1.0),
+        files=[(".", int(fields["vox_offset"][0]))],
+        path=str(path),
+        format=format_name,
+    )
+
+
+def _quaternion_affine(quatern, pixdim) -> np.ndarray:
+    b, c, d, qx, qy, qz = quatern
+    a = np.sqrt(max(1.0 - (b * b + c * c + d * d), 0.0))
+    rotation = np.array(
+        [
+            [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+            [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+            [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b],
+        ]
+    )
+    # qfac (pixdim[0]) of -1 flips the third axis
+    rotation[:, 2] *= -1.0 if pixdim[0] < 0 else 1.0
+    return np.column_stack([rotation, [qx, qy, qz]])
+
+
+def read_image_header(path: str) -> ImageHeader:
+    """ read only the header of a .mif/.mih/.mif.gz/.nii/.nii.gz image
+
+        Example
+        -------
+        >>> import gzip, struct
+        >>> import numpy as np
+        >>> from pydra.tasks.mrtrix3.image import read_image_header
+        >>> hdr = bytearray(352)
+        >>> struct.pack_into("<i", hdr, 0, 348)
+        >>> struct.pack_into("<8h", hdr, 40, 4, 96, 96, 60, 65, 1, 1, 1)
+        >>> struct.pack_into("<2h", hdr, 70, 16, 32)
+        >>> struct.pack_into("<8f", hdr, 76, 1, 2.5, 2.5, 2.5, 8.7, 0, 0, 0)
+        >>> struct.pack_into("<f", hdr, 108, 352)
+        >>> struct.pack_into("<2h", hdr, 252, 0, 1)
+        >>> struct.pack_into("<12f", hdr, 280, 2.5, 0, 0, -120, 0, 2.5, 0, -120,
+        ...                  0, 0, 2.5, -75)
+        >>> with gzip.open("header_only.nii.gz", "wb") as f:
+        ...     _ = f.write(bytes(hdr))
+        >>> header = read_image_header("header_only.nii.gz")
+        >>> header.dim, header.datatype, header.format
+        ((96, 96, 60, 65), 'Float32LE', 'NIfTI-1.1')
+        >>> header.to_json()["transform"][0]
+        [1.0, 0.0, 0.0, -120.0]
+
+        The axes are realigned as MRtrix3 does on loading the image, so that the
+        header of a radiological (LAS) image matches ``mrconvert -json_export``:
+
+        >>> struct.pack_into("<4f", hdr, 280, -2.5, 0, 0, 117.5)
+        >>> with gzip.open("header_las.nii.gz", "wb") as f:
+        ...     _ = f.write(bytes(hdr))
+        >>> header = read_image_header("header_las.nii.gz")
+        >>> header.layout, header.to_json()["transform"][0]
+        ('-0,+1,+2,+3', [1.0, 0.0, 0.0, -120.0])
+    """
+    path = str(path)
+    if path.endswith((".mif", ".mih", ".mif.gz")):
+        return realign(read_header(path))
+    if path.endswith((".nii", ".nii.gz")):
+        return realign(read_nifti_header(path))
+    raise ValueError(f"unrecognised image format of '{path}'")
+
+
+def realign(header: ImageHeader) -> ImageHeader:
+    """ permute and flip the spatial axes to best match the scanner axes
+
+        This is what MRtrix3 does on loading an image, so e.g. a radiological
+        (LAS) NIfTI image is presented with its first axis flipped. The data on
+        disk are left as they are: the change is absorbed by the layout.
+    """
+    if header.ndim < 3 or not header.transform:
+        return header
+    transform = np.array(header.transform, dtype=np.float64)[:3]
+    linear = transform[:, :3]
+    # image axis closest to each scanner axis, disambiguated as in MRtrix3
+    perm = [int(np.argmax(np.abs(linear[row]))) for row in range(3)]
+
+    def not_any_of(a, b):
+        return next(i for i in range(3) if i not in (a, b))
+
+    if perm[0] == perm[1]:
+        perm[1] = not_any_of(perm[0], perm[2])
+    if perm[0] == perm[2]:
+        perm[2] = not_any_of(perm[0], perm[1])
+    if perm[1] == perm[2]:
+        perm[2] = not_any_of(perm[0], perm[1])
+    flips = [linear[row, perm[row]] < 0 for row in range(3)]
+    if perm == [0, 1, 2] and not any(flips):
+        return header
+    layout = parse_layout(header.layout)
+    for row, axis in enumerate(perm):
+        if flips[row]:
+            transform[:, 3] += (
+                (header.dim[axis] - 1) * header.vox[axis] * transform[:, axis]
+            )
+            transform[:, axis] *= -1
+            sign, order = layout[axis]
+            layout[axis] = (-sign, order)
+    axes = perm + list(range(3, header.ndim))
+    transform[:, :3] = transform[:, perm]
+    return attr.evolve(
+        header,
+        dim=tuple(header.dim[ax] for ax in axes),
+        vox=tuple(header.vox[ax] for ax in axes),
+        layout=",".join(
+            f"{'+' if layout[ax][0] > 0 else '-'}{layout[ax][1]}" for ax in axes
+        ),
+        transform=(transform + 0.0).tolist(),
+    )
+
+
+@attr.s(auto_attribs=True)
+class Image:
+    """ MRtrix3 image with its voxel data memory-mapped from disk """
+
+    header: ImageHeader
+    data: np.ndarray
+
+    @property
+    def scaled(self) -> np.ndarray:
+        """ voxel intensities with the header scaling applied (loads the data) """
+        offset, scale = self.header.scaling
+        if (offset, scale) == (0.0, 1.0):
+            return np.asarray(self.data)
+        return offset + scale * np.asarray(self.data, dtype=np.float64)
+
+
+def memmap_data(header: ImageHeader, mode: str = "r") -> np.ndarray:
+    """ map the voxel data described by a header, with axes in image order
+
+    The returned array is a view onto a :class:`numpy.memmap`, so no data are
+    read until they are accessed.
+    """
+    fname, offset = header.data_file
+    if fname.endswith(".gz"):
+        raise ValueError(f"compressed image '{fname}' cannot be memory-mapped")
+    disk_order = header.disk_order()
+    mapped = np.memmap(
+        fname,
+        dtype=header.dtype,
+        mode=mode,
+        offset=offset,
+        shape=header.storage_shape(),
+    )
+    data = mapped.transpose([disk_order.index(ax) for ax in range(header.ndim)])
+    flips = tuple(
+        slice(None, None, -1) if sign < 0 else slice(None)
+        for sign, _ in parse_layout(header.layout)
+    )
+    return data[flips]
+
+
+def load_mif(path: str, mode: str = "r") -> Image:
+    """ load an MRtrix3 .mif/.mih image, memory-mapping its voxel data """
+    header = read_header(path)
+    return Image(header=header, data=memmap_data(header, mode=mode))
+
+
+def scanner_to_voxel(header: ImageHeader) -> np.ndarray:
+    """ 3x4 transform of scanner coordinates (mm) to voxel coordinates """
+    if header.transform:
+        transform = np.array(header.transform, dtype=np.float64)[:3]
+    else:
+        transform = np.eye(4)[:3]
+    linear = transform[:, :3] * np.asarray(header.vox[:3], dtype=np.float64)
+    inverse = np.linalg.inv(linear)
+    return np.column_stack([inverse, -inverse @ transform[:, 3]])
+
+
+class VoxelLookup:
+    """ nearest-neighbour lookup of the values of the first volume of a memory-mapped
+        (uncompressed .mif/.mih or NIfTI) image at scanner coordinates
+    """
+
+    def __init__(self, path: str):
+        self.header = read_image_header(path)
+        data = memmap_data(self.header)
+        if data.ndim > 3:
+            data = data[(Ellipsis,) + (0,) * (data.ndim - 3)]
+        offset, scale = self.header.scaling
+        if (offset, scale) != (0.0, 1.0):
+            data = offset + scale * np.asarray(data, dtype=np.float64)
+        self.data = data
+        self.transform = scanner_to_voxel(self.header)
+        self.shape = np.array(self.data.shape[:3])
+
+    def voxels(self, points: np.ndarray) -> np.ndarray:
+        """ indices of the voxels nearest to N points, which may lie outside the image """
+        coords = points @ self.transform[:, :3].T + self.transform[:, 3]
+        return np.rint(coords).astype(np.int64)
+
+    def values(self, voxels: np.ndarray, fill=0) -> np.ndarray:
+        """ values of N voxels, ``fill`` for those outside the image """
+        inside = np.all((voxels >= 0) & (voxels < self.shape), axis=1)
+        dtype = np.result_type(self.data.dtype, np.asarray(fill).dtype)
+        values = np.full(len(voxels), fill, dtype=dtype)
+        x, y, z = voxels[inside].T
+        values[inside] = self.data[x, y, z]
+        return values
+
+    def __call__(self, points: np.ndarray, fill=0) -> np.ndarray:
+        """ values at N points (N x 3 scanner coordinates) """
+        return self.values(self.voxels(points), fill=fill)
+
+
+def _format_values(values) -> str:
+    return ",".join(
+        str(v) if isinstance(v, (int, np.integer)) else repr(float(v)) for v in values
+    )
+
+
+def format_header(header: ImageHeader, alignment: int = 16) -> bytes:
+    """ render a header in MRtrix3 format, padded to the start of its data
+
+        For .mif images (a single data file named '.') the data offset is chosen to
+        fall just after the header, rounded up to a multiple of ``alignment``.
+    """
+    lines = [
+        "mrtrix image",
+        "dim: " + _format_values(header.dim),
+        "vox: " + _format_values(header.vox),
+        "layout: " + header.layout,
+        "datatype: " + header.datatype,
+    ]
+    lines += ["transform: " + _format_values(row) for row in header.transform[:3]]
+    if tuple(header.scaling) != (0.0, 1.0):
+        lines.append("scaling: " + _format_values(header.scaling))
+    lines += ["dw_scheme: " + _format_values(row) for row in header.dw_scheme]
+    for key, value in header.keyval.items():
+        lines += [f"{key}: {v}" for v in str(value).split("\n")]
+    text = "".join(line + "\n" for line in lines).encode("utf-8")
+    if [fname for fname, _ in header.files] != ["."]:
+        files = "".join(f"file: {fname} {offset}\n" for fname, offset in header.files)
+        return text + files.encode("utf-8") + b"END\n"
+    return terminate_header(text, alignment)
+
+
+def terminate_header(text: bytes, alignment: int = 16) -> bytes:
+    """ append the 'file: . <offset>' and END lines to a header, padding it so the
+        data (stored in the same file) start at a multiple of ``alignment``
+    """
+    # the offset is part of the header, so iterate until its length settles
+    offset = 0
+    while True:
+        tail = f"file: . {offset}\nEND\n".encode("utf-8")
+        required = -(-(len(text) + len(tail)) // alignment) * alignment
+        if required == offset:
+            return (text + tail).ljust(offset, b"\0")
+        offset = required
+
+
+class ImageWriter:
+    """ write an MRtrix3 .mif/.mih image slab-by-slab along its last axis
+
+        The header is written and the data region allocated up front; slabs are
+        then copied into a memory-mapped view of the output file, so that no more
+        than one slab needs to be held in memory at a time. Slabs may have either
+        the full image dimensionality (with any extent along the last axis) or one
+        dimension less (a single position along the last axis).
+
+        Example
+        -------
+        >>> import numpy as np
+        >>> from pydra.tasks.mrtrix3.image import ImageHeader, ImageWriter, load_mif
+        >>> header = ImageHeader(
+        ...     dim=(2, 2, 1, 3), vox=(2.0, 2.0, 2.0, 1.0),
+        ...     layout="+0,+1,+2,+3", datatype="Float32LE",
+        ...     dw_scheme=[[0, 0, 1, 0], [1, 0, 0, 1000], [0, 1, 0, 1000]],
+        ... )
+        >>> with ImageWriter("written.mif", header) as writer:
+        ...     for volume in range(3):
+        ...         writer.write(np.full((2, 2, 1), volume))
+        >>> img = load_mif("written.mif")
+        >>> img.data[..., 2].tolist()
+        [[[2.0], [2.0]], [[2.0], [2.0]]]
+        >>> img.header.dw_scheme[1]
+        [1.0, 0.0, 0.0, 1000.0]
+    """
+
+    def __init__(self, path: str, header: ImageHeader):
+        self.path = str(path)
+        self.header = create_image(self.path, header)
+        self.data = memmap_data(self.header, mode="r+")
+        self.position = 0
+
+    def write(self, slab):
+        """ copy the next slab of data into the image """
+        slab = np.asarray(slab)
+        if slab.ndim == self.header.ndim - 1:
+            slab = slab[..., np.newaxis]
+        end = self.position + slab.shape[-1]
+        if end > self.header.dim[-1]:
+            raise ValueError(
+                f"slab overruns the last image axis ({end} > {self.header.dim[-1]})"
+            )
+        self.data[..., self.position : end] = slab
+        self.data.flush()
+        self.position = end
+
+    def close(self):
+        """ flush the output and release the memory map """
+        if self.data is None:
+            return
+        self.data.flush()
+        self.data = None
+        if self.position != self.header.dim[-1]:
+            raise ValueError(
+                f"only {self.position} of {self.header.dim[-1]} positions along the "
+                f"last axis of '{self.path}' were written"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.data = None
+
+
+def create_image(path: str, header: ImageHeader) -> ImageHeader:
+    """ write the header of a .mif/.mih image and allocate its data region
+
+        Returns the header as written, with the location of the data filled in.
+    """
+    path = str(path)
+    if path.endswith(".mih"):
+        files = [(os.path.basename(path)[:-4] + ".dat", 0)]
+    elif path.endswith(".mif"):
+        files = [(".", 0)]
+    else:
+        raise ValueError(f"'{path}' is not a .mif or .mih file")
+    if not header.transform:
+        header = attr.evolve(
+            header, transform=[[float(i == j) for j in range(4)] for i in range(3)]
+        )
+    text = format_header(attr.evolve(header, files=files))
+    if files[0][0] == ".":
+        files = [(".", len(text))]
+    header = attr.evolve(header, files=files, path=path)
+    with open(path, "wb") as f:
+        f.write(text)
+    data_path, offset = header.data_file
+    _preallocate(data_path, offset + header.nbytes)
+    return header
+
+
+def _preallocate(path: str, size: int):
+    with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except (AttributeError, OSError):
+            # not every platform/file system supports allocation up front
+            pass
+        f.truncate(size)
+
+
+def save_mif(
+    path: str,
+    data: ty.Union[np.ndarray, ty.Iterable[np.ndarray]],
+    header: ImageHeader,
+    slab_size: int = 1,
+) -> ImageHeader:
+    """ write an array, or an iterable of slabs along the last axis, to a .mif/.mih
+
+        Arrays (including memory maps) are copied ``slab_size`` positions of their
+        last axis at a time.
+    """
+    if isinstance(data, np.ndarray):
+        array = data
+        data = (
+            array[..., i : i + slab_size] for i in range(0, array.shape[-1], slab_size)
+        )
+    with ImageWriter(path, header) as writer:
+        for slab in data:
+            writer.write(slab)
+    return writer.header
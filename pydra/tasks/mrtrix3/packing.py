@@ -0,0 +1,301 @@
+"""
+Packing of many small MRtrix3 tasks into a few scheduler jobs.
+
+Submitting each task as a job of its own (as pydra's slurm worker does) swamps
+the queue of the scheduler when there are thousands of short tasks, such as
+conversions. :func:`pack_tasks` instead groups the tasks into packs, saved to a
+shared directory, each of which is run within a single allocation: an element of
+a job array (:meth:`TaskPacks.array_script`) or a node of a multi-node
+allocation (:meth:`TaskPacks.nodes_script`). Within its allocation, a pack runs
+its tasks on a pool of processes, as many at a time as there are cores, and sets
+``nthreads`` of the tasks that leave it unset so that the cores are filled. The
+timing of each task is appended to a report next to the pack
+(:meth:`TaskPacks.timings`) as soon as it finishes.
+
+The directory of the packs, the cache directory of the tasks and their inputs
+must be on storage shared with the nodes. Tasks left with pydra's default cache
+directory (a temporary one, local to the submitting machine) are given one in
+the directory of the packs. Setting ``nthreads`` changes the checksums of the
+tasks, so their results are found from the reports of the packs
+(:meth:`TaskPacks.results`).
+
+Example
+-------
+>>> from pydra.tasks.mrtrix3.packing import pack_tasks
+>>> from pydra.tasks.mrtrix3.utils import MRConvert
+>>> tasks = [
+...     MRConvert(in_file="test_dwi.nii.gz", out_file=f"dwi_{i}.mif")
+...     for i in range(10)
+... ]
+>>> packs = pack_tasks(tasks, "packs", per_pack=4, ncores=8)
+>>> packs.sizes
+[4, 3, 3]
+>>> print(packs.array_script(python="python"))  # doctest: +ELLIPSIS
+#!/bin/bash
+#SBATCH --job-name=pydra-mrtrix3
+#SBATCH --array=0-2
+#SBATCH --cpus-per-task=8
+#SBATCH --mem=4G
+python -m pydra.tasks.mrtrix3.packing .../packs --pack "$SLURM_ARRAY_TASK_ID"
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import typing as ty
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import attr
+import cloudpickle as cp
+from .convert import shutdown_pool
+from .threads import available_cores
+
+
+#: memory (in GB) assumed for tasks without resources (see
+#: :class:`~pydra.tasks.mrtrix3.workflows.StageResources`)
+DEFAULT_MEM_GB = 1.0
+
+
+def _pack_path(pack_dir: Path, index: int, suffix: str) -> Path:
+    return pack_dir / f"pack_{index:04d}{suffix}"
+
+
+class TaskPacks:
+    """ packs of tasks saved to a directory, to be run by scheduler jobs """
+
+    def __init__(self, pack_dir: str):
+        self.pack_dir = Path(pack_dir).absolute()
+        plan = json.loads((self.pack_dir / "plan.json").read_text())
+        self.ncores = plan["ncores"]
+        self.sizes = plan["sizes"]
+        self.mem_gb = plan["mem_gb"]
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def _script(
+        self,
+        job_name: ty.Optional[str],
+        extra: ty.Sequence[str],
+        allocation: ty.List[str],
+        command: str,
+    ) -> str:
+        lines = [
+            "#!/bin/bash",
+            f"#SBATCH --job-name={job_name or 'pydra-mrtrix3'}",
+            *allocation,
+            f"#SBATCH --cpus-per-task={self.ncores}",
+            f"#SBATCH --mem={math.ceil(max(self.mem_gb))}G",
+            *(f"#SBATCH {option}" for option in extra),
+            command,
+        ]
+        return "\n".join(lines)
+
+    def array_script(
+        self,
+        job_name: ty.Optional[str] = None,
+        extra: ty.Sequence[str] = (),
+        python: ty.Optional[str] = None,
+    ) -> str:
+        """ sbatch script of a job array running one pack per element
+
+            ``extra`` options (e.g. "--time=1:00:00") are added to the header.
+        """
+        return self._script(
+            job_name,
+            extra,
+            [f"#SBATCH --array=0-{len(self) - 1}"],
+            f"{python or sys.executable} -m {__name__} {self.pack_dir} "
+            '--pack "$SLURM_ARRAY_TASK_ID"',
+        )
+
+    def nodes_script(
+        self,
+        nodes: int,
+        job_name: ty.Optional[str] = None,
+        extra: ty.Sequence[str] = (),
+        python: ty.Optional[str] = None,
+    ) -> str:
+        """ sbatch script of a single allocation of ``nodes`` nodes, each running
+            every ``nodes``-th pack in turn
+        """
+        return self._script(
+            job_name,
+            extra,
+            [f"#SBATCH --nodes={nodes}", "#SBATCH --ntasks-per-node=1"],
+            f"srun {python or sys.executable} -m {__name__} {self.pack_dir}",
+        )
+
+    def timings(self) -> ty.List[dict]:
+        """ records of the tasks run so far, in the order they finished within
+            each pack
+        """
+        records = []
+        for index in range(len(self)):
+            report = _pack_path(self.pack_dir, index, ".jsonl")
+            if report.exists():
+                records.extend(
+                    json.loads(line) for line in report.read_text().splitlines()
+                )
+        return records
+
+    def results(self) -> ty.List[ty.Optional[ty.Any]]:
+        """ pydra results of the tasks, in the order they were packed (None for
+            those that haven't run successfully)
+        """
+        results = [None] * sum(self.sizes)
+        for record in self.timings():
+            result_file = Path(record["output_dir"]) / "_result.pklz"
+            if record["status"] == "ok" and result_file.exists():
+                results[record["task"]] = cp.loads(result_file.read_bytes())
+        return results
+
+
+def pack_tasks(
+    tasks: ty.Sequence[ty.Any],
+    pack_dir: str,
+    per_pack: int,
+    ncores: ty.Optional[int] = None,
+) -> TaskPacks:
+    """ save the tasks in packs of at most ``per_pack`` (of as even sizes as
+        possible), to be run by allocations of ``ncores`` cores (by default
+        those of this machine)
+    """
+    if not tasks:
+        raise ValueError("no tasks to pack")
+    pack_dir = Path(pack_dir).absolute()
+    pack_dir.mkdir(parents=True, exist_ok=True)
+    ncores = ncores or available_cores()
+    npacks = math.ceil(len(tasks) / per_pack)
+    size, remainder = divmod(len(tasks), npacks)
+    sizes = [size + (i < remainder) for i in range(npacks)]
+    default_cache = Path(tempfile.gettempdir()).resolve()
+    mem_gb = []
+    start = 0
+    for index, size in enumerate(sizes):
+        numbered = list(enumerate(tasks[start : start + size], start))
+        start += size
+        for _, task in numbered:
+            if default_cache in Path(task.cache_dir).parents:
+                task.cache_dir = pack_dir / "cache"
+        # the largest tasks may run at once
+        needs = sorted(
+            (
+                getattr(getattr(task, "resources", None), "mem_gb", DEFAULT_MEM_GB)
+                for _, task in numbered
+            ),
+            reverse=True,
+        )
+        mem_gb.append(sum(needs[:ncores]))
+        report = _pack_path(pack_dir, index, ".jsonl")
+        if report.exists():
+            report.unlink()
+        _pack_path(pack_dir, index, ".pkl").write_bytes(cp.dumps(numbered))
+    plan = {"ncores": ncores, "sizes": sizes, "mem_gb": mem_gb}
+    (pack_dir / "plan.json").write_text(json.dumps(plan, indent=2))
+    return TaskPacks(pack_dir)
+
+
+def _run_packed(number: int, payload: bytes, nthreads: int) -> dict:
+    """ run a task of a pack, returning the record of its timing """
+    task = cp.loads(payload)
+    if hasattr(task.inputs, "nthreads"):
+        if task.inputs.nthreads in (None, attr.NOTHING):
+            task.inputs = attr.evolve(task.inputs, nthreads=nthreads)
+        nthreads = task.inputs.nthreads
+    record = {
+        "task": number,
+        "name": task.name or type(task).__name__,
+        "nthreads": nthreads,
+        "output_dir": str(task.output_dir),
+        "start": time.time(),
+    }
+    started = time.perf_counter()
+    try:
+        result = task()
+    except Exception as e:
+        record.update(status="error", error=f"{type(e).__name__}: {e}")
+    else:
+        record["status"] = "error" if result.errored else "ok"
+    finally:
+        # the conversion pool would keep the worker from exiting
+        shutdown_pool()
+    record["wall"] = time.perf_counter() - started
+    return record
+
+
+def run_pack(
+    pack_dir: str, index: int, ncores: ty.Optional[int] = None
+) -> ty.List[dict]:
+    """ run the tasks of a pack on the cores of this allocation, returning their
+        records (which are also appended to the report of the pack)
+    """
+    pack_dir = Path(pack_dir)
+    numbered = cp.loads(_pack_path(pack_dir, index, ".pkl").read_bytes())
+    ncores = ncores or available_cores()
+    workers = max(min(len(numbered), ncores), 1)
+    nthreads = max(ncores // workers, 1)
+    jobs = [(number, cp.dumps(task), nthreads) for number, task in numbered]
+    report = _pack_path(pack_dir, index, ".jsonl")
+    records = []
+
+    def add(record):
+        record["pack"] = index
+        records.append(record)
+        with open(report, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    pending = jobs
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            try:
+                futures = [pool.submit(_run_packed, *job) for job in jobs]
+            except AssertionError:
+                # a daemonic worker process, which can't start a pool itself
+                futures = []
+            else:
+                pending = []
+            for future in as_completed(futures):
+                add(future.result())
+    for job in pending:
+        add(_run_packed(*job))
+    return records
+
+
+def main(argv: ty.Optional[ty.Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog=f"python -m {__name__}",
+        description="Run packs of tasks saved by pack_tasks",
+    )
+    parser.add_argument("pack_dir", help="directory of the packs")
+    parser.add_argument(
+        "--pack",
+        type=int,
+        help="pack to run (default: every SLURM_NTASKS-th pack from SLURM_PROCID)",
+    )
+    parser.add_argument("--ncores", type=int, help="cores of the allocation")
+    args = parser.parse_args(argv)
+    if args.pack is not None:
+        indices = [args.pack]
+    else:
+        first = int(os.environ.get("SLURM_PROCID", 0))
+        stride = int(os.environ.get("SLURM_NTASKS", 1))
+        indices = range(first, len(TaskPacks(args.pack_dir)), stride)
+    failed = 0
+    for index in indices:
+        records = run_pack(args.pack_dir, index, args.ncores)
+        failed += sum(record["status"] != "ok" for record in records)
+        for record in records:
+            print(
+                f"pack {index} task {record['task']} ({record['name']}): "
+                f"{record['status']} in {record['wall']:.1f}s "
+                f"with {record['nthreads']} threads"
+            )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Resumable tckgen runs, split into independently seeded partitions.
+
+The output of tckgen is only a valid tractogram once the command has finished,
+so a long run that is interrupted (e.g. a pre-empted cluster job) is lost as a
+whole. :class:`PartitionedTracking` instead splits the selection (and the
+number of seeds, if limited) of a :class:`~pydra.tasks.mrtrix3.tractography.TckGen`
+task between a number of partitions. Each partition is a tckgen run of its
+own, with its own random seed (``MRTRIX_RNG_SEED``). The partitions run
+concurrently and share the threads of the task. Each finished partition is
+checkpointed: its tractogram is moved into the checkpoint directory and a
+record of it is written next to it. When the same task is run again, only the
+partitions without a checkpoint are run. The partitions are then streamed into
+the output, block by block, without parsing the streamlines (see
+:meth:`~pydra.tasks.mrtrix3.streamlines.TckWriter.append_tck`).
+
+The checkpoint directory defaults to one under the cache directory of the
+package (``$XDG_CACHE_HOME/pydra-mrtrix3/tckgen``). It is named after a
+fingerprint of the command and its input files, so that it outlives the output
+directory of the task, which pydra clears when the task is rerun. Partitions
+can also be run on several nodes sharing the checkpoint directory, by passing
+each node the indices of its partitions, and then merged once all have
+finished.
+
+Example
+-------
+>>> from pydra.tasks.mrtrix3.tractography import TckGen
+>>> from pydra.tasks.mrtrix3.partitioned_tracking import PartitionedTracking
+>>> task = TckGen(in_file="test_dwi.nii.gz", out_file="tracks.tck", select=10,
+...               seed_image=["test_dwi.nii.gz"], rng_seed=100)
+>>> tracking = PartitionedTracking(task, 4, checkpoint_dir="checkpoints")
+>>> [(p.select, p.seed) for p in tracking.partitions]
+[(3, 100), (3, 101), (2, 102), (2, 103)]
+>>> tracking.pending()
+[0, 1, 2, 3]
+"""
+import hashlib
+import json
+import os
+import shutil
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor
+import attr
+from .streamlines import TckWriter, read_tck_header
+from .threads import available_cores
+
+
+#: version of the layout of the checkpoint directory
+CHECKPOINT_VERSION = 1
+
+
+def rng_seed_environment(seed: ty.Optional[int]) -> ty.Dict[str, str]:
+    """ variables to add to the environment of commands so that they use a seed
+        for their random numbers, if one is given
+    """
+    if seed in (None, attr.NOTHING):
+        return {}
+    return {"MRTRIX_RNG_SEED": str(seed)}
+
+
+def split(total: int, nparts: int) -> ty.List[int]:
+    """ shares of a total, as even as possible """
+    share, remainder = divmod(total, nparts)
+    return [share + (i < remainder) for i in range(nparts)]
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class Partition:
+    """ a tckgen run generating part of a tractogram """
+
+    index: int
+    seed: int
+    select: int
+    seeds: ty.Optional[int] = None
+
+
+def _is_set(value) -> bool:
+    return value not in (None, attr.NOTHING)
+
+
+class PartitionedTracking:
+    """ the partitions of the tckgen run of a
+        :class:`~pydra.tasks.mrtrix3.tractography.TckGen` task, and their
+        checkpoints
+    """
+
+    def __init__(self, task, npartitions: int, checkpoint_dir: ty.Optional[str] = None):
+        inputs = task.inputs
+        if not _is_set(inputs.select) or inputs.select <= 0:
+            raise ValueError("partitioned tracking requires the selection to be set")
+        if _is_set(inputs.output_seeds):
+            raise ValueError("output_seeds is not supported by partitioned tracking")
+        self.task = task
+        self.npartitions = npartitions
+        self.fingerprint = self._fingerprint()
+        if _is_set(inputs.rng_seed):
+            base_seed = inputs.rng_seed
+        else:
+            base_seed = int(self.fingerprint[:7], 16)
+        if not _is_set(checkpoint_dir):
+            from .capabilities import cache_root
+
+            checkpoint_dir = os.path.join(cache_root(), "tckgen", self.fingerprint[:32])
+        self.checkpoint_dir = os.path.abspath(checkpoint_dir)
+        seeds = inputs.seeds if _is_set(inputs.seeds) and inputs.seeds > 0 else None
+        self.partitions = [
+            Partition(
+                index=i,
+                seed=base_seed + i,
+                select=select,
+                seeds=None if seeds is None else split(seeds, npartitions)[i],
+            )
+            for i, select in enumerate(split(inputs.select, npartitions))
+        ]
+
+    def _args(self, **changes) -> ty.List[str]:
+        """ the command with the given inputs changed """
+        original = self.task.inputs
+        self.task.inputs = attr.evolve(original, **changes)
+        try:
+            args = self.task.command_args
+        finally:
+            self.task.inputs = original
+        return [str(a) for a in args if a not in ["", " "]]
+
+    def _fingerprint(self) -> str:
+        """ hash of the command (but for its output and threads), the partitioning
+            and the sizes and modification times of the input files
+        """
+        args = self._args(out_file="out.tck", nthreads=None)
+        files = [
+            [path, os.stat(path).st_size, os.stat(path).st_mtime_ns]
+            for path in sorted(self.task._input_files())
+        ]
+        key = [args, files, self.npartitions, self.task.inputs.rng_seed]
+        return hashlib.sha256(json.dumps(key, default=str).encode()).hexdigest()
+
+    def _path(self, partition: Partition, suffix: str = ".tck") -> str:
+        return os.path.join(self.checkpoint_dir, f"part_{partition.index:04d}{suffix}")
+
+    def _prepare(self):
+        """ create the checkpoint directory, or check that it is for this run """
+        plan_path = os.path.join(self.checkpoint_dir, "plan.json")
+        plan = {
+            "version": CHECKPOINT_VERSION,
+            "fingerprint": self.fingerprint,
+            "partitions": [attr.asdict(p) for p in self.partitions],
+        }
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        if os.path.exists(plan_path):
+            with open(plan_path) as f:
+                existing = json.load(f)
+            if existing != plan:
+                raise ValueError(
+                    f"{self.checkpoint_dir} holds the checkpoints of a different "
+                    "tckgen run"
+                )
+            return
+        _write_json(plan_path, plan)
+
+    def completed(self) -> ty.List[int]:
+        """ indices of the partitions with a valid checkpoint """
+        done = []
+        for partition in self.partitions:
+            try:
+                with open(self._path(partition, ".json")) as f:
+                    record = json.load(f)
+                size = os.path.getsize(self._path(partition))
+            except (OSError, ValueError):
+                continue
+            if record.get("size") == size and record.get("seed") == partition.seed:
+                done.append(partition.index)
+        return done
+
+    def pending(self) -> ty.List[int]:
+        """ indices of the partitions still to be run """
+        done = set(self.completed())
+        return [p.index for p in self.partitions if p.index not in done]
+
+    def run(
+        self,
+        indices: ty.Optional[ty.Iterable[int]] = None,
+        workers: ty.Optional[int] = None,
+        nthreads: ty.Optional[int] = None,
+    ) -> ty.List[int]:
+        """ run the partitions (all, or those of the given indices) that have not
+            been checkpointed, returning the indices of those run
+
+            ``workers`` partitions (by default as many as the threads allow) are
+            run at a time, sharing ``nthreads`` threads (by default those of the
+            task, or all the available cores).
+        """
+        self._prepare()
+        wanted = set(range(self.npartitions) if indices is None else indices)
+        pending = [p for p in self.partitions if p.index in wanted]
+        done = set(self.completed())
+        pending = [p for p in pending if p.index not in done]
+        if not pending:
+            return []
+        if not _is_set(nthreads):
+            nthreads = self.task.inputs.nthreads
+        if not _is_set(nthreads):
+            nthreads = available_cores()
+        workers = workers or max(min(len(pending), nthreads), 1)
+        share = max(nthreads // workers, 1)
+        self.task._check_capabilities([self._partition_args(pending[0], share)])
+        with ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(self._run_partition, p, share) for p in pending]
+            errors = [f.exception() for f in futures]
+        failed = [e for e in errors if e is not None]
+        if failed:
+            raise RuntimeError(
+                f"{len(failed)} of {len(pending)} tckgen partitions failed, the "
+                f"first with: {failed[0]}"
+            )
+        return [p.index for p in pending]
+
+    def _partition_args(self, partition: Partition, nthreads: int) -> ty.List[str]:
+        changes = {
+            "select": partition.select,
+            "out_file": self._path(partition, ".partial.tck"),
+            "nthreads": nthreads,
+        }
+        if partition.seeds is not None:
+            changes["seeds"] = partition.seeds
+        return self._args(**changes)
+
+    def _run_partition(self, partition: Partition, nthreads: int):
+        partial = self._path(partition, ".partial.tck")
+        if os.path.exists(partial):
+            # left behind by an interrupted run
+            os.unlink(partial)
+        env = dict(
+            self.task._command_environment(), MRTRIX_RNG_SEED=str(partition.seed)
+        )
+        return_code, stdout, stderr = self.task._run_process(
+            self._partition_args(partition, nthreads), env=env
+        )
+        if return_code:
+            if os.path.exists(partial):
+                os.unlink(partial)
+            raise RuntimeError(stderr or stdout)
+        count = read_tck_header(partial).count
+        os.replace(partial, self._path(partition))
+        record = {
+            **attr.asdict(partition),
+            "count": count,
+            "size": os.path.getsize(self._path(partition)),
+        }
+        _write_json(self._path(partition, ".json"), record)
+
+    def merge(self, out_file: ty.Optional[str] = None, keep: bool = False) -> int:
+        """ concatenate the partitions into the output of the task (or out_file),
+            returning the number of streamlines
+
+            The checkpoints are removed afterwards unless ``keep`` is set.
+        """
+        missing = self.pending()
+        if missing:
+            raise RuntimeError(f"partitions {missing} of the tckgen run are missing")
+        out_file = str(self.task.inputs.out_file if out_file is None else out_file)
+        headers = [read_tck_header(self._path(p)) for p in self.partitions]
+        keyval = dict(headers[0].keyval)
+        if all("total_count" in h.keyval for h in headers):
+            keyval["total_count"] = str(
+                sum(int(h.keyval["total_count"]) for h in headers)
+            )
+        tmp_path = f"{out_file}.{os.getpid()}.tmp"
+        try:
+            with TckWriter(
+                tmp_path, keyval=keyval, datatype=headers[0].datatype
+            ) as writer:
+                for partition in self.partitions:
+                    writer.append_tck(self._path(partition))
+            os.replace(tmp_path, out_file)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        if not keep:
+            shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+        return writer.header.count
+
+
+def _write_json(path: str, data: dict):
+    """ write a JSON file atomically, so that it is never seen half-written """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
@@ -0,0 +1,271 @@
+"""
+Fusing linear chains of MRtrix3 tasks into a single shell pipeline.
+
+MRtrix3 commands accept ``-`` in place of an input or output image, in which
+case the image is passed between commands as a temporary file created under
+``MRTRIX_TMPFILE_DIR`` (see :mod:`pydra.tasks.mrtrix3.tmpfiles`), whose path is
+written to the standard output of the producer and read from the standard input
+of the consumer (which deletes it).
+:func:`pipe` renders the command lines of a chain of tasks with the ``out_file``
+of each task but the last, and the ``in_file`` of each task but the first,
+replaced by ``-``, and returns a single :class:`MRTrix3Pipeline` task that runs
+them concurrently. Only the output of the last task (and any side outputs, such
+as exported gradients) lands in the task's output directory. The ``in_file`` and
+``grad_fsl`` of the first task may be connected to the outputs of other nodes of
+a workflow; they become inputs of the pipeline task.
+
+Example
+-------
+>>> from pydra.tasks.mrtrix3.utils import MRConvert
+>>> from pydra.tasks.mrtrix3.pipeline import pipe
+>>> task = pipe(
+...     MRConvert(in_file="test_dwi.nii.gz", grad_fsl=["test.bvec", "test.bval"]),
+...     MRConvert(axes=[0, 1, 2, 3], nthreads=2),
+...     MRConvert(vox=[2.0, 2.0, 2.0], out_file="dwi_2mm.mif"),
+... )
+>>> task.cmdline  # doctest: +NORMALIZE_WHITESPACE
+'mrconvert test_dwi.nii.gz -fslgrad test.bvec test.bval - | mrconvert - -nthreads 2
+ -axes 0 1 2 3 - | mrconvert - -vox 2.0 2.0 2.0 dwi_2mm.mif'
+"""
+import os
+import tempfile
+import typing as ty
+import subprocess as sp
+import attr
+from pydra.engine.specs import File, LazyField, SpecInfo, ShellSpec
+from .base import MRTrix3OutSpec, MRTrix3Task
+from .tmpfiles import AUTO, estimate_bytes
+
+
+#: image argument standing for a piped image
+PIPE = "-"
+
+#: token separating the commands of a pipeline in its command line
+SEPARATOR = "|"
+
+#: inputs of the first task that may be lazy, with the placeholders standing for
+#: them in its arguments until they are set on the pipeline task
+PLACEHOLDERS = {
+    "in_file": "{in_file}",
+    "grad_fsl": ["{grad_fsl[0]}", "{grad_fsl[1]}"],
+}
+
+
+def stage_args(task, pipe_in: bool, pipe_out: bool) -> ty.List[str]:
+    """ command line of a task with its input and/or output image piped """
+    missing = [
+        name for name in ("in_file", "out_file") if not hasattr(task.inputs, name)
+    ]
+    if missing:
+        raise ValueError(f"{task.name} has no {' or '.join(missing)} input to pipe")
+    changes = {}
+    if pipe_in:
+        changes["in_file"] = PIPE
+    if pipe_out:
+        changes["out_file"] = PIPE
+    for field in attr.fields(type(task.inputs)):
+        if field.name in changes:
+            continue
+        if isinstance(getattr(task.inputs, field.name), LazyField):
+            if pipe_in or field.name not in PLACEHOLDERS:
+                raise ValueError(
+                    f"{field.name} of {task.name} can't be connected in a pipeline, "
+                    f"only the {' and '.join(PLACEHOLDERS)} of the first task"
+                )
+            changes[field.name] = PLACEHOLDERS[field.name]
+    original = task.inputs
+    task.inputs = attr.evolve(original, **changes)
+    try:
+        if task.inputs.in_file in (None, attr.NOTHING):
+            raise ValueError(f"in_file of the first task ({task.name}) is not set")
+        if task.inputs.out_file in (None, attr.NOTHING):
+            raise ValueError(f"out_file of the last task ({task.name}) is not set")
+        return [str(a) for a in task.command_args if a not in ["", " "]]
+    finally:
+        task.inputs = original
+
+
+def pipe(*tasks, tmpfile_dir: ty.Optional[str] = None, **kwargs) -> "MRTrix3Pipeline":
+    """ fuse a linear chain of MRtrix3 tasks into a single pipeline task
+
+        The ``in_file`` of the first task and the ``out_file`` of the last must
+        be set; those in between are ignored. Other keyword arguments (e.g.
+        ``name``, ``cache_dir``) are passed on to the pipeline task.
+    """
+    if len(tasks) < 2:
+        raise ValueError("at least two tasks are required to form a pipeline")
+    last = len(tasks) - 1
+    stages = [stage_args(t, i > 0, i < last) for i, t in enumerate(tasks)]
+    if tmpfile_dir is not None:
+        kwargs["tmpfile_dir"] = tmpfile_dir
+    grad_fsl = getattr(tasks[0].inputs, "grad_fsl", None)
+    if isinstance(grad_fsl, LazyField):
+        kwargs["grad_fsl"] = grad_fsl
+    return MRTrix3Pipeline(
+        in_file=tasks[0].inputs.in_file,
+        out_file=tasks[-1].inputs.out_file,
+        stages=stages,
+        **kwargs,
+    )
+
+
+MRTrix3PipelineInputSpec = SpecInfo(
+    name="MRTrix3PipelineInputs",
+    fields=[
+        (
+            "in_file",
+            attr.ib(
+                type=File,
+                metadata={
+                    "help_string": "input image of the first command",
+                    "mandatory": True,
+                },
+            ),
+        ),
+        (
+            "out_file",
+            attr.ib(
+                type=str,
+                metadata={
+                    "help_string": "output image of the last command",
+                    "mandatory": True,
+                },
+            ),
+        ),
+        (
+            "grad_fsl",
+            attr.ib(
+                type=ty.List[File],
+                metadata={
+                    "help_string": "FSL format gradient files [bvecs, bvals] of the "
+                    "first command, when connected in a workflow",
+                },
+            ),
+        ),
+        (
+            "stages",
+            attr.ib(
+                type=ty.List[ty.List[str]],
+                metadata={
+                    "help_string": "arguments of each command, with piped images "
+                    "given as '-'",
+                    "mandatory": True,
+                },
+            ),
+        ),
+        (
+            "tmpfile_dir",
+            attr.ib(
+                type=str,
+                metadata={
+                    "help_string": "directory of the piped intermediate images, or "
+                    "'auto' (the default, unless MRTRIX_TMPFILE_DIR is set) to choose "
+                    "one with room for them (see pydra.tasks.mrtrix3.tmpfiles)",
+                },
+            ),
+        ),
+    ],
+    bases=(ShellSpec,),
+)
+
+MRTrix3PipelineOutputSpec = SpecInfo(
+    name="MRTrix3PipelineOutputs",
+    fields=[
+        (
+            "out_file",
+            attr.ib(
+                type=File,
+                metadata={
+                    "help_string": "output image of the last command",
+                    "output_file_template": "{out_file}",
+                },
+            ),
+        ),
+    ],
+    bases=(MRTrix3OutSpec,),
+)
+
+
+class MRTrix3Pipeline(MRTrix3Task):
+    """
+    Run a chain of MRtrix3 commands as a single pipeline, each command reading
+    its input image from the one before it. Usually created with :func:`pipe`.
+    The intermediate images are created in a private subdirectory of
+    ``tmpfile_dir``, on /dev/shm or local scratch by default when they fit, which
+    is removed once the pipeline finishes, so that nothing is left behind by
+    commands that fail.
+    """
+
+    input_spec = MRTrix3PipelineInputSpec
+    output_spec = MRTrix3PipelineOutputSpec
+    executable = "mrconvert"
+
+    @property
+    def command_args(self):
+        args = []
+        for stage in self._stages():
+            if args:
+                args.append(SEPARATOR)
+            args.extend(stage)
+        return args
+
+    def _stages(self) -> ty.List[ty.List[str]]:
+        """ arguments of each command, with the placeholders of the first filled in """
+        values = {PLACEHOLDERS["in_file"]: self.inputs.in_file}
+        if self.inputs.grad_fsl not in (None, attr.NOTHING):
+            values.update(zip(PLACEHOLDERS["grad_fsl"], self.inputs.grad_fsl))
+        first, *rest = self.inputs.stages
+        return [[str(values.get(a, a)) for a in first]] + rest
+
+    def _tmpfile_setting(self) -> str:
+        # piped images always go to a managed directory
+        return (
+            super()._tmpfile_setting() or os.environ.get("MRTRIX_TMPFILE_DIR") or AUTO
+        )
+
+    def _estimate_tmpfile_bytes(self) -> int:
+        # in the worst case every intermediate image exists at the same time
+        return estimate_bytes(self._input_files(), copies=len(self.inputs.stages) - 1)
+
+    def _run_command(self):
+        # the threads of each command are set in its own arguments, and
+        # MRTRIX_TMPFILE_DIR in the environment by MRTrix3Task._execute
+        stages = self._stages()
+        self._check_capabilities(stages)
+        procs, errors = [], []
+        try:
+            stdin = sp.DEVNULL
+            for args in stages:
+                errors.append(tempfile.TemporaryFile())
+                proc = self._popen(args, stdin=stdin, stdout=sp.PIPE, stderr=errors[-1])
+                if procs:
+                    # so the producer receives SIGPIPE if its consumer exits early
+                    procs[-1].stdout.close()
+                procs.append(proc)
+                stdin = proc.stdout
+            with procs[-1].stdout:
+                stdout = procs[-1].stdout.read()
+            for proc in procs:
+                self._wait(proc)
+            stderr = []
+            for args, proc, error in zip(stages, procs, errors):
+                error.seek(0)
+                text = error.read().decode("utf-8", "replace")
+                if proc.returncode:
+                    text = f"{' '.join(args)} exited with {proc.returncode}:\n{text}"
+                stderr.append(text)
+        finally:
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+            for error in errors:
+                error.close()
+        return_code = next((p.returncode for p in procs if p.returncode), 0)
+        self.output_ = {
+            "return_code": return_code,
+            "stdout": stdout.decode("utf-8", "replace"),
+            "stderr": "".join(stderr),
+        }
+        if return_code:
+            raise RuntimeError(self.output_["stderr"])
@@ -0,0 +1,378 @@
+import attr
+import typing as ty
+from pydra.engine.specs import File, SpecInfo
+from .base import (
+    MRTrix3BaseSpec,
+    MRTrix3OutSpec,
+    MRTrix3Task,
+    in_file_field,
+    out_file_field,
+    output_field,
+)
+
+
+DWIDenoiseInputSpec = SpecInfo(
+    name="DWIDenoiseInputs",
+    fields=[
+        in_file_field(),
+        out_file_field("denoised DWI image"),
+        (
+            "mask",
+            attr.ib(
+                type=File,
+                metadata={
+                    "argstr": "-mask {mask}",
+                    "help_string": "only process voxels within the mask",
+                },
+            ),
+        ),
+        (
+            "extent",
+            attr.ib(
+                type=ty.List[int],
+                metadata={
+                    "argstr": "-extent",
+                    "sep": ",",
+                    "help_string": "size of the sliding window (default 5,5,5)",
+                },
+            ),
+        ),
+        (
+            "noise",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "-noise {noise}",
+                    "help_string": "output map of the estimated noise level",
+                },
+            ),
+        ),
+    ],
+    bases=(MRTrix3BaseSpec,),
+)
+
+DWIDenoiseOutputSpec = SpecInfo(
+    name="DWIDenoiseOutputs",
+    fields=[
+        output_field("out_file", "denoised DWI image"),
+        output_field("noise", "map of the estimated noise level"),
+    ],
+    bases=(MRTrix3OutSpec,),
+)
+
+
+class DWIDenoise(MRTrix3Task):
+    """
+    Example
+    ------
+    >>> task = DWIDenoise(in_file="test_dwi.nii.gz", out_file="denoised.mif")
+    >>> task.inputs.noise = "noise.mif"
+    >>> task.cmdline
+    'dwidenoise test_dwi.nii.gz -noise noise.mif denoised.mif'
+    """
+
+    input_spec = DWIDenoiseInputSpec
+    output_spec = DWIDenoiseOutputSpec
+    executable = "dwidenoise"
+
+
+MRDeGibbsInputSpec = SpecInfo(
+    name="MRDeGibbsInputs",
+    fields=[
+        in_file_field(),
+        out_file_field(),
+        (
+            "axes",
+            attr.ib(
+                type=ty.List[int],
+                metadata={
+                    "argstr": "-axes",
+                    "sep": ",",
+                    "help_string": "slice axes (default 0,1, i.e. axial slices)",
+                },
+            ),
+        ),
+        (
+            "nshifts",
+            attr.ib(
+                type=int,
+                metadata={
+                    "argstr": "-nshifts {nshifts}",
+                    "help_string": "discretization of subpixel spacing (default 20)",
+                },
+            ),
+        ),
+    ],
+    bases=(MRTrix3BaseSpec,),
+)
+
+MRDeGibbsOutputSpec = SpecInfo(
+    name="MRDeGibbsOutputs",
+    fields=[output_field("out_file", "output image")],
+    bases=(MRTrix3OutSpec,),
+)
+
+
+class MRDeGibbs(MRTrix3Task):
+    """
+    Example
+    ------
+    >>> task = MRDeGibbs(in_file="test_dwi.nii.gz", out_file="degibbs.mif", axes=[0, 1])
+    >>> task.cmdline
+    'mrdegibbs test_dwi.nii.gz -axes 0,1 degibbs.mif'
+    """
+
+    input_spec = MRDeGibbsInputSpec
+    output_spec = MRDeGibbsOutputSpec
+    executable = "mrdegibbs"
+
+
+DWIFslPreprocInputSpec = SpecInfo(
+    name="DWIFslPreprocInputs",
+    fields=[
+        in_file_field(),
+        out_file_field("preprocessed DWI image"),
+        (
+            "rpe",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "-rpe_{rpe}",
+                    "help_string": "reversed phase-encoding design: none, pair (a pair "
+                    "of spin-echo b=0 images, see se_epi), all (all DWIs acquired "
+                    "twice) or header (read from the image headers)",
+                    "allowed_values": ["none", "pair", "all", "header"],
+                    "mandatory": True,
+                },
+            ),
+        ),
+        (
+            "pe_dir",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "-pe_dir {pe_dir}",
+                    "help_string": "phase encoding direction of the input, e.g. AP",
+                },
+            ),
+        ),
+        (
+            "readout_time",
+            attr.ib(
+                type=float,
+                metadata={
+                    "argstr": "-readout_time {readout_time}",
+                    "help_string": "total readout time of the input, in seconds",
+                },
+            ),
+        ),
+        (
+            "se_epi",
+            attr.ib(
+                type=File,
+                metadata={
+                    "argstr": "-se_epi {se_epi}",
+                    "help_string": "spin-echo EPI b=0 images for estimating the "
+                    "inhomogeneity field",
+                },
+            ),
+        ),
+        (
+            "json_import",
+            attr.ib(
+                type=File,
+                metadata={
+                    "argstr": "-json_import {json_import}",
+                    "help_string": "JSON sidecar to import header information from",
+                },
+            ),
+        ),
+        (
+            "topup_options",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "-topup_options",
+                    "help_string": "additional command-line options for topup",
+                },
+            ),
+        ),
+        (
+            "eddy_options",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "-eddy_options",
+                    "help_string": "additional command-line options for eddy, e.g. "
+                    "' --slm=linear --repol' (the leading space stops them being read "
+                    "as options of dwifslpreproc)",
+                },
+            ),
+        ),
+        (
+            "eddyqc_text",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "-eddyqc_text {eddyqc_text}",
+                    "help_string": "directory for the text-based quality control "
+                    "outputs of eddy",
+                },
+            ),
+        ),
+    ],
+    bases=(MRTrix3BaseSpec,),
+)
+
+DWIFslPreprocOutputSpec = SpecInfo(
+    name="DWIFslPreprocOutputs",
+    fields=[
+        output_field("out_file", "preprocessed DWI image"),
+        output_field("eddyqc_text", "directory of the quality control outputs of eddy"),
+    ],
+    bases=(MRTrix3OutSpec,),
+)
+
+
+class DWIFslPreproc(MRTrix3Task):
+    """
+    The options passed on to topup and eddy are given to dwifslpreproc as single
+    arguments, however many spaces they contain.
+
+    Example
+    ------
+    >>> task = DWIFslPreproc(in_file="test_dwi.nii.gz", out_file="preproc.mif")
+    >>> task.inputs.rpe = "none"
+    >>> task.inputs.pe_dir = "AP"
+    >>> task.inputs.eddy_options = " --slm=linear --repol"
+    >>> task.cmdline
+    'dwifslpreproc test_dwi.nii.gz -rpe_none -pe_dir AP -eddy_options  --slm=linear --repol preproc.mif'
+    >>> task.command_args[5:7]
+    ['-eddy_options', ' --slm=linear --repol']
+    """
+
+    input_spec = DWIFslPreprocInputSpec
+    output_spec = DWIFslPreprocOutputSpec
+    executable = "dwifslpreproc"
+
+    @property
+    def command_args(self):
+        # pydra splits the values of the inputs on spaces
+        args = super().command_args
+        for name in ("topup_options", "eddy_options"):
+            value = getattr(self.inputs, name)
+            flag = f"-{name}"
+            if value in (None, attr.NOTHING) or flag not in args:
+                continue
+            start = args.index(flag) + 1
+            args[start : start + len(value.split())] = [value]
+        return args
+
+
+DWIBiasCorrectInputSpec = SpecInfo(
+    name="DWIBiasCorrectInputs",
+    fields=[
+        (
+            "algorithm",
+            attr.ib(
+                type=str,
+                default="ants",
+                metadata={
+                    "argstr": "{algorithm}",
+                    "position": 1,
+                    "help_string": "estimation of the bias field with ANTs N4 (ants) "
+                    "or FSL FAST (fsl)",
+                    "allowed_values": ["ants", "fsl"],
+                },
+            ),
+        ),
+        in_file_field(position=2),
+        out_file_field("bias-corrected DWI image"),
+        (
+            "mask",
+            attr.ib(
+                type=File,
+                metadata={
+                    "argstr": "-mask {mask}",
+                    "help_string": "mask of the voxels used to estimate the field",
+                },
+            ),
+        ),
+        (
+            "bias",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "-bias {bias}",
+                    "help_string": "output image of the estimated bias field",
+                },
+            ),
+        ),
+    ],
+    bases=(MRTrix3BaseSpec,),
+)
+
+DWIBiasCorrectOutputSpec = SpecInfo(
+    name="DWIBiasCorrectOutputs",
+    fields=[
+        output_field("out_file", "bias-corrected DWI image"),
+        output_field("bias", "estimated bias field"),
+    ],
+    bases=(MRTrix3OutSpec,),
+)
+
+
+class DWIBiasCorrect(MRTrix3Task):
+    """
+    Example
+    ------
+    >>> task = DWIBiasCorrect(in_file="test_dwi.nii.gz", out_file="unbiased.mif")
+    >>> task.inputs.bias = "bias.mif"
+    >>> task.cmdline
+    'dwibiascorrect ants test_dwi.nii.gz -bias bias.mif unbiased.mif'
+    """
+
+    input_spec = DWIBiasCorrectInputSpec
+    output_spec = DWIBiasCorrectOutputSpec
+    executable = "dwibiascorrect"
+
+
+DWI2MaskInputSpec = SpecInfo(
+    name="DWI2MaskInputs",
+    fields=[
+        in_file_field(),
+        out_file_field("whole-brain mask image"),
+        (
+            "clean_scale",
+            attr.ib(
+                type=int,
+                metadata={
+                    "argstr": "-clean_scale {clean_scale}",
+                    "help_string": "maximum scale used to cut bridges (0 disables the "
+                    "cleaning)",
+                },
+            ),
+        ),
+    ],
+    bases=(MRTrix3BaseSpec,),
+)
+
+DWI2MaskOutputSpec = SpecInfo(
+    name="DWI2MaskOutputs",
+    fields=[output_field("out_file", "whole-brain mask image")],
+    bases=(MRTrix3OutSpec,),
+)
+
+
+class DWI2Mask(MRTrix3Task):
+    """
+    Example
+    ------
+    >>> task = DWI2Mask(in_file="test_dwi.nii.gz", out_file="mask.mif", clean_scale=0)
+    >>> task.cmdline
+    'dwi2mask test_dwi.nii.gz -clean_scale 0 mask.mif'
+    """
+
+    input_spec = DWI2MaskInputSpec
+    output_spec = DWI2MaskOutputSpec
+    executable = "dwi2mask"
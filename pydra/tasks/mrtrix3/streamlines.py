@@ -0,0 +1,659 @@
+"""
+Streaming I/O for MRtrix3 .tck tractograms.
+
+Streamlines are stored as consecutive (x, y, z) triplets, each streamline being
+terminated by a triplet of NaNs and the whole data region by a triplet of Infs.
+The reader maps the data region one fixed-size window at a time and locates the
+delimiters with vectorised scans, so its memory use does not grow with the size
+of the tractogram.
+
+An optional offset index (:class:`TckIndex`), stored as a sidecar next to the
+.tck file, gives random access to individual streamlines and splits the data
+into byte ranges on streamline boundaries for parallel processing.
+
+Example
+-------
+>>> import numpy as np
+>>> from pydra.tasks.mrtrix3.streamlines import TckReader, TckWriter
+>>> with TckWriter("tracks.tck", keyval={"step_size": "0.5"}) as writer:
+...     writer.write_batch([np.zeros((3, 3)), np.ones((2, 3))])
+>>> with TckWriter("tracks.tck", mode="a") as writer:
+...     writer.write(np.full((4, 3), 2.0))
+>>> reader = TckReader("tracks.tck")
+>>> reader.header.count, reader.header.keyval["step_size"]
+(3, '0.5')
+>>> [len(s) for s in reader]
+[3, 2, 4]
+>>> [[len(s) for s in batch] for batch in reader.iter_batches(2)]
+[[3, 2], [4]]
+"""
+import os
+import typing as ty
+import attr
+import numpy as np
+from .image import parse_datatype, read_entries, terminate_header
+
+
+#: default number of bytes of the data region mapped at a time
+DEFAULT_CHUNK_SIZE = 64 * 1024 ** 2
+
+#: width of the zero-padded count field, which is rewritten in place
+COUNT_WIDTH = 10
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class TckHeader:
+    """ header of an MRtrix3 .tck file
+
+        - count is the number of streamlines in the file
+        - datatype is the storage type of the coordinates (Float32LE by default)
+        - offset is the byte offset of the data region
+        - keyval holds all other key-value entries (e.g. step_size, roi)
+    """
+
+    count: int = 0
+    datatype: str = "Float32LE"
+    offset: int = 0
+    keyval: ty.Dict[str, str] = attr.ib(factory=dict)
+    path: ty.Optional[str] = None
+
+    @property
+    def dtype(self) -> np.dtype:
+        return parse_datatype(self.datatype)
+
+    @property
+    def point_size(self) -> int:
+        """ number of bytes taken up by each (x, y, z) triplet """
+        return 3 * self.dtype.itemsize
+
+
+def read_tck_header(path: str) -> TckHeader:
+    """ read the header of an MRtrix3 .tck file """
+    fields = {"keyval": {}}
+    for key, value in read_entries(path, "mrtrix tracks"):
+        if key == "count":
+            fields["count"] = int(value)
+        elif key == "datatype":
+            fields["datatype"] = value
+        elif key == "file":
+            fname, _, offset = value.partition(" ")
+            if fname != ".":
+                raise ValueError(f"'{path}' stores its data in a separate file")
+            fields["offset"] = int(offset)
+        elif key in fields["keyval"]:
+            fields["keyval"][key] += "\n" + value
+        else:
+            fields["keyval"][key] = value
+    if "offset" not in fields:
+        raise ValueError(f"header of '{path}' has no 'file' entry")
+    return TckHeader(path=path, **fields)
+
+
+def concatenate(
+    streamlines: ty.Sequence[np.ndarray],
+) -> ty.Tuple[np.ndarray, np.ndarray]:
+    """ points of N streamlines as one (M, 3) float64 array, with the N + 1 bounds
+        of the points of each streamline in it
+    """
+    bounds = np.zeros(len(streamlines) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in streamlines], out=bounds[1:])
+    if not len(streamlines):
+        return np.zeros((0, 3)), bounds
+    return np.concatenate(streamlines).astype(np.float64, copy=False), bounds
+
+
+def segment_sums(values: np.ndarray, bounds: np.ndarray) -> np.ndarray:
+    """ sums of per-point values over each streamline (0 for empty ones) """
+    cumulative = np.zeros(len(values) + 1)
+    np.cumsum(values, out=cumulative[1:])
+    return cumulative[bounds[1:]] - cumulative[bounds[:-1]]
+
+
+def streamline_lengths(points: np.ndarray, bounds: np.ndarray) -> np.ndarray:
+    """ lengths of the streamlines whose points were concatenated """
+    steps = np.zeros(len(points))
+    steps[1:] = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    # the first point of each streamline doesn't continue the previous one
+    steps[bounds[:-1][bounds[:-1] < len(points)]] = 0.0
+    return segment_sums(steps, bounds)
+
+
+class TckReader:
+    """ iterate over the streamlines of a .tck file with bounded memory use
+
+        The data region is memory-mapped ``chunk_size`` bytes at a time and each
+        streamline is copied out of the mapping as it is yielded. Points are
+        returned as native-endian (N, 3) arrays of the stored float type.
+    """
+
+    def __init__(self, path: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.path = str(path)
+        self.header = read_tck_header(self.path)
+        self.chunk_size = chunk_size
+
+    def __iter__(self) -> ty.Iterator[np.ndarray]:
+        for _, points in self.scan():
+            yield points
+
+    def iter_batches(
+        self, batch_size: int = 100000
+    ) -> ty.Iterator[ty.List[np.ndarray]]:
+        """ yield lists of up to ``batch_size`` streamlines """
+        batch = []
+        for points in self:
+            batch.append(points)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def windows(
+        self, start: ty.Optional[int] = None, stop: ty.Optional[int] = None
+    ) -> ty.Iterator[ty.Tuple[int, np.ndarray]]:
+        """ yield (byte offset, (N, 3) memory map) windows onto the data region
+
+            ``start`` and ``stop`` are byte offsets into the file, defaulting to the
+            start of the data region and the end of the file respectively.
+        """
+        point_size = self.header.point_size
+        start = self.header.offset if start is None else start
+        stop = os.path.getsize(self.path) if stop is None else stop
+        window_points = max(self.chunk_size // point_size, 1)
+        position = start
+        while True:
+            npoints = min(window_points, (stop - position) // point_size)
+            if npoints <= 0:
+                return
+            yield position, np.memmap(
+                self.path,
+                dtype=self.header.dtype,
+                mode="r",
+                offset=position,
+                shape=(npoints, 3),
+            )
+            position += npoints * point_size
+
+    def scan(
+        self, start: ty.Optional[int] = None, stop: ty.Optional[int] = None
+    ) -> ty.Iterator[ty.Tuple[int, np.ndarray]]:
+        """ yield the byte offset and points of each streamline
+
+            ``start`` and ``stop`` must fall on streamline boundaries (e.g. be taken
+            from a :class:`TckIndex`). A trailing streamline without a terminating
+            delimiter (i.e. one still being written) is dropped.
+        """
+        point_size = self.header.point_size
+        native = self.header.dtype.newbyteorder("=")
+        pending, pending_offset = [], start
+        for position, window in self.windows(start, stop):
+            if pending_offset is None:
+                pending_offset = position
+            first_coord = window[:, 0]
+            finished = np.flatnonzero(np.isinf(first_coord))
+            if finished.size:
+                window = window[: finished[0]]
+                first_coord = first_coord[: finished[0]]
+            begin = 0
+            for delimiter in np.flatnonzero(np.isnan(first_coord)):
+                pending.append(window[begin:delimiter])
+                yield pending_offset, np.concatenate(pending).astype(native)
+                begin = int(delimiter) + 1
+                pending, pending_offset = [], position + begin * point_size
+            if begin < len(window):
+                # copy the partial streamline so the window can be released
+                pending.append(np.array(window[begin:]))
+            if finished.size:
+                return
+
+    def scan_offsets(self, stride: int = 1) -> ty.Iterator[np.ndarray]:
+        """ yield arrays of the byte offsets of every ``stride``-th streamline
+
+            Only the delimiters are inspected, so no streamline data are copied.
+        """
+        point_size = self.header.point_size
+        # byte offset at which the next streamline would start, and its number
+        next_start, number = self.header.offset, 0
+        for position, window in self.windows():
+            first_coord = window[:, 0]
+            finished = np.flatnonzero(np.isinf(first_coord))
+            if finished.size:
+                first_coord = first_coord[: finished[0]]
+            ends = np.flatnonzero(np.isnan(first_coord))
+            if ends.size:
+                starts = np.empty(ends.size, dtype=np.uint64)
+                starts[0] = next_start
+                starts[1:] = position + (ends[:-1] + 1) * point_size
+                selected = (number + np.arange(ends.size)) % stride == 0
+                yield starts[selected]
+                next_start = position + (int(ends[-1]) + 1) * point_size
+                number += ends.size
+            if finished.size:
+                return
+
+    def streamline(self, number: int, index: ty.Optional["TckIndex"] = None):
+        """ read a single streamline, using an offset index to locate it """
+        index = load_index(self.path) if index is None else index
+        return next(self.select([number], index=index))
+
+    def select(
+        self, numbers: ty.Iterable[int], index: ty.Optional["TckIndex"] = None
+    ) -> ty.Iterator[np.ndarray]:
+        """ yield the given streamlines (in the order requested) by random access """
+        index = load_index(self.path) if index is None else index
+        for number in numbers:
+            if not 0 <= number < index.count:
+                raise IndexError(f"streamline {number} out of range ({index.count})")
+            start, stop = index.block(number // index.stride)
+            for i, (_, points) in enumerate(self.scan(start, stop)):
+                if i == number % index.stride:
+                    yield points
+                    break
+
+
+#: version of the offset index sidecar layout
+INDEX_VERSION = 1
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class TckIndex:
+    """ byte offsets of every ``stride``-th streamline of a .tck file
+
+        The index records the size and modification time of the .tck file it was
+        built from, and is stored as a .npy sidecar of unsigned 64-bit integers
+        (a metadata block followed by the offsets) that can be memory-mapped.
+
+        Example
+        -------
+        >>> import numpy as np
+        >>> from pydra.tasks.mrtrix3.streamlines import TckWriter, TckReader
+        >>> with TckWriter("indexed.tck") as writer:
+        ...     writer.write_batch([np.full((n + 1, 3), n) for n in range(10)])
+        >>> index = load_index("indexed.tck", stride=4)
+        >>> index.count, len(index.offsets)
+        (10, 3)
+        >>> TckReader("indexed.tck").streamline(6, index=index)[0].tolist()
+        [6.0, 6.0, 6.0]
+        >>> [len(s) for s in TckReader("indexed.tck").select([9, 0], index=index)]
+        [10, 1]
+        >>> load_index("indexed.tck", stride=4, build=False) is not None
+        True
+        >>> [first for first, start, stop in index.chunks(2)]
+        [0, 4]
+    """
+
+    offsets: np.ndarray
+    stride: int
+    count: int
+    end: int
+    tck_size: int
+    tck_mtime: int
+
+    # number of metadata entries preceding the offsets in the sidecar
+    _NMETA = 6
+
+    @classmethod
+    def build(cls, path: str, stride: int = 1) -> "TckIndex":
+        """ scan a .tck file for the offsets of every ``stride``-th streamline """
+        reader = TckReader(path)
+        stat = os.stat(path)
+        offsets = [np.empty(0, dtype=np.uint64)]
+        offsets += list(reader.scan_offsets(stride=stride))
+        offsets = np.concatenate(offsets)
+        # the end of the data is the offset of the terminator, found by a last scan
+        # of the final block only
+        if len(offsets):
+            end = int(offsets[-1])
+            count = (len(offsets) - 1) * stride
+            for offset, points in reader.scan(end):
+                end = offset + (len(points) + 1) * reader.header.point_size
+                count += 1
+        else:
+            end, count = reader.header.offset, 0
+        return cls(
+            offsets=offsets,
+            stride=stride,
+            count=count,
+            end=end,
+            tck_size=stat.st_size,
+            tck_mtime=stat.st_mtime_ns,
+        )
+
+    def is_valid(self, path: str) -> bool:
+        """ whether the .tck file is unchanged since the index was built """
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime_ns) == (self.tck_size, self.tck_mtime)
+
+    def block(self, i: int) -> ty.Tuple[int, int]:
+        """ byte range of the i-th block of ``stride`` streamlines """
+        stop = self.offsets[i + 1] if i + 1 < len(self.offsets) else self.end
+        return int(self.offsets[i]), int(stop)
+
+    def byte_ranges(self, nchunks: int) -> ty.List[ty.Tuple[int, int]]:
+        """ split the data into up to ``nchunks`` byte ranges of similar numbers of
+            streamlines, each starting and ending on a streamline boundary
+        """
+        return [(start, stop) for _, start, stop in self.chunks(nchunks)]
+
+    def chunks(self, nchunks: int) -> ty.List[ty.Tuple[int, int, int]]:
+        """ :meth:`byte_ranges`, each preceded by the number of its first streamline """
+        nblocks = len(self.offsets)
+        if not nblocks:
+            return []
+        bounds = np.unique(
+            np.linspace(0, nblocks, min(nchunks, nblocks) + 1).astype(int)
+        )
+        edges = [int(self.offsets[b]) for b in bounds[:-1]] + [self.end]
+        firsts = [int(b) * self.stride for b in bounds[:-1]]
+        return list(zip(firsts, edges[:-1], edges[1:]))
+
+    def save(self, path: str):
+        meta = [
+            INDEX_VERSION,
+            self.stride,
+            self.count,
+            self.end,
+            self.tck_size,
+            self.tck_mtime,
+        ]
+        data = np.concatenate([np.array(meta, dtype=np.uint64), self.offsets])
+        # write to a temporary file first so readers never see a partial index
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, data)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "TckIndex":
+        data = np.load(path, mmap_mode="r")
+        if data.dtype != np.uint64 or len(data) < cls._NMETA:
+            raise ValueError(f"'{path}' is not a .tck offset index")
+        version, stride, count, end, size, mtime = (int(v) for v in data[: cls._NMETA])
+        if version != INDEX_VERSION:
+            raise ValueError(f"'{path}' has unsupported index version {version}")
+        return cls(
+            offsets=data[cls._NMETA :],
+            stride=stride,
+            count=count,
+            end=end,
+            tck_size=size,
+            tck_mtime=mtime,
+        )
+
+
+def index_path(path: str) -> str:
+    """ path of the offset index sidecar of a .tck file """
+    return str(path) + ".idx.npy"
+
+
+def load_index(path: str, stride: int = 1, build: bool = True) -> ty.Optional[TckIndex]:
+    """ load the offset index sidecar of a .tck file, (re)building it if needed
+
+        A sidecar that does not match the size/modification time of the .tck file,
+        or that was built with a coarser stride than requested, is discarded. If ``build`` is False
+        None is returned in that case, otherwise a new index is built and saved
+        next to the .tck file (if that directory is writable).
+    """
+    sidecar = index_path(path)
+    if os.path.exists(sidecar):
+        try:
+            index = TckIndex.load(sidecar)
+        except ValueError:
+            index = None
+        if index is not None and index.is_valid(path) and index.stride <= stride:
+            return index
+    if not build:
+        return None
+    index = TckIndex.build(path, stride=stride)
+    try:
+        index.save(sidecar)
+    except OSError:
+        pass
+    return index
+
+
+class TckWriter:
+    """ write streamlines to a .tck file, or append them to an existing one
+
+        Each write leaves a valid end-of-data marker behind the new streamlines
+        and the count field of the header is rewritten in place on
+        :meth:`flush`/:meth:`close`, so the file never needs to be rewritten as a
+        whole and memory use is bounded by the size of a single batch. The count
+        fields of files written by other programs (e.g. tckgen) aren't padded, so
+        their header is rewritten with padded fields, once, when they are first
+        opened for appending. When appending, the total_count field (the number of
+        streamlines generated, if the file has one) is increased along with the
+        count.
+
+        Example
+        -------
+        >>> import numpy as np
+        >>> from pydra.tasks.mrtrix3.image import terminate_header
+        >>> header = b"mrtrix tracks\\ntotal_count: 18\\ncount: 9\\n"
+        >>> header += b"datatype: Float32LE\\n"
+        >>> points = np.tile([[0, 0, 0], [np.nan] * 3], (9, 1)).astype("<f4")
+        >>> with open("unpadded.tck", "wb") as f:
+        ...     _ = f.write(terminate_header(header))
+        ...     _ = f.write(points.tobytes() + np.full(3, np.inf, "<f4").tobytes())
+        >>> with TckWriter("unpadded.tck", mode="a") as writer:
+        ...     writer.write(np.ones((2, 3)))
+        >>> header = read_tck_header("unpadded.tck")
+        >>> header.count, int(header.keyval["total_count"])
+        (10, 19)
+    """
+
+    def __init__(
+        self,
+        path: str,
+        mode: str = "w",
+        keyval: ty.Optional[ty.Dict[str, str]] = None,
+        datatype: str = "Float32LE",
+    ):
+        self.path = str(path)
+        self._total_count = None
+        if mode == "w":
+            header = TckHeader(datatype=datatype, keyval=dict(keyval or {}))
+            text = self._header_text(header)
+            with open(self.path, "wb") as f:
+                f.write(text)
+            header.offset = len(text)
+            self.header = attr.evolve(header, path=self.path)
+            self._file = open(self.path, "r+b")
+            end_of_data = self.header.offset
+        elif mode == "a":
+            if keyval:
+                raise ValueError("keyval cannot be changed when appending")
+            self.header = read_tck_header(self.path)
+            self._file = open(self.path, "r+b")
+            end_of_data = self._end_of_data()
+            if "total_count" in self.header.keyval:
+                self._total_count = int(self.header.keyval["total_count"])
+            fields = [self._locate_field("count")]
+            if self._total_count is not None:
+                fields.append(self._locate_field("total_count"))
+            if any(width < COUNT_WIDTH for _, width in fields):
+                end_of_data = self._pad_header(end_of_data)
+        else:
+            raise ValueError(f"mode must be 'w' or 'a', not '{mode}'")
+        self._count_field = self._locate_field("count")
+        self._total_count_field = None
+        if self._total_count is not None:
+            self._total_count_field = self._locate_field("total_count")
+        self._file.seek(end_of_data)
+        self._delimiter = np.full((1, 3), np.nan, dtype=self.header.dtype)
+        self._terminator = np.full((1, 3), np.inf, dtype=self.header.dtype)
+        self._file.write(self._terminator.tobytes())
+        self._file.seek(-self.header.point_size, os.SEEK_CUR)
+
+    def _end_of_data(self) -> int:
+        """ byte offset of the end-of-data marker of an existing file """
+        size = os.path.getsize(self.path)
+        point_size = self.header.point_size
+        end = size - (size - self.header.offset) % point_size - point_size
+        if end >= self.header.offset:
+            self._file.seek(end)
+            last = np.frombuffer(self._file.read(point_size), dtype=self.header.dtype)
+            if np.isinf(last).all():
+                return end
+        # no marker (e.g. an interrupted write): drop any incomplete streamline
+        end, self.header.count = self.header.offset, 0
+        for offset, points in TckReader(self.path).scan():
+            end = offset + (len(points) + 1) * point_size
+            self.header.count += 1
+        return end
+
+    def _locate_field(self, key: str) -> ty.Tuple[int, int]:
+        """ byte offset and width of the value of a field of the header """
+        self._file.seek(0)
+        text = self._file.read(self.header.offset)
+        label = f"\n{key}: ".encode("utf-8")
+        start = text.find(label)
+        if start < 0:
+            raise ValueError(f"'{self.path}' has no {key} field")
+        start += len(label)
+        end = text.index(b"\n", start)
+        return start, end - start
+
+    def _header_text(self, header: TckHeader, offset: ty.Optional[int] = None) -> bytes:
+        """ the header, with zero-padded count fields, terminated at ``offset``
+            (by default the next aligned one)
+        """
+        keyval = dict(header.keyval)
+        padded = {"count": header.count}
+        if self._total_count is not None:
+            del keyval["total_count"]
+            padded["total_count"] = self._total_count
+        lines = ["mrtrix tracks"]
+        for key, value in keyval.items():
+            lines += [f"{key}: {v}" for v in str(value).split("\n")]
+        lines.append(f"datatype: {header.datatype}")
+        lines += [
+            f"{key}: {str(value).zfill(COUNT_WIDTH)}" for key, value in padded.items()
+        ]
+        text = "".join(l + "\n" for l in lines).encode("utf-8")
+        if offset is None:
+            return terminate_header(text)
+        return (text + f"file: . {offset}\nEND\n".encode("utf-8")).ljust(offset, b"\0")
+
+    def _pad_header(self, end_of_data: int) -> int:
+        """ rewrite the header of an existing file with padded count fields,
+            moving its data if the header no longer fits, and return the new
+            offset of the end of the data
+        """
+        offset = self.header.offset
+        text = self._header_text(self.header, offset)
+        if len(text) == offset:
+            self._file.seek(0)
+            self._file.write(text)
+            self._file.flush()
+            return end_of_data
+        text = self._header_text(self.header)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(text)
+                self._file.seek(offset)
+                remaining = end_of_data - offset
+                while remaining:
+                    block = self._file.read(min(remaining, DEFAULT_CHUNK_SIZE))
+                    f.write(block)
+                    remaining -= len(block)
+            self._file.close()
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        self._file = open(self.path, "r+b")
+        self.header.offset = len(text)
+        return end_of_data - offset + len(text)
+
+    def write(self, streamline: np.ndarray):
+        """ append a single (N, 3) streamline """
+        self.write_batch([streamline])
+
+    def write_batch(self, streamlines: ty.Sequence[np.ndarray]):
+        """ append a batch of (N, 3) streamlines with a single write """
+        if not len(streamlines):
+            return
+        pieces = []
+        for points in streamlines:
+            pieces += [np.asarray(points, dtype=self.header.dtype), self._delimiter]
+        # concatenation yields native byte order, so cast back to the stored type
+        data = np.concatenate(pieces + [self._terminator])
+        self._file.write(data.astype(self.header.dtype, copy=False).tobytes())
+        self._file.seek(-self.header.point_size, os.SEEK_CUR)
+        self.header.count += len(streamlines)
+        if self._total_count is not None:
+            self._total_count += len(streamlines)
+
+    def append_tck(self, path: str):
+        """ append all the streamlines of another .tck file
+
+            The data of files of the same datatype are copied as they are, block by
+            block, without parsing the streamlines.
+        """
+        header = read_tck_header(path)
+        end = os.path.getsize(path) - header.point_size
+        terminated = False
+        if header.datatype == self.header.datatype and end >= header.offset:
+            with open(path, "rb") as f:
+                f.seek(end)
+                last = np.frombuffer(f.read(header.point_size), dtype=header.dtype)
+                terminated = bool(np.isinf(last).all())
+        if not terminated or (end - header.offset) % header.point_size:
+            total_count = self._total_count
+            for batch in TckReader(path).iter_batches():
+                self.write_batch(batch)
+            if total_count is not None and "total_count" in header.keyval:
+                self._total_count = total_count + int(header.keyval["total_count"])
+            return
+        with open(path, "rb") as f:
+            f.seek(header.offset)
+            remaining = end - header.offset
+            while remaining:
+                block = f.read(min(remaining, DEFAULT_CHUNK_SIZE))
+                if not block:
+                    raise ValueError(f"'{path}' was truncated while being read")
+                self._file.write(block)
+                remaining -= len(block)
+        self._file.write(self._terminator.tobytes())
+        self._file.seek(-self.header.point_size, os.SEEK_CUR)
+        self.header.count += header.count
+        if self._total_count is not None:
+            self._total_count += int(header.keyval.get("total_count", header.count))
+
+    def flush(self):
+        """ rewrite the count fields to match the streamlines written so far """
+        fields = [(self._count_field, self.header.count)]
+        if self._total_count is not None:
+            self.header.keyval["total_count"] = str(self._total_count)
+            fields.append((self._total_count_field, self._total_count))
+        position = self._file.tell()
+        for (start, width), value in fields:
+            text = str(value).zfill(width)
+            if len(text) > width:
+                raise ValueError(
+                    f"count {value} does not fit into the {width}-character count "
+                    f"field of '{self.path}'"
+                )
+            self._file.seek(start)
+            self._file.write(text.encode("utf-8"))
+        self._file.seek(position)
+        self._file.flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            try:
+                self._file.truncate(self._file.tell() + self.header.point_size)
+            finally:
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,301 @@
+"""
+Measurement of the resources used by MRtrix3 commands.
+
+With the ``telemetry`` input of a task derived from
+:class:`~pydra.tasks.mrtrix3.base.MRTrix3Task` set (or the
+``PYDRA_MRTRIX3_TELEMETRY`` environment variable set for all of them), the run
+of its command is measured and a record of it appended to ``telemetry.jsonl`` in
+its output directory. The measurements are also set as outputs of the task
+(``wall_time``, ``user_time``, ``sys_time``, ``max_rss``, ``read_bytes``, ...).
+Setting the environment variable to the path of a file, rather than to 1,
+also appends the records of all the tasks to that file, to collect those of a
+whole workflow.
+
+Only the commands run by the task are measured, so that the records of tasks
+run concurrently (in threads or processes) don't include each other's. The
+resource usage of each command (``wait4`` rusage) gives its CPU times and peak
+RSS, and ``/proc/<pid>/io``, read once it has exited but before it is reaped,
+the bytes it read and wrote. Both include those of the processes the command
+ran itself. As the rusage only gives the peak RSS of the largest process, the
+memory and threads of the running commands and their descendants are also
+sampled from ``/proc``, their sum being the peak of commands that run
+concurrently (e.g. the stages of a pipeline). The CPU times also include those
+of the thread running the task, but the work done by other threads of its
+process (the in-process conversions of
+:class:`~pydra.tasks.mrtrix3.utils.MRConvert`, the (de)compression of gzipped
+files with ``parallel_gzip``) isn't measured. Measurements that the platform
+doesn't provide are recorded as None.
+
+Example
+-------
+>>> import subprocess, sys
+>>> from pydra.tasks.mrtrix3.telemetry import Recorder
+>>> with Recorder() as recorder:
+...     proc = subprocess.Popen([
+...         sys.executable, "-c", "import time; x = b'x' * 200_000_000; time.sleep(0.5)"
+...     ])
+...     recorder.track(proc)
+...     recorder.wait(proc)
+0
+>>> metrics = recorder.metrics()
+>>> metrics["wall_time"] > 0, metrics["max_rss"] > 200_000_000
+(True, True)
+"""
+import json
+import os
+import sys
+import threading
+import time
+import typing as ty
+from filelock import FileLock
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+#: name of the file of the records, in the output directory of each task
+TELEMETRY_FILE = "telemetry.jsonl"
+
+#: seconds between samples of the memory and threads of the child processes
+SAMPLE_INTERVAL = 0.2
+
+#: measurements set as outputs of the tasks
+METRICS = (
+    "wall_time",
+    "user_time",
+    "sys_time",
+    "max_rss",
+    "max_threads",
+    "read_bytes",
+    "write_bytes",
+    "read_chars",
+    "write_chars",
+)
+
+_ON = {"1", "true", "yes", "on"}
+_OFF = {"0", "false", "no", "off"}
+
+
+def _setting() -> str:
+    return os.environ.get("PYDRA_MRTRIX3_TELEMETRY", "").strip()
+
+
+def enabled(setting=None) -> bool:
+    """ whether to record the telemetry of a task, given its ``telemetry`` input
+        (which overrides the environment if set)
+    """
+    if isinstance(setting, bool):
+        return setting
+    value = _setting()
+    return bool(value) and value.lower() not in _OFF
+
+
+def log_path() -> ty.Optional[str]:
+    """ file collecting the records of all tasks, if the environment names one """
+    value = _setting()
+    if not value or value.lower() in _ON | _OFF:
+        return None
+    return value
+
+
+#: fields of /proc/<pid>/io, by measurement
+IO_FIELDS = {
+    "read_bytes": "read_bytes",
+    "write_bytes": "write_bytes",
+    "read_chars": "rchar",
+    "write_chars": "wchar",
+}
+
+
+def _read_io(pid: int) -> ty.Optional[ty.Dict[str, int]]:
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            return {key: int(value) for key, value in (line.split(":") for line in f)}
+    except OSError:
+        return None
+
+
+def _exit_code(status: int) -> int:
+    # as Popen.returncode, negative for the signal that terminated the process
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _children(pid: int) -> ty.List[int]:
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return []
+    children = []
+    for tid in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children.extend(int(c) for c in f.read().split())
+        except OSError:
+            continue
+    return children
+
+
+def _descendants(pid: int) -> ty.List[int]:
+    found, stack = [], _children(pid)
+    while stack:
+        child = stack.pop()
+        found.append(child)
+        stack.extend(_children(child))
+    return found
+
+
+def _rss_and_threads(pid: int) -> ty.Tuple[int, int]:
+    """ resident memory (in bytes) and number of threads of a process """
+    rss = threads = 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, threads
+
+
+def _maxrss_bytes(usage) -> int:
+    # in kilobytes, but for macOS
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+
+class Recorder:
+    """ measurement of the resources used within a context by the commands
+        registered with :meth:`track` (and the processes they run), and by the
+        thread that entered it
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.start = None
+        self._lock = threading.Lock()
+        self._running = set()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._peak_rss = None
+        self._peak_threads = None
+        self._times = None
+        self._max_rss = None
+        self._io = None
+
+    def __enter__(self) -> "Recorder":
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self._thread_usage = self._rusage()
+        if hasattr(os, "wait4"):
+            self._times = [0.0, 0.0]
+            self._max_rss = 0
+        if os.path.exists(f"/proc/{os.getpid()}/io"):
+            self._io = dict.fromkeys(IO_FIELDS, 0)
+        pid = os.getpid()
+        if os.path.exists(f"/proc/{pid}/task/{pid}/children"):
+            self._peak_rss = self._peak_threads = 0
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall_time = time.perf_counter() - self._started
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+        self._final_thread_usage = self._rusage()
+
+    @staticmethod
+    def _rusage():
+        # that of the calling thread, where the platform provides it
+        if getattr(resource, "RUSAGE_THREAD", None) is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_THREAD)
+
+    def track(self, proc):
+        """ measure a command started within the context, which must then be
+            waited for with :meth:`wait`
+        """
+        with self._lock:
+            self._running.add(proc.pid)
+
+    def wait(self, proc) -> int:
+        """ wait for a tracked command to exit, returning its return code """
+        if self._times is None:
+            return proc.wait()
+        try:
+            if hasattr(os, "waitid"):
+                # leave the process to be reaped, so its /proc entry remains
+                os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+            io = _read_io(proc.pid)
+            _, status, usage = os.wait4(proc.pid, 0)
+        finally:
+            with self._lock:
+                self._running.discard(proc.pid)
+        proc.returncode = _exit_code(status)
+        with self._lock:
+            self._times[0] += usage.ru_utime
+            self._times[1] += usage.ru_stime
+            self._max_rss = max(self._max_rss, _maxrss_bytes(usage))
+            if self._io is not None and io is not None:
+                for metric, key in IO_FIELDS.items():
+                    self._io[metric] += io[key]
+        return proc.returncode
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                running = list(self._running)
+            pids = running + [d for pid in running for d in _descendants(pid)]
+            usage = [_rss_and_threads(pid) for pid in pids]
+            self._peak_rss = max(self._peak_rss, sum(rss for rss, _ in usage))
+            self._peak_threads = max(self._peak_threads, sum(t for _, t in usage))
+            if self._stop.wait(self.interval):
+                return
+
+    def metrics(self) -> ty.Dict[str, ty.Optional[float]]:
+        """ the measurements, once the context has exited """
+        metrics = dict.fromkeys(METRICS)
+        metrics["wall_time"] = self.wall_time
+        metrics["max_rss"] = self._peak_rss
+        metrics["max_threads"] = self._peak_threads
+        if self._times is not None:
+            metrics["user_time"], metrics["sys_time"] = self._times
+            metrics["max_rss"] = max(metrics["max_rss"] or 0, self._max_rss)
+        if self._thread_usage is not None:
+            before, after = self._thread_usage, self._final_thread_usage
+            metrics["user_time"] = (metrics["user_time"] or 0) + (
+                after.ru_utime - before.ru_utime
+            )
+            metrics["sys_time"] = (metrics["sys_time"] or 0) + (
+                after.ru_stime - before.ru_stime
+            )
+        if self._io is not None:
+            metrics.update(self._io)
+        return metrics
+
+
+def write_record(record: dict, path: str):
+    """ append a record to a JSONL file, and to the file collecting those of all
+        tasks if the environment names one
+    """
+    line = json.dumps(record) + "\n"
+    with open(path, "a") as f:
+        f.write(line)
+    shared = log_path()
+    if shared is not None:
+        # the records of concurrent tasks are appended in turn
+        with FileLock(shared + ".lock"):
+            with open(shared, "a") as f:
+                f.write(line)
+
+
+def read_records(path: str) -> ty.List[dict]:
+    """ the records of a JSONL file """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
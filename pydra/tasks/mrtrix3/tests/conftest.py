@@ -0,0 +1,59 @@
+"""
+Stub MRtrix3 executables, for the tests that run tasks end-to-end without MRtrix3
+installed.
+"""
+import os
+import stat
+import pytest
+
+#: logs its arguments to $STUB_LOG, waits for $STUB_SLEEP seconds and copies the
+#: input image (the first argument) to the output image (the last)
+STUB_MRCONVERT = """#!/bin/sh
+if [ "$1" = "-version" ]; then echo "== mrconvert stub =="; exit 0; fi
+case "$1" in __print*) exit 1;; esac
+echo "$@" >> "$STUB_LOG"
+sleep "$STUB_SLEEP"
+for last; do :; done
+cat "$1" > "$last"
+"""
+
+
+@pytest.fixture
+def stub_executables(tmp_path, monkeypatch):
+    """ function installing a shell script as an executable on the PATH, with the
+        settings of the package that would reach outside of the test unset
+    """
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("STUB_LOG", str(tmp_path / "stub.log"))
+    monkeypatch.setenv("STUB_SLEEP", "0")
+    monkeypatch.setenv("PYDRA_MRTRIX3_CHECK_CAPABILITIES", "0")
+    monkeypatch.setenv("PYDRA_MRTRIX3_CAPABILITY_DIR", str(tmp_path / "capabilities"))
+    for name in (
+        "PYDRA_MRTRIX3_CACHE_DIR",
+        "PYDRA_MRTRIX3_TELEMETRY",
+        "MRTRIX_RNG_SEED",
+    ):
+        monkeypatch.delenv(name, raising=False)
+
+    def install(name: str, script: str):
+        stub = bindir / name
+        stub.write_text(script)
+        stub.chmod(stub.stat().st_mode | stat.S_IXUSR)
+
+    return install
+
+
+@pytest.fixture
+def stub_mrconvert(stub_executables, tmp_path):
+    """ function returning the arguments of each run of the mrconvert stub so far """
+    stub_executables("mrconvert", STUB_MRCONVERT)
+    log = tmp_path / "stub.log"
+
+    def runs():
+        if not log.exists():
+            return []
+        return [line.split() for line in log.read_text().splitlines()]
+
+    return runs
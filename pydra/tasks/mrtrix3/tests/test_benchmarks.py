@@ -0,0 +1,90 @@
+"""
+Benchmarks of the overhead of the task layer: constructing MRConvert tasks,
+rendering their command lines, computing their checksums and running them
+end-to-end against a stub mrconvert executable.
+
+Run with, e.g.,
+
+    pytest pydra/tasks/mrtrix3/tests/test_benchmarks.py --benchmark-only \
+        --benchmark-autosave --benchmark-compare --benchmark-compare-fail=min:25%
+
+to append the results to the JSON history under .benchmarks/ and fail on
+regressions against the previous run on the same machine. 1 and 10 task
+instances are benchmarked by default; larger batches can be added with
+PYDRA_MRTRIX3_BENCHMARK_SIZES (e.g. "1,100,10000").
+"""
+import os
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from pydra.tasks.mrtrix3.utils import MRConvert
+
+SIZES = [
+    int(n) for n in os.environ.get("PYDRA_MRTRIX3_BENCHMARK_SIZES", "1,10").split(",")
+]
+
+
+@pytest.fixture(scope="module")
+def inputs(tmp_path_factory):
+    """ a small image and gradient files, as the contents of real inputs are hashed """
+    datadir = tmp_path_factory.mktemp("inputs")
+    paths = {}
+    for name, content in [
+        ("in_file", b"\0" * 4096),
+        ("bvec", b"0 1 0\n0 0 1\n1 0 0\n"),
+        ("bval", b"0 1000 1000\n"),
+    ]:
+        paths[name] = datadir / name
+        paths[name].write_bytes(content)
+    return paths
+
+
+def make_tasks(n, inputs, **kwargs):
+    return [
+        MRConvert(
+            in_file=str(inputs["in_file"]),
+            grad_fsl=[str(inputs["bvec"]), str(inputs["bval"])],
+            out_file="dwi.mif",
+            nthreads=i % 8 + 1,
+            **kwargs,
+        )
+        for i in range(n)
+    ]
+
+
+def run_pedantic(benchmark, func, n):
+    # large batches are repeated less often to keep the suite's run time bounded
+    return benchmark.pedantic(func, rounds=max(20 // n, 3), iterations=1)
+
+
+@pytest.mark.parametrize("n", SIZES)
+def test_instantiation(benchmark, inputs, n):
+    tasks = run_pedantic(benchmark, lambda: make_tasks(n, inputs), n)
+    assert len(tasks) == n
+
+
+@pytest.mark.parametrize("n", SIZES)
+def test_cmdline(benchmark, inputs, n):
+    tasks = make_tasks(n, inputs)
+    cmdlines = run_pedantic(benchmark, lambda: [t.cmdline for t in tasks], n)
+    assert cmdlines[0].startswith("mrconvert ")
+
+
+@pytest.mark.parametrize("n", SIZES)
+def test_checksum(benchmark, inputs, n):
+    tasks = make_tasks(n, inputs)
+    checksums = run_pedantic(benchmark, lambda: [t.checksum for t in tasks], n)
+    assert len(set(checksums)) == min(n, 8)
+
+
+def test_run_stub(benchmark, inputs, stub_mrconvert, tmp_path):
+    counter = iter(range(10 ** 6))
+
+    def run():
+        # a fresh cache directory each round, so nothing is reused between rounds
+        (task,) = make_tasks(1, inputs, cache_dir=tmp_path / f"cache{next(counter)}")
+        return task()
+
+    result = benchmark.pedantic(run, rounds=10, iterations=1)
+    assert result.output.return_code == 0
@@ -0,0 +1,104 @@
+"""
+Reuse of results from the shared result cache, through MRTrix3Task against a
+stub mrconvert executable (see conftest.py).
+"""
+import os
+import pytest
+
+from pydra.tasks.mrtrix3.fixel import FixelCorrespondence
+from pydra.tasks.mrtrix3.utils import MRConvert
+
+#: concatenates the subject's data file and the index of the template directory
+#: into the output data file
+STUB_FIXELCORRESPONDENCE = """#!/bin/sh
+if [ "$1" = "-version" ]; then echo "== fixelcorrespondence stub =="; exit 0; fi
+case "$1" in __print*) exit 1;; esac
+echo "$@" >> "$STUB_LOG"
+mkdir -p "$3"
+cat "$1" "$2/index.mif" > "$3/$4"
+"""
+
+
+@pytest.fixture
+def stub_mrconvert(stub_mrconvert, tmp_path, monkeypatch):
+    # with the result cache enabled
+    monkeypatch.setenv("PYDRA_MRTRIX3_CACHE_DIR", str(tmp_path / "result_cache"))
+    return stub_mrconvert
+
+
+@pytest.fixture
+def in_file(tmp_path):
+    path = tmp_path / "in.mif"
+    path.write_bytes(b"image data")
+    return path
+
+
+def run(in_file, cache_dir):
+    task = MRConvert(in_file=str(in_file), out_file="out.mif", cache_dir=cache_dir)
+    result = task()
+    assert result.output.return_code == 0
+    return task.output_dir / "out.mif"
+
+
+def test_hit_and_miss(stub_mrconvert, in_file, tmp_path):
+    first = run(in_file, tmp_path / "workflow1")
+    assert len(stub_mrconvert()) == 1
+    # a different task instance, with the same input content
+    second = run(in_file, tmp_path / "workflow2")
+    assert len(stub_mrconvert()) == 1
+    assert second.read_bytes() == first.read_bytes() == b"image data"
+    in_file.write_bytes(b"other image data")
+    third = run(in_file, tmp_path / "workflow3")
+    assert len(stub_mrconvert()) == 2
+    assert third.read_bytes() == b"other image data"
+
+
+def test_outputs_stay_writable(stub_mrconvert, in_file, tmp_path):
+    first = run(in_file, tmp_path / "workflow1")
+    second = run(in_file, tmp_path / "workflow2")
+    for output in (first, second):
+        assert os.access(output, os.W_OK)
+    # modifying a fetched output doesn't corrupt the cached one
+    second.write_bytes(b"modified")
+    third = run(in_file, tmp_path / "workflow3")
+    assert len(stub_mrconvert()) == 1
+    assert third.read_bytes() == first.read_bytes() == b"image data"
+
+
+def test_environment_in_key(stub_mrconvert, in_file, tmp_path, monkeypatch):
+    run(in_file, tmp_path / "workflow1")
+    monkeypatch.setenv("MRTRIX_RNG_SEED", "42")
+    run(in_file, tmp_path / "workflow2")
+    assert len(stub_mrconvert()) == 2
+
+
+def test_directory_inputs(stub_executables, tmp_path, monkeypatch):
+    monkeypatch.setenv("PYDRA_MRTRIX3_CACHE_DIR", str(tmp_path / "result_cache"))
+    stub_executables("fixelcorrespondence", STUB_FIXELCORRESPONDENCE)
+    subject = tmp_path / "subject.mif"
+    subject.write_bytes(b"subject ")
+    template_dir = tmp_path / "template"
+    template_dir.mkdir()
+    (template_dir / "index.mif").write_bytes(b"template")
+
+    def run(cache_dir):
+        task = FixelCorrespondence(
+            in_file=str(subject),
+            template_dir=str(template_dir),
+            out_dir="fd",
+            out_file="subject.mif",
+            cache_dir=cache_dir,
+        )
+        assert task().output.return_code == 0
+        return (task.output_dir / "fd" / "subject.mif").read_bytes()
+
+    def runs():
+        return len((tmp_path / "stub.log").read_text().splitlines())
+
+    assert run(tmp_path / "workflow1") == b"subject template"
+    assert run(tmp_path / "workflow2") == b"subject template"
+    assert runs() == 1
+    # the template regenerated at the same path
+    (template_dir / "index.mif").write_bytes(b"new template")
+    assert run(tmp_path / "workflow3") == b"subject new template"
+    assert runs() == 2
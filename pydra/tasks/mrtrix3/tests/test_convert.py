@@ -0,0 +1,68 @@
+"""
+The pool of processes shared by in-process conversions, and the clean-up of the
+outputs of conversions that didn't complete.
+"""
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pytest
+
+from pydra.tasks.mrtrix3.convert import (
+    convert,
+    convert_pool,
+    remove_outputs,
+    shutdown_pool,
+)
+
+
+@pytest.fixture
+def nifti(tmp_path):
+    """ a 2x2x1x3 Int16 NIfTI-1 image """
+    hdr = bytearray(352)
+    struct.pack_into("<i", hdr, 0, 348)
+    struct.pack_into("<8h", hdr, 40, 4, 2, 2, 1, 3, 1, 1, 1)
+    struct.pack_into("<2h", hdr, 70, 4, 16)
+    struct.pack_into("<8f", hdr, 76, 1, 2, 2, 2, 1, 0, 0, 0)
+    struct.pack_into("<f", hdr, 108, 352)
+    struct.pack_into("<2h", hdr, 252, 0, 1)
+    struct.pack_into("<12f", hdr, 280, 2, 0, 0, 0, 0, 2, 0, 0, 0, 0, 2, 0)
+    path = tmp_path / "inputs" / "dwi.nii"
+    path.parent.mkdir()
+    path.write_bytes(bytes(hdr) + np.arange(12, dtype="<i2").tobytes())
+    return str(path)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setenv("PYDRA_MRTRIX3_CONVERT_WORKERS", "1")
+    shutdown_pool()
+    yield
+    shutdown_pool()
+
+
+def test_single_pool_across_threads(pool):
+    with ThreadPoolExecutor(8) as threads:
+        pools = list(threads.map(lambda _: convert_pool(), range(8)))
+    assert all(p is pools[0] for p in pools)
+
+
+def test_broken_pool_replaced(pool, nifti, tmp_path):
+    broken = convert_pool()
+    with pytest.raises(BrokenProcessPool):
+        # a worker killed mid-task, as by the OOM killer
+        broken.submit(os._exit, 1).result()
+    with pytest.raises(BrokenProcessPool):
+        convert(in_file=nifti, out_file=str(tmp_path / "first.mif"))
+    header = convert(in_file=nifti, out_file=str(tmp_path / "second.mif"))
+    assert convert_pool() is not broken
+    assert os.path.getsize(tmp_path / "second.mif") > header.nbytes
+
+
+def test_remove_mih_outputs(pool, nifti, tmp_path):
+    out_file = str(tmp_path / "dwi.mih")
+    convert(in_file=nifti, out_file=out_file)
+    assert sorted(os.listdir(tmp_path)) == ["dwi.dat", "dwi.mih", "inputs"]
+    remove_outputs(in_file=nifti, out_file=out_file)
+    assert os.listdir(tmp_path) == ["inputs"]
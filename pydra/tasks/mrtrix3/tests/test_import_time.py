@@ -0,0 +1,67 @@
+"""
+Guards on the cost of importing the package, paid by every pydra worker process.
+
+Each check runs in a fresh interpreter with pydra already imported, so only the
+modules imported on top of it by this package count against the budget
+(``PYDRA_MRTRIX3_IMPORT_BUDGET_MS``, in milliseconds, 50 by default).
+"""
+import os
+import re
+import subprocess as sp
+import sys
+import pytest
+
+IMPORT_BUDGET_MS = float(os.environ.get("PYDRA_MRTRIX3_IMPORT_BUDGET_MS", "50"))
+
+
+def run_python(code, *flags):
+    # the package may be imported from the source tree rather than installed
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    return sp.run(
+        [sys.executable, *flags, "-c", code],
+        stdout=sp.PIPE,
+        stderr=sp.PIPE,
+        universal_newlines=True,
+        env=env,
+        check=True,
+    )
+
+
+def imported_after_pydra(module):
+    """ (module, self time in microseconds) of the imports made by ``module`` """
+    stderr = run_python(f"import pydra; import {module}", "-X", "importtime").stderr
+    timings = re.findall(r"import time:\s+(\d+) \|\s+\d+ \| *(\S+)", stderr)
+    # pydra is imported first; everything reported after it is down to the module
+    names = [name for _, name in timings]
+    start = names.index("pydra") + 1
+    return [(name, int(self_us)) for self_us, name in timings[start:]]
+
+
+@pytest.mark.parametrize(
+    "module", ["pydra.tasks.mrtrix3", "pydra.tasks.mrtrix3.utils"],
+)
+def test_import_time(module):
+    imported = imported_after_pydra(module)
+    total_ms = sum(us for _, us in imported) / 1000
+    slowest = sorted(imported, key=lambda item: -item[1])[:5]
+    assert total_ms < IMPORT_BUDGET_MS, f"{total_ms:.1f} ms, slowest: {slowest}"
+
+
+def test_package_import_is_lazy():
+    out = run_python(
+        "import sys, pydra.tasks.mrtrix3;"
+        "print(' '.join(m for m in sys.modules if m.startswith('pydra.tasks.mrtrix3.')"
+        " or m == 'numpy'))"
+    ).stdout
+    loaded = out.split()
+    assert "numpy" not in loaded
+    assert "pydra.tasks.mrtrix3.utils" not in loaded
+    assert "pydra.tasks.mrtrix3._version" not in loaded
+
+
+def test_task_modules_dont_import_numpy():
+    out = run_python(
+        "import sys, pydra.tasks.mrtrix3.utils, pydra.tasks.mrtrix3.pipeline;"
+        "print('numpy' in sys.modules)"
+    ).stdout
+    assert out.strip() == "False"
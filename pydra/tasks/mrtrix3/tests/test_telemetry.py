@@ -0,0 +1,48 @@
+"""
+Measurement of the resources used by MRTrix3Task instances, against a stub
+mrconvert executable (see conftest.py).
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+from pydra.tasks.mrtrix3.telemetry import TELEMETRY_FILE, read_records
+from pydra.tasks.mrtrix3.utils import MRConvert
+
+
+def make_task(tmp_path, name, nbytes=1_000_000):
+    in_file = tmp_path / f"{name}.mif"
+    in_file.write_bytes(b"x" * nbytes)
+    return MRConvert(
+        in_file=str(in_file),
+        out_file="out.mif",
+        telemetry=True,
+        cache_dir=tmp_path / name,
+    )
+
+
+def test_outputs(stub_mrconvert, tmp_path):
+    task = make_task(tmp_path, "task")
+    output = task().output
+    assert output.return_code == 0
+    assert output.wall_time > 0
+    assert output.max_rss > 0
+    assert output.input_bytes == 1_000_000
+    assert output.output_bytes >= 1_000_000
+    if os.path.exists("/proc/self/io"):
+        assert output.read_chars >= 1_000_000
+        assert output.write_chars >= 1_000_000
+    assert os.path.basename(output.telemetry_file) == TELEMETRY_FILE
+    [record] = read_records(output.telemetry_file)
+    assert record["return_code"] == 0
+    assert record["wall_time"] == output.wall_time
+
+
+def test_concurrent_tasks(stub_mrconvert, tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_SLEEP", "0.5")
+    # a task run alongside one converting a hundred times more data
+    tasks = [make_task(tmp_path, "small"), make_task(tmp_path, "large", 100_000_000)]
+    with ThreadPoolExecutor(2) as pool:
+        small, large = [r.output for r in pool.map(lambda task: task(), tasks)]
+    if os.path.exists("/proc/self/io"):
+        assert small.write_chars < 10_000_000 <= large.write_chars
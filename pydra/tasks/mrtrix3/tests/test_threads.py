@@ -0,0 +1,70 @@
+"""
+Allocation of nthreads from the node-wide budget to MRTrix3Task instances run
+concurrently, against a stub mrconvert executable (see conftest.py).
+"""
+from concurrent.futures import ProcessPoolExecutor
+import pytest
+
+from pydra.tasks.mrtrix3.threads import ThreadBudget
+from pydra.tasks.mrtrix3.utils import MRConvert, MRConvertBatch
+
+
+@pytest.fixture
+def granted(stub_mrconvert, tmp_path, monkeypatch):
+    """ function returning the nthreads granted to each run of the stub """
+    monkeypatch.setenv("STUB_SLEEP", "1")
+    monkeypatch.setenv("PYDRA_MRTRIX3_NTHREADS", "8")
+    monkeypatch.setenv("PYDRA_MRTRIX3_NTHREADS_DIR", str(tmp_path / "registry"))
+    monkeypatch.delenv("PYDRA_MRTRIX3_MAX_THREADS", raising=False)
+    return lambda: [int(args[args.index("-nthreads") + 1]) for args in stub_mrconvert()]
+
+
+def run_task(in_file, cache_dir):
+    task = MRConvert(in_file=in_file, out_file="out.mif", cache_dir=cache_dir)
+    return task().output.return_code
+
+
+@pytest.mark.parametrize(
+    "expected_tasks, ntasks, grants", [(4, 4, [2] * 4), (2, 2, [4, 4])]
+)
+def test_concurrent_tasks(
+    granted, tmp_path, monkeypatch, expected_tasks, ntasks, grants
+):
+    monkeypatch.setenv("PYDRA_MRTRIX3_EXPECTED_TASKS", str(expected_tasks))
+    in_file = tmp_path / "in.mif"
+    in_file.write_bytes(b"image data")
+    with ProcessPoolExecutor(ntasks) as pool:
+        futures = [
+            pool.submit(run_task, str(in_file), str(tmp_path / f"workflow{i}"))
+            for i in range(ntasks)
+        ]
+        assert [future.result() for future in futures] == [0] * ntasks
+    assert sorted(granted()) == grants
+    assert ThreadBudget.from_env().active() == {}
+
+
+def test_batch_shares_its_grant(granted, tmp_path, monkeypatch):
+    monkeypatch.setenv("PYDRA_MRTRIX3_EXPECTED_TASKS", "1")
+    monkeypatch.setenv("STUB_SLEEP", "0")
+    in_files = []
+    for i in range(3):
+        in_files.append(tmp_path / f"in_{i}.mif")
+        in_files[-1].write_bytes(b"image data")
+    task = MRConvertBatch(
+        in_file=[str(p) for p in in_files], max_workers=2, cache_dir=tmp_path
+    )
+    out_files = task().output.out_files
+    # the 8 threads granted to the task, between the 2 conversions run at once
+    assert granted() == [4] * 3
+    assert [p.read_bytes() for p in out_files] == [b"image data"] * 3
+    assert ThreadBudget.from_env().active() == {}
+
+
+def test_grants_within_budget(tmp_path):
+    budget = ThreadBudget(ncores=16, expected_tasks=4, registry_dir=tmp_path)
+    tokens = [budget.acquire() for _ in range(6)]
+    granted = [threads for _, threads in tokens]
+    assert granted == [4, 4, 4, 4, 1, 1]
+    budget.release(tokens[0][0])
+    # the threads released are granted again, up to the share of the tasks active
+    assert budget.acquire()[1] == 2
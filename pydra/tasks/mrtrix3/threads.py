@@ -0,0 +1,159 @@
+"""
+Node-wide allocation of CPU threads between concurrently running MRtrix3 tasks.
+
+When ``nthreads`` is left unset every MRtrix3 command uses all the cores of the
+machine, so that concurrent tasks launched by pydra's workers oversubscribe it.
+With the ``PYDRA_MRTRIX3_NTHREADS`` environment variable set to ``auto`` (all
+available cores) or to a number of cores, tasks derived from
+:class:`~pydra.tasks.mrtrix3.base.MRTrix3Task` that don't set ``nthreads``
+instead draw a share of that budget from a registry kept in a lock-protected
+file on the node. The threads of a running command can't be changed, so each
+task receives an equal share of the cores given the number of MRtrix3 tasks
+active when it starts or, if larger, the number of tasks expected to run
+concurrently (``PYDRA_MRTRIX3_EXPECTED_TASKS``, by default the square root of
+the number of cores), so that the first tasks to start don't take all the cores.
+The share is limited to the cores not already held by others (and to
+``PYDRA_MRTRIX3_MAX_THREADS``, if set), but is never less than one thread.
+Entries of processes that died without releasing their threads are discarded.
+
+Example
+-------
+>>> from pydra.tasks.mrtrix3.threads import ThreadBudget
+>>> budget = ThreadBudget(ncores=8, expected_tasks=1, registry_dir="thread_registry")
+>>> with budget.allocate() as first:
+...     with budget.allocate() as second:
+...         with budget.allocate() as third:
+...             (first, second, third)
+(8, 1, 1)
+>>> budget = ThreadBudget(ncores=8, expected_tasks=3, registry_dir="thread_registry")
+>>> with budget.allocate() as first:
+...     with budget.allocate() as second:
+...         with budget.allocate() as third:
+...             (first, second, third)
+(2, 2, 2)
+>>> budget = ThreadBudget(ncores=8, max_threads=3, registry_dir="thread_registry")
+>>> with budget.allocate() as first:
+...     with budget.allocate() as second:
+...         with budget.allocate() as third:
+...             (first, second, third)
+(3, 3, 2)
+>>> budget.active()
+{}
+"""
+import json
+import math
+import os
+import tempfile
+import typing as ty
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from filelock import FileLock
+
+
+def available_cores() -> int:
+    """ number of cores this process may run on """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ThreadBudget:
+    """ budget of cores on a node, shared through a registry file """
+
+    def __init__(
+        self,
+        ncores: ty.Optional[int] = None,
+        max_threads: ty.Optional[int] = None,
+        registry_dir: ty.Optional[str] = None,
+        expected_tasks: ty.Optional[int] = None,
+    ):
+        self.ncores = ncores or available_cores()
+        self.max_threads = max_threads
+        self.expected_tasks = expected_tasks or max(int(math.sqrt(self.ncores)), 1)
+        if registry_dir is None:
+            registry_dir = os.path.join(
+                tempfile.gettempdir(), f"pydra-mrtrix3-threads-{os.getuid()}"
+            )
+        self.registry_dir = Path(registry_dir)
+        self.registry_dir.mkdir(parents=True, exist_ok=True)
+        self.registry = self.registry_dir / "registry.json"
+        # an OS-level lock, so it is released if its holder is killed
+        self.lock = FileLock(str(self.registry_dir / "registry.lock"))
+
+    @classmethod
+    def from_env(cls) -> ty.Optional["ThreadBudget"]:
+        """ budget configured through the environment, or None if it is disabled """
+        setting = os.environ.get("PYDRA_MRTRIX3_NTHREADS", "").strip().lower()
+        if not setting:
+            return None
+        max_threads = os.environ.get("PYDRA_MRTRIX3_MAX_THREADS")
+        expected_tasks = os.environ.get("PYDRA_MRTRIX3_EXPECTED_TASKS")
+        return cls(
+            ncores=None if setting == "auto" else int(setting),
+            max_threads=int(max_threads) if max_threads else None,
+            registry_dir=os.environ.get("PYDRA_MRTRIX3_NTHREADS_DIR"),
+            expected_tasks=int(expected_tasks) if expected_tasks else None,
+        )
+
+    def _read(self) -> ty.Dict[str, dict]:
+        try:
+            entries = json.loads(self.registry.read_text())
+        except (OSError, ValueError):
+            return {}
+        return {k: v for k, v in entries.items() if _pid_alive(v["pid"])}
+
+    def _write(self, entries: ty.Dict[str, dict]):
+        tmp = self.registry.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(entries))
+        os.replace(tmp, self.registry)
+
+    def active(self) -> ty.Dict[str, int]:
+        """ threads held by each active allocation """
+        with self.lock:
+            return {k: v["threads"] for k, v in self._read().items()}
+
+    def share(self, entries: ty.Dict[str, dict]) -> int:
+        """ number of threads granted to a new task, given the active ones """
+        held = sum(entry["threads"] for entry in entries.values())
+        tasks = max(self.expected_tasks, len(entries) + 1)
+        threads = min(self.ncores // tasks, self.ncores - held)
+        if self.max_threads is not None:
+            threads = min(threads, self.max_threads)
+        return max(threads, 1)
+
+    def acquire(self) -> ty.Tuple[str, int]:
+        """ register a new task, returning its token and number of threads """
+        token = uuid.uuid4().hex
+        with self.lock:
+            entries = self._read()
+            threads = self.share(entries)
+            entries[token] = {"pid": os.getpid(), "threads": threads}
+            self._write(entries)
+        return token, threads
+
+    def release(self, token: str):
+        with self.lock:
+            entries = self._read()
+            entries.pop(token, None)
+            self._write(entries)
+
+    @contextmanager
+    def allocate(self) -> ty.Iterator[int]:
+        """ hold a share of the budget for the duration of the context """
+        token, threads = self.acquire()
+        try:
+            yield threads
+        finally:
+            self.release(token)
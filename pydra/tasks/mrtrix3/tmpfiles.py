@@ -0,0 +1,95 @@
+"""
+Placement of the temporary images of MRtrix3 commands.
+
+MRtrix3 commands write temporary and piped images to ``MRTRIX_TMPFILE_DIR``,
+which defaults to the working directory (often the pydra cache directory, on
+shared storage). Tasks derived from :class:`~pydra.tasks.mrtrix3.base.MRTrix3Task`
+with the ``tmpfile_dir`` input (or the ``PYDRA_MRTRIX3_TMPFILE_DIR`` environment
+variable) set to a directory instead create them in a private subdirectory of it,
+which is removed once the command finishes, whether or not it succeeded. With
+``auto``, the size of the temporary images is estimated from the headers of the
+input images, and the first of /dev/shm, the local scratch directories listed in
+``PYDRA_MRTRIX3_SCRATCH_DIRS`` and the system's temporary directory with enough
+free space is chosen, falling back to the working directory.
+
+Example
+-------
+>>> import os
+>>> from pydra.tasks.mrtrix3.tmpfiles import choose_tmpfile_dir, private_tmpfile_dir
+>>> choose_tmpfile_dir(2 ** 30, candidates=["no_such_dir"], fallback="fallback")
+'fallback'
+>>> with private_tmpfile_dir(".") as tmpfile_dir:
+...     with open(os.path.join(tmpfile_dir, "leftover.mif"), "w") as f:
+...         _ = f.write("partial image")
+>>> os.path.exists(tmpfile_dir)
+False
+"""
+import os
+import shutil
+import tempfile
+import typing as ty
+from contextlib import contextmanager
+
+
+#: margin of free space required on top of the estimated size of temporary images
+HEADROOM = 1.25
+
+AUTO = "auto"
+
+
+def image_nbytes(path: str) -> int:
+    """ size of the data of an image, from its header (0 if it isn't an image) """
+    from .image import read_image_header
+
+    try:
+        return read_image_header(path).nbytes
+    except (OSError, ValueError):
+        return 0
+
+
+def estimate_bytes(paths: ty.Iterable[str], copies: int = 1) -> int:
+    """ estimated size of ``copies`` temporary images the size of all inputs """
+    return copies * sum(image_nbytes(p) for p in paths)
+
+
+def candidate_dirs() -> ty.List[str]:
+    """ directories considered for temporary images, fastest first """
+    candidates = ["/dev/shm"]
+    scratch = os.environ.get("PYDRA_MRTRIX3_SCRATCH_DIRS", "")
+    candidates.extend(d for d in scratch.split(os.pathsep) if d)
+    candidates.append(tempfile.gettempdir())
+    return candidates
+
+
+def choose_tmpfile_dir(
+    nbytes: int,
+    candidates: ty.Optional[ty.Sequence[str]] = None,
+    fallback: str = os.curdir,
+) -> str:
+    """ first candidate directory with room for ``nbytes`` of temporary images """
+    if candidates is None:
+        candidates = candidate_dirs()
+    for directory in candidates:
+        if not (os.path.isdir(directory) and os.access(directory, os.W_OK)):
+            continue
+        if shutil.disk_usage(directory).free >= nbytes * HEADROOM:
+            return directory
+    return fallback
+
+
+@contextmanager
+def private_tmpfile_dir(base: str) -> ty.Iterator[str]:
+    """ private subdirectory of ``base``, removed with anything left in it """
+    os.makedirs(base, exist_ok=True)
+    directory = tempfile.mkdtemp(prefix="pydra-mrtrix3-", dir=base)
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def tmpfile_environment(directory: str) -> ty.Dict[str, str]:
+    """ variables to add to the environment of commands so that they place their
+        temporary images in a directory
+    """
+    return {"MRTRIX_TMPFILE_DIR": os.path.abspath(directory)}
@@ -0,0 +1,336 @@
+import attr
+import typing as ty
+from pydra.engine.specs import File, SpecInfo
+from .base import (
+    MRTrix3BaseSpec,
+    MRTrix3OutSpec,
+    MRTrix3Task,
+    in_file_field,
+    out_file_field,
+    output_field,
+)
+
+
+def _roi_option(name, help_string):
+    return (
+        name,
+        attr.ib(
+            type=ty.List[str],
+            metadata={
+                "argstr": f"-{name}...",
+                "help_string": help_string + " (a mask image, or a sphere given as "
+                "x,y,z,radius in mm)",
+            },
+        ),
+    )
+
+
+TckEditInputSpec = SpecInfo(
+    name="TckEditInputs",
+    fields=[
+        in_file_field(help_string="input tractogram"),
+        out_file_field("output tractogram"),
+        _roi_option("include", "regions each streamline must traverse"),
+        _roi_option(
+            "include_ordered",
+            "regions each streamline must traverse, in the order given",
+        ),
+        _roi_option("exclude", "regions no streamline may enter"),
+        _roi_option("mask", "regions outside which streamlines are truncated"),
+        (
+            "maxlength",
+            attr.ib(
+                type=float,
+                metadata={
+                    "argstr": "-maxlength {maxlength}",
+                    "help_string": "maximum length of the streamlines, in mm",
+                },
+            ),
+        ),
+        (
+            "minlength",
+            attr.ib(
+                type=float,
+                metadata={
+                    "argstr": "-minlength {minlength}",
+                    "help_string": "minimum length of the streamlines, in mm",
+                },
+            ),
+        ),
+        (
+            "number",
+            attr.ib(
+                type=int,
+                metadata={
+                    "argstr": "-number {number}",
+                    "help_string": "maximum number of streamlines to output",
+                },
+            ),
+        ),
+        (
+            "skip",
+            attr.ib(
+                type=int,
+                metadata={
+                    "argstr": "-skip {skip}",
+                    "help_string": "number of selected streamlines to skip before "
+                    "writing any",
+                },
+            ),
+        ),
+        (
+            "maxweight",
+            attr.ib(
+                type=float,
+                metadata={
+                    "argstr": "-maxweight {maxweight}",
+                    "help_string": "maximum weight of the streamlines",
+                },
+            ),
+        ),
+        (
+            "minweight",
+            attr.ib(
+                type=float,
+                metadata={
+                    "argstr": "-minweight {minweight}",
+                    "help_string": "minimum weight of the streamlines",
+                },
+            ),
+        ),
+        (
+            "inverse",
+            attr.ib(
+                type=bool,
+                metadata={
+                    "argstr": "-inverse",
+                    "help_string": "output the streamlines failing the criteria",
+                },
+            ),
+        ),
+        (
+            "ends_only",
+            attr.ib(
+                type=bool,
+                metadata={
+                    "argstr": "-ends_only",
+                    "help_string": "only test the endpoints of each streamline "
+                    "against the include and exclude regions",
+                },
+            ),
+        ),
+        (
+            "tck_weights_in",
+            attr.ib(
+                type=File,
+                metadata={
+                    "argstr": "-tck_weights_in {tck_weights_in}",
+                    "help_string": "weights of the input streamlines",
+                },
+            ),
+        ),
+        (
+            "tck_weights_out",
+            attr.ib(
+                type=str,
+                metadata={
+                    "argstr": "-tck_weights_out {tck_weights_out}",
+                    "help_string": "output text file of the weights of the selected "
+                    "streamlines",
+                },
+            ),
+        ),
+    ],
+    bases=(MRTrix3BaseSpec,),
+)
+
+TckEditOutputSpec = SpecInfo(
+    name="TckEditOutputs",
+    fields=[
+        output_field("out_file", "output tractogram"),
+        output_field("tck_weights_out", "weights of the selected streamlines"),
+    ],
+    bases=(MRTrix3OutSpec,),
+)
+
+
+class TckEdit(MRTrix3Task):
+    """
+    Several selections can be made from a large tractogram in a single, parallel
+    pass over it with :func:`~pydra.tasks.mrtrix3.filtering.filter_tracks`.
+
+    Example
+    ------
+    >>> from pydra.tasks.mrtrix3.streamlines import TckWriter
+    >>> TckWriter("tracks.tck").close()
+    >>> task = TckEdit(in_file="tracks.tck", out_file="selected.tck")
+    >>> task.inputs.include = ["test_dwi.nii.gz", "-10,0,4.5,3"]
+    >>> task.inputs.minlength = 10.0
+    >>> task.inputs.number = 1000
+    >>> task.cmdline
+    'tckedit tracks.tck -include test_dwi.nii.gz -include -10,0,4.5,3 -minlength 10.0 -number 1000 selected.tck'
+    """
+
+    input_spec = TckEditInputSpec
+    output_spec = TckEditOutputSpec
+    executable = "tckedit"
+    compressed_outputs = ()
+
+
+def _tckgen_option(name, type, help_string, **metadata):
+    argstr = f"-{name}" if type is bool else f"-{name} {{{name}}}"
+    return (
+        name,
+        attr.ib(
+            type=type,
+            metadata={"argstr": argstr, "help_string": help_string, **metadata},
+        ),
+    )
+
+
+TckGenInputSpec = SpecInfo(
+    name="TckGenInputs",
+    fields=[
+        in_file_field(help_string="image of the fibre orientations (e.g. FODs)"),
+        out_file_field("output tractogram"),
+        _tckgen_option(
+            "algorithm",
+            str,
+            "tractography algorithm (default iFOD2)",
+            allowed_values=[
+                "fact",
+                "ifod1",
+                "ifod2",
+                "nulldist1",
+                "nulldist2",
+                "sd_stream",
+                "seedtest",
+                "tensor_det",
+                "tensor_prob",
+            ],
+        ),
+        _tckgen_option("select", int, "number of streamlines to select"),
+        _tckgen_option("step", float, "step size, in mm"),
+        _tckgen_option("angle", float, "maximum angle between steps, in degrees"),
+        _tckgen_option("minlength", float, "minimum length of the streamlines, in mm"),
+        _tckgen_option("maxlength", float, "maximum length of the streamlines, in mm"),
+        _tckgen_option("cutoff", float, "FOD amplitude terminating the streamlines"),
+        _tckgen_option("trials", int, "number of sampling trials at each step"),
+        _tckgen_option("downsample", int, "downsampling factor of the output"),
+        _roi_option("seed_image", "seed regions, seeded at random"),
+        _tckgen_option(
+            "seed_gmwmi",
+            File,
+            "seed from the grey matter - white matter interface (requires act)",
+        ),
+        _tckgen_option(
+            "seed_dynamic",
+            File,
+            "seed dynamically, from the fibre densities of the given FOD image",
+        ),
+        _tckgen_option("seeds", int, "number of seeds to draw (0 for no limit)"),
+        _tckgen_option(
+            "max_attempts_per_seed", int, "number of attempts at tracking from a seed"
+        ),
+        _tckgen_option(
+            "seed_unidirectional", bool, "track from the seeds in one direction only"
+        ),
+        _tckgen_option(
+            "output_seeds", str, "output text file of the seeds of the streamlines"
+        ),
+        _roi_option("include", "regions each streamline must traverse"),
+        _roi_option("exclude", "regions no streamline may enter"),
+        _roi_option("mask", "regions outside which streamlines are terminated"),
+        _tckgen_option("act", File, "5TT image for anatomically-constrained tracking"),
+        _tckgen_option("backtrack", bool, "allow streamlines to backtrack (with act)"),
+        _tckgen_option(
+            "crop_at_gmwmi",
+            bool,
+            "crop the streamlines at the grey matter - white matter interface",
+        ),
+        (
+            "rng_seed",
+            attr.ib(
+                type=int,
+                metadata={
+                    "help_string": "seed of the random number generator (passed as "
+                    "MRTRIX_RNG_SEED), for reproducible tracking",
+                },
+            ),
+        ),
+        (
+            "npartitions",
+            attr.ib(
+                type=int,
+                metadata={
+                    "help_string": "split the selection between this number of "
+                    "tckgen runs with different seeds, checkpointing each (see "
+                    "pydra.tasks.mrtrix3.partitioned_tracking)",
+                },
+            ),
+        ),
+        (
+            "checkpoint_dir",
+            attr.ib(
+                type=str,
+                metadata={
+                    "help_string": "directory holding the finished partitions (by "
+                    "default, one under the cache directory of the package)",
+                },
+            ),
+        ),
+    ],
+    bases=(MRTrix3BaseSpec,),
+)
+
+TckGenOutputSpec = SpecInfo(
+    name="TckGenOutputs",
+    fields=[
+        output_field("out_file", "output tractogram"),
+        output_field("output_seeds", "seeds of the streamlines"),
+    ],
+    bases=(MRTrix3OutSpec,),
+)
+
+
+class TckGen(MRTrix3Task):
+    """
+    With ``npartitions`` set, the selection is generated by that many tckgen
+    runs with different random seeds, sharing the threads of the task. Each
+    finished run is kept as a checkpoint, so that a run that was interrupted
+    (e.g. pre-empted) only repeats the unfinished ones when run again.
+
+    Example
+    ------
+    >>> task = TckGen(in_file="test_dwi.nii.gz", out_file="tracks.tck")
+    >>> task.inputs.seed_image = ["test_dwi.nii.gz"]
+    >>> task.inputs.select = 10000000
+    >>> task.inputs.npartitions = 8
+    >>> task.cmdline
+    'tckgen test_dwi.nii.gz -select 10000000 -seed_image test_dwi.nii.gz tracks.tck'
+    """
+
+    input_spec = TckGenInputSpec
+    output_spec = TckGenOutputSpec
+    executable = "tckgen"
+    compressed_outputs = ()
+    # the streamlines differ between runs, even with the same seed when threaded
+    cacheable = False
+
+    def _run_command(self):
+        from .partitioned_tracking import PartitionedTracking, rng_seed_environment
+
+        npartitions = self.inputs.npartitions
+        if npartitions in (None, attr.NOTHING) or npartitions <= 1:
+            with self._set_environment(rng_seed_environment(self.inputs.rng_seed)):
+                return super()._run_command()
+        tracking = PartitionedTracking(
+            self, npartitions, checkpoint_dir=self.inputs.checkpoint_dir
+        )
+        tracking.run()
+        count = tracking.merge()
+        self.output_ = {
+            "return_code": 0,
+            "stdout": f"{count} streamlines from {npartitions} partitions",
+            "stderr": "",
+        }
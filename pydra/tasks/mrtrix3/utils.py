@@ -1,10 +1,17 @@
+import os
+import json
+import logging
 import attr
+import pydra
 import typing as ty
-from pydra import ShellCommandTask
-from pydra.engine.specs import File, SpecInfo, ShellSpec, ShellOutSpec
-from .base import MRTrix3BaseSpec
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from pydra.engine.specs import File, SpecInfo, ShellSpec
+from .base import MRTrix3BaseSpec, MRTrix3OutSpec, MRTrix3Task
 
 
+logger = logging.getLogger(__name__)
+
 MRConvertInputSpec = SpecInfo(
     name="MRConvertInputs",
     fields=[
@@ -129,12 +136,16 @@ MRConvertOutputSpec = SpecInfo(
             ),
         ),
     ],
-    bases=(ShellOutSpec,),
+    bases=(MRTrix3OutSpec,),
 )
 
 
-class MRConvert(ShellCommandTask):
+class MRConvert(MRTrix3Task):
     """
+    Plain conversions of NIfTI images to .mif/.mih (i.e. without coord, vox, axes
+    or scaling) are done in-process, without running mrconvert (see
+    :mod:`pydra.tasks.mrtrix3.convert`).
+
     Example
     ------
     >>> task = MRConvert()
@@ -149,3 +160,333 @@ class MRConvert(ShellCommandTask):
     input_spec = MRConvertInputSpec
     output_spec = MRConvertOutputSpec
     executable = "mrconvert"
+
+    def fast_convert_kwargs(self) -> ty.Optional[dict]:
+        """ arguments of :func:`~pydra.tasks.mrtrix3.convert.nifti_to_mif` if the
+            conversion is a plain NIfTI to .mif/.mih reformat, otherwise None
+        """
+        from .convert import enabled, NIFTI_EXTENSIONS, MRTRIX_EXTENSIONS
+
+        inputs = self.inputs
+
+        def value(name):
+            value = getattr(inputs, name)
+            return None if value in (None, attr.NOTHING, []) else value
+
+        if not enabled() or any(
+            value(name) for name in ("coord", "vox", "axes", "scaling", "args")
+        ):
+            return None
+        in_file, out_file = str(inputs.in_file), value("out_file")
+        if not (
+            in_file.endswith(NIFTI_EXTENSIONS)
+            and out_file
+            and out_file.endswith(MRTRIX_EXTENSIONS)
+        ):
+            return None
+        if os.path.exists(out_file) and not value("force"):
+            # leave it to mrconvert to report the clash
+            return None
+        return {
+            "in_file": in_file,
+            "out_file": out_file,
+            "grad_fsl": value("grad_fsl"),
+            "grad_file": value("grad_file"),
+            "export_grad": value("export_grad"),
+            "export_json": value("export_json"),
+            "command_history": " ".join(
+                str(a) for a in self.command_args if a not in ["", " "]
+            ),
+        }
+
+    def _run_command(self):
+        from .convert import UnsupportedConversion, convert, remove_outputs
+
+        kwargs = self.fast_convert_kwargs()
+        if kwargs is None:
+            return super()._run_command()
+        try:
+            convert(**kwargs)
+        except UnsupportedConversion as e:
+            logger.info("converting %s with mrconvert: %s", kwargs["in_file"], e)
+            remove_outputs(**kwargs)
+            return super()._run_command()
+        self.output_ = {"return_code": 0, "stdout": "", "stderr": ""}
+
+
+MRConvertBatchInputSpec = SpecInfo(
+    name="MRConvertBatchInputs",
+    fields=[
+        (
+            "in_file",
+            attr.ib(
+                type=ty.List[File],
+                metadata={
+                    "help_string": "input images, one per conversion",
+                    "mandatory": True,
+                },
+            ),
+        ),
+        (
+            "out_file",
+            attr.ib(
+                type=ty.List[str],
+                metadata={"help_string": "output images (default: dwi_<index>.mif)",},
+            ),
+        ),
+        (
+            "grad_fsl",
+            attr.ib(
+                type=ty.List[ty.List[File]],
+                metadata={
+                    "help_string": "FSL format gradient files [bvecs, bvals] per input",
+                    "xor": "grad_file",
+                },
+            ),
+        ),
+        (
+            "grad_file",
+            attr.ib(
+                type=ty.List[File],
+                metadata={
+                    "help_string": "MRTrix3 format gradient file per input",
+                    "xor": "grad_fsl",
+                },
+            ),
+        ),
+        (
+            "coord",
+            attr.ib(
+                type=ty.List[float],
+                metadata={"help_string": "extract data at the specific coordinatest",},
+            ),
+        ),
+        (
+            "vox",
+            attr.ib(
+                type=ty.List[float],
+                metadata={"help_string": "change the voxel dimensions"},
+            ),
+        ),
+        (
+            "axes",
+            attr.ib(
+                type=ty.List[int],
+                metadata={"help_string": "specify the axes that will be used"},
+            ),
+        ),
+        (
+            "scaling",
+            attr.ib(
+                type=ty.List[float],
+                metadata={"help_string": "specify the data scaling parameter"},
+            ),
+        ),
+        (
+            "nthreads",
+            attr.ib(
+                type=int,
+                metadata={
+                    "help_string": "number of CPU threads of each conversion "
+                    "(default: the threads drawn from the node's budget, or the "
+                    "available cores, divided by max_workers)",
+                },
+            ),
+        ),
+        (
+            "max_workers",
+            attr.ib(
+                type=int,
+                default=4,
+                metadata={"help_string": "maximum number of concurrent conversions"},
+            ),
+        ),
+    ],
+    bases=(ShellSpec,),
+)
+
+
+def _batch_out_files(field, output_dir):
+    report = json.loads((Path(output_dir) / "batch.json").read_text())
+    return [
+        Path(output_dir) / item["out_file"] if item["return_code"] == 0 else None
+        for item in report
+    ]
+
+
+MRConvertBatchOutputSpec = SpecInfo(
+    name="MRConvertBatchOutputs",
+    fields=[
+        (
+            "out_files",
+            attr.ib(
+                type=ty.List[ty.Optional[File]],
+                metadata={
+                    "help_string": "output images (None for failed conversions)",
+                    "callable": _batch_out_files,
+                },
+            ),
+        ),
+        (
+            "report",
+            attr.ib(
+                type=File,
+                metadata={
+                    "help_string": "JSON report of the command, return code and "
+                    "stderr of each conversion",
+                    "value": "batch.json",
+                },
+            ),
+        ),
+    ],
+    bases=(MRTrix3OutSpec,),
+)
+
+
+class MRConvertBatch(MRTrix3Task):
+    """
+    Run many conversions from a single task, with at most ``max_workers``
+    mrconvert processes at a time. Failed conversions don't fail the task (unless
+    all of them fail); they are reported in ``report`` and have None in place of
+    their output in ``out_files``.
+
+    Example
+    ------
+    >>> task = MRConvertBatch()
+    >>> task.inputs.in_file = ["sub-01_dwi.nii.gz", "sub-02_dwi.nii.gz"]
+    >>> task.inputs.grad_fsl = [["sub-01.bvec", "sub-01.bval"],
+    ...                         ["sub-02.bvec", "sub-02.bval"]]
+    >>> task.inputs.nthreads = 2
+    >>> for args in task.item_args():
+    ...     print(" ".join(args))
+    mrconvert sub-01_dwi.nii.gz -nthreads 2 -fslgrad sub-01.bvec sub-01.bval dwi_0.mif
+    mrconvert sub-02_dwi.nii.gz -nthreads 2 -fslgrad sub-02.bvec sub-02.bval dwi_1.mif
+    """
+
+    input_spec = MRConvertBatchInputSpec
+    output_spec = MRConvertBatchOutputSpec
+    executable = "mrconvert"
+    # the items are converted (or not) independently, so aren't cached
+    cacheable = False
+
+    def item_args(self) -> ty.List[ty.List[str]]:
+        """ command line of each conversion """
+        return [args for args, _ in self.items()]
+
+    def items(self) -> ty.List[ty.Tuple[ty.List[str], ty.Optional[dict]]]:
+        """ command line of each conversion, with the arguments of its in-process
+            conversion (None if it has to be run by mrconvert)
+        """
+        inputs = self.inputs
+        nitems = len(inputs.in_file)
+        per_item = {"in_file": inputs.in_file}
+        for name in ("out_file", "grad_fsl", "grad_file"):
+            values = getattr(inputs, name)
+            if values in (None, attr.NOTHING):
+                continue
+            if len(values) != nitems:
+                raise ValueError(
+                    f"{name} has {len(values)} entries but there are {nitems} inputs"
+                )
+            per_item[name] = values
+        if "out_file" not in per_item:
+            per_item["out_file"] = [f"dwi_{i}.mif" for i in range(nitems)]
+        nthreads = inputs.nthreads
+        if nthreads in (None, attr.NOTHING):
+            from .threads import available_cores
+
+            nthreads = max(available_cores() // inputs.max_workers, 1)
+        shared = {
+            name: getattr(inputs, name)
+            for name in ("coord", "vox", "axes", "scaling")
+            if getattr(inputs, name) not in (None, attr.NOTHING)
+        }
+        # a single MRConvert renders the arguments of every item
+        template = MRConvert(executable=inputs.executable, nthreads=nthreads, **shared)
+        items = []
+        for i in range(nitems):
+            template.inputs = attr.evolve(
+                template.inputs, **{name: v[i] for name, v in per_item.items()}
+            )
+            args = [str(a) for a in template.command_args if a not in ["", " "]]
+            items.append((args, template.fast_convert_kwargs()))
+        return items
+
+    def _concurrent_commands(self) -> int:
+        return max(min(self.inputs.max_workers, len(self.inputs.in_file)), 1)
+
+    def _run_command(self):
+        from .convert import UnsupportedConversion, remove_outputs
+        from .convert import convert as convert_in_process
+
+        def convert(item):
+            args, fast_kwargs = item
+            if fast_kwargs is not None:
+                try:
+                    convert_in_process(**fast_kwargs)
+                    return 0, ""
+                except UnsupportedConversion as e:
+                    logger.info(
+                        "converting %s with mrconvert: %s", fast_kwargs["in_file"], e
+                    )
+                    remove_outputs(**fast_kwargs)
+                except (OSError, ValueError) as e:
+                    return -1, f"{e}\n"
+            try:
+                self._check_capabilities([args])
+            except (OSError, ValueError) as e:
+                return -1, f"{e}\n"
+            return_code, _, stderr = self._run_process(args)
+            return return_code, stderr
+
+        items = self.items()
+        all_args = [args for args, _ in items]
+        with ThreadPoolExecutor(max_workers=self.inputs.max_workers) as pool:
+            results = list(pool.map(convert, items))
+        report = [
+            {"args": args, "out_file": args[-1], "return_code": rc, "stderr": stderr}
+            for args, (rc, stderr) in zip(all_args, results)
+        ]
+        Path("batch.json").write_text(json.dumps(report, indent=2))
+        failed = [item for item in report if item["return_code"]]
+        self.output_ = {
+            "return_code": 0,
+            "stdout": f"{len(report) - len(failed)} of {len(report)} conversions "
+            "succeeded\n",
+            "stderr": "".join(
+                f"{' '.join(item['args'])}:\n{item['stderr']}" for item in failed
+            ),
+        }
+        if report and len(failed) == len(report):
+            raise RuntimeError(self.output_["stderr"])
+
+
+@pydra.mark.task
+@pydra.mark.annotate(
+    {
+        "return": {
+            "size": ty.List[int],
+            "spacing": ty.List[float],
+            "datatype": str,
+            "nvolumes": int,
+            "header": dict,
+        }
+    }
+)
+def header_info(in_file: File):
+    """
+    Read image metadata from the header alone, without running mrinfo or
+    mrconvert -json_export. ``header`` holds the same keys as exported by MRtrix3,
+    with the axes realigned to the scanner axes as MRtrix3 presents them.
+    """
+    from .image import read_image_header
+
+    header = read_image_header(in_file)
+    nvolumes = header.dim[3] if header.ndim > 3 else 1
+    return (
+        list(header.dim),
+        list(header.vox),
+        header.datatype,
+        nvolumes,
+        header.to_json(),
+    )
@@ -0,0 +1,205 @@
+"""
+Workflows assembled from the tasks of the package.
+
+Each node of a workflow carries the resources it is tuned for in its
+``resources`` attribute (a :class:`StageResources`), with ``nthreads`` also set
+as its input so that concurrent nodes don't oversubscribe the node they run on.
+The defaults of each workflow can be overridden stage by stage.
+
+Example
+-------
+>>> from pydra.tasks.mrtrix3.workflows import dwi_preproc_workflow
+>>> wf = dwi_preproc_workflow(
+...     in_file=["sub-01_dwi.nii.gz", "sub-02_dwi.nii.gz"],
+...     grad_fsl=[["sub-01.bvec", "sub-01.bval"], ["sub-02.bvec", "sub-02.bval"]],
+...     pe_dir="AP",
+... )
+>>> wf.state.splitter
+('dwi_preproc.in_file', 'dwi_preproc.grad_fsl')
+>>> [node.name for node in wf.graph.sorted_nodes]
+['denoise', 'fslpreproc', 'biascorrect', 'mask']
+>>> wf.fslpreproc.resources
+StageResources(nthreads=8, mem_gb=8.0)
+>>> wf.denoise.resources
+StageResources(nthreads=9, mem_gb=7.0)
+>>> wf.denoise.inputs.stages  # doctest: +NORMALIZE_WHITESPACE
+[['mrconvert', '{in_file}', '-nthreads', '1', '-fslgrad', '{grad_fsl[0]}',
+  '{grad_fsl[1]}', '-'], ['dwidenoise', '-', '-nthreads', '4', '-'],
+ ['mrdegibbs', '-', '-nthreads', '4', 'degibbs.mif']]
+>>> wf = dwi_preproc_workflow(
+...     in_file=["sub-01_dwi.nii.gz", "sub-02_dwi.nii.gz"],
+...     grad_fsl=[["sub-01.bvec", "sub-01.bval"], ["sub-02.bvec", "sub-02.bval"]],
+...     se_epi="se_epi.mif",
+...     rpe="pair",
+... )
+>>> wf.state.splitter
+('dwi_preproc.in_file', 'dwi_preproc.grad_fsl')
+"""
+import attr
+import typing as ty
+import pydra
+from .pipeline import pipe
+from .preprocess import DWI2Mask, DWIBiasCorrect, DWIDenoise, DWIFslPreproc, MRDeGibbs
+from .utils import MRConvert
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class StageResources:
+    """ threads and memory (in GB) a stage of a workflow is tuned for
+
+        nthreads of None leaves the threads of the stage to the node's thread
+        budget (see :mod:`pydra.tasks.mrtrix3.threads`)
+    """
+
+    nthreads: ty.Optional[int] = None
+    mem_gb: float = 1.0
+
+
+#: resources of the stages of :func:`dwi_preproc_workflow`. dwidenoise and
+#: mrdegibbs scale well with threads; eddy dominates the run time and memory
+DWI_PREPROC_RESOURCES = {
+    "convert": StageResources(nthreads=1, mem_gb=1.0),
+    "denoise": StageResources(nthreads=4, mem_gb=4.0),
+    "degibbs": StageResources(nthreads=4, mem_gb=2.0),
+    "fslpreproc": StageResources(nthreads=8, mem_gb=8.0),
+    "biascorrect": StageResources(nthreads=4, mem_gb=4.0),
+    "mask": StageResources(nthreads=1, mem_gb=1.0),
+}
+
+
+def _run_at_once(*resources: StageResources) -> StageResources:
+    """ resources of stages run at the same time, as in a pipeline """
+    nthreads = [r.nthreads for r in resources]
+    return StageResources(
+        nthreads=None if None in nthreads else sum(nthreads),
+        mem_gb=sum(r.mem_gb for r in resources),
+    )
+
+
+def _is_list(value) -> bool:
+    return isinstance(value, (list, tuple))
+
+
+def _with_resources(task_class, resources: StageResources, **inputs):
+    """ task with the given inputs (those that are None left unset) and resources """
+    if resources.nthreads is not None:
+        inputs["nthreads"] = resources.nthreads
+    task = task_class(**{k: v for k, v in inputs.items() if v is not None})
+    task.resources = resources
+    return task
+
+
+def dwi_preproc_workflow(
+    in_file: ty.Union[str, ty.List[str]],
+    grad_fsl: ty.Optional[ty.List] = None,
+    se_epi: ty.Optional[ty.Union[str, ty.List[str]]] = None,
+    name: str = "dwi_preproc",
+    rpe: str = "none",
+    pe_dir: ty.Optional[str] = None,
+    readout_time: ty.Optional[float] = None,
+    eddy_options: ty.Optional[str] = None,
+    bias_algorithm: str = "ants",
+    fuse: bool = True,
+    resources: ty.Optional[ty.Dict[str, StageResources]] = None,
+    **kwargs,
+) -> pydra.Workflow:
+    """ mrconvert, dwidenoise, mrdegibbs, dwifslpreproc, dwibiascorrect and dwi2mask
+
+        Given lists of inputs (in_file, and grad_fsl and se_epi if set), the
+        workflow is split over subjects, a single se_epi being shared by all of
+        them. With ``fuse`` set, the light stages
+        mrconvert, dwidenoise and mrdegibbs are run as a single pipeline node
+        named ``denoise`` (see :mod:`pydra.tasks.mrtrix3.pipeline`), so that
+        their intermediate images never reach the cache directory; as they run at
+        the same time, its resources are the sum of theirs. ``resources`` overrides the entries of
+        :data:`DWI_PREPROC_RESOURCES`, and other keyword arguments are passed on
+        to the workflow (e.g. ``cache_dir``).
+
+        The outputs are the preprocessed image (dwi), its brain mask (mask) and
+        the estimated bias field (bias).
+    """
+    stage = {**DWI_PREPROC_RESOURCES, **(resources or {})}
+    subject_inputs = {"in_file": in_file, "grad_fsl": grad_fsl, "se_epi": se_epi}
+    subject_inputs = {k: v for k, v in subject_inputs.items() if v is not None}
+    wf = pydra.Workflow(name=name, input_spec=list(subject_inputs), **kwargs)
+    wf.inputs = attr.evolve(wf.inputs, **subject_inputs)
+    if isinstance(in_file, (list, tuple)):
+        # a single se_epi is shared by the subjects
+        split = [k for k in subject_inputs if k != "se_epi" or _is_list(se_epi)]
+        wf.split(tuple(split) if len(split) > 1 else "in_file")
+    elif _is_list(se_epi):
+        raise ValueError(
+            f"se_epi lists {len(se_epi)} images but in_file is a single image"
+        )
+
+    grad_kwargs = {"grad_fsl": wf.lzin.grad_fsl} if grad_fsl is not None else {}
+    convert = _with_resources(
+        MRConvert,
+        stage["convert"],
+        name="convert",
+        in_file=wf.lzin.in_file,
+        out_file="dwi.mif",
+        **grad_kwargs,
+    )
+    denoise = _with_resources(
+        DWIDenoise, stage["denoise"], name="denoise", out_file="denoised.mif"
+    )
+    degibbs = _with_resources(
+        MRDeGibbs, stage["degibbs"], name="degibbs", out_file="degibbs.mif"
+    )
+    if fuse:
+        fused = pipe(convert, denoise, degibbs, name="denoise")
+        fused.resources = _run_at_once(
+            stage["convert"], stage["denoise"], stage["degibbs"]
+        )
+        wf.add(fused)
+    else:
+        denoise.inputs.in_file = wf.convert.lzout.out_file
+        degibbs.inputs.in_file = wf.denoise.lzout.out_file
+        wf.add(convert)
+        wf.add(denoise)
+        wf.add(degibbs)
+    previous = wf.denoise if fuse else wf.degibbs
+
+    wf.add(
+        _with_resources(
+            DWIFslPreproc,
+            stage["fslpreproc"],
+            name="fslpreproc",
+            in_file=previous.lzout.out_file,
+            out_file="preproc.mif",
+            rpe=rpe,
+            pe_dir=pe_dir,
+            readout_time=readout_time,
+            se_epi=wf.lzin.se_epi if se_epi is not None else None,
+            eddy_options=eddy_options,
+        )
+    )
+    wf.add(
+        _with_resources(
+            DWIBiasCorrect,
+            stage["biascorrect"],
+            name="biascorrect",
+            algorithm=bias_algorithm,
+            in_file=wf.fslpreproc.lzout.out_file,
+            out_file="unbiased.mif",
+            bias="bias.mif",
+        )
+    )
+    wf.add(
+        _with_resources(
+            DWI2Mask,
+            stage["mask"],
+            name="mask",
+            in_file=wf.biascorrect.lzout.out_file,
+            out_file="mask.mif",
+        )
+    )
+    wf.set_output(
+        [
+            ("dwi", wf.biascorrect.lzout.out_file),
+            ("mask", wf.mask.lzout.out_file),
+            ("bias", wf.biascorrect.lzout.bias),
+        ]
+    )
+    return wf